@@ -1,4 +1,19 @@
 from .version import __version__
-from .db import Database, DatabaseError
+from .crypto import CryptoError
+from .db import Database, DatabaseError, Entry, SealedPassword, SearchResult
+from .dbset import DatabaseSet
+from .history import History
+from .shared import SharedDatabase
 
-__all__ = ["__version__", "Database", "DatabaseError"]
+__all__ = [
+    "__version__",
+    "CryptoError",
+    "Database",
+    "DatabaseError",
+    "DatabaseSet",
+    "Entry",
+    "History",
+    "SealedPassword",
+    "SearchResult",
+    "SharedDatabase",
+]
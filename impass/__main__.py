@@ -4,16 +4,36 @@ import os
 import io
 import sys
 import json
-import gpg  # type: ignore
+import time
+import shlex
 import getpass
 import argparse
 import textwrap
+import datetime
 import subprocess
 import collections
 
 from typing import Optional, NoReturn, List, Callable, Union, Sequence, Any, Dict
 
-from .db import Database, DatabaseError, DEFAULT_NEW_PASSWORD_OCTETS
+from .db import (
+    Database,
+    DatabaseError,
+    DATABASE_VERSIONS,
+    DEFAULT_NEW_PASSWORD_OCTETS,
+    DEFAULT_SNAPSHOTS,
+    parse_date,
+    parse_duration,
+)
+from .audit import BreachCorpus, audit as do_audit
+from .crypto import CryptoError, RecipientSet, get_backend
+from .dbset import DBSET_SUFFIX, DatabaseSet
+from .history import History
+from .hosts import PUBLIC_SUFFIX_LIST, HostIndex
+from .native import NativeHost, ProtocolError
+from .policy import DEFAULT_WORDLIST, PolicyError, PolicySet
+from .rekey import rekey as do_rekey, throughput
+from .stats import Timings, database_stats, prometheus, timing_stats, write_prometheus
+from .sync import get_remote, sync as do_sync
 from .version import __version__
 
 PROG = "impass"
@@ -50,7 +70,31 @@ def error(code: int, msg: str = "") -> NoReturn:
     sys.exit(code)
 
 
-def open_db(keyid: Optional[str] = None, create: bool = False) -> Database:
+class Session:
+    """State of an interactive shell session.
+
+    The database is opened once, on first use, and kept open for the
+    following commands; saves are deferred until commit or exit.
+
+    """
+
+    def __init__(self, keyid: str) -> None:
+        self.keyid = keyid
+        self.db: Optional[Union[Database, DatabaseSet]] = None
+
+
+# the running shell session, if any
+SESSION: Optional[Session] = None
+
+# wall time of operations and commands, saved in IMPASS_STATS by main()
+TIMINGS = Timings()
+
+
+def open_db(
+    keyid: Optional[str] = None, create: bool = False
+) -> Union[Database, DatabaseSet]:
+    if SESSION is not None and SESSION.db is not None:
+        return SESSION.db
     db_path = os.getenv("IMPASS_DB", os.path.join(IMPASS_DIR, "db"))
     if not create and not os.path.exists(db_path):
         error(
@@ -59,18 +103,90 @@ def open_db(keyid: Optional[str] = None, create: bool = False) -> Database:
 To add an entry to the database use 'impass add'.
 See 'impass help' for more information.""",
         )
+    recipients = None
+    recipients_path = os.getenv("IMPASS_RECIPIENTS", db_path + ".recipients")
+    if os.path.exists(recipients_path):
+        try:
+            recipients = RecipientSet.load(recipients_path)
+        except CryptoError as e:
+            error(20, "Recipient set error: {}".format(e))
     try:
-        db = Database(db_path, keyid)
-    except gpg.errors.GPGMEError as e:
+        db: Union[Database, DatabaseSet]
+        with TIMINGS.timed("open"):
+            if os.path.isdir(db_path):
+                db = DatabaseSet(db_path, keyid)
+            else:
+                db = Database(db_path, keyid, recipients=recipients)
+        if isinstance(db, Database):
+            try:
+                db.snapshot_limit = int(
+                    os.getenv("IMPASS_SNAPSHOTS", DEFAULT_SNAPSHOTS)
+                )
+            except ValueError:
+                pass
+        # waits for the members of a database set, raising their errors
+        sigvalid = db.sigvalid
+    except CryptoError as e:
         error(20, "Decryption error: {}".format(e))
     except DatabaseError as e:
         error(10, "Impass database error: {}".format(e.msg))
-    if db.sigvalid is False:
+    if sigvalid is False:
         log("WARNING: could not validate OpenPGP signature on db file.")
+    if os.getenv("IMPASS_CRYPTO") == "null":
+        log("WARNING: IMPASS_CRYPTO=null, the database is not encrypted.")
+    if SESSION is not None:
+        SESSION.db = db
     return db
 
 
+def warn_recipient_drift(db: Union[Database, DatabaseSet]) -> None:
+    if not isinstance(db, Database):
+        return
+    added, removed = db.recipient_drift()
+    if added or removed:
+        log("WARNING: database recipients differ from the recipient set:")
+        for fpr in added:
+            log("  adding {}".format(fpr))
+        for keyid in removed:
+            log("  removing {}".format(keyid))
+
+
+def save_db(db: Union[Database, DatabaseSet]) -> None:
+    # in a shell session, changes are saved on commit or exit
+    if SESSION is None:
+        warn_recipient_drift(db)
+        with TIMINGS.timed("save"):
+            db.save()
+
+
+def open_history(keyid: Optional[str] = None) -> Optional[History]:
+    history_path = os.getenv("IMPASS_HISTORY", os.path.join(IMPASS_DIR, "history"))
+    if not history_path:
+        return None
+    # the history is decrypted lazily, on first use
+    return History(history_path, keyid)
+
+
+def record_history(history: Optional[History], context: str) -> None:
+    if history is None:
+        return
+    try:
+        history.record(context)
+        history.save()
+    except (CryptoError, DatabaseError) as e:
+        log("WARNING: could not update context history: {}".format(e))
+
+
+def get_timings_path() -> Optional[str]:
+    path = os.getenv("IMPASS_STATS", os.path.join(IMPASS_DIR, "stats"))
+    if not path or not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        return None
+    return path
+
+
 def get_keyid() -> str:
+    if SESSION is not None:
+        return SESSION.keyid
     keyid = os.getenv("IMPASS_KEYID")
     keyfile = os.getenv("IMPASS_KEYFILE", os.path.join(IMPASS_DIR, "keyid"))
 
@@ -93,10 +209,9 @@ def get_keyid() -> str:
         error(20)
 
     try:
-        gpgctx = gpg.Context()
-        gpgctx.get_key(keyid, secret=False)
-    except gpg.errors.GPGMEError as e:
-        log("GPGME error for key ID {}:".format(keyid))
+        get_backend().resolve_key(keyid)
+    except CryptoError as e:
+        log("Crypto error for key ID {}:".format(keyid))
         log("  {}".format(e))
         error(20)
 
@@ -110,6 +225,13 @@ def get_keyid() -> str:
 
 
 class Completer:
+    """Readline completer.
+
+    Matches are offered in the order of the completions list, so
+    completions should be ordered by preference.
+
+    """
+
     def __init__(self, completions: Optional[List[str]] = None):
         if completions is None:
             self.completions: List[str] = []
@@ -124,9 +246,9 @@ class Completer:
             return None
 
 
-def input_complete(
-    prompt: str, completions: Optional[List[str]] = None, default: Optional[str] = None
-) -> str:
+def set_completions(
+    completions: Optional[List[str]] = None, default: Optional[str] = None
+) -> None:
     try:
         # lifted from magic-wormhole/codes.py
         import readline
@@ -143,6 +265,12 @@ def input_complete(
             readline.set_startup_hook(lambda: readline.insert_text(default))
     except ImportError:
         pass
+
+
+def input_complete(
+    prompt: str, completions: Optional[List[str]] = None, default: Optional[str] = None
+) -> str:
+    set_completions(completions, default)
     try:
         return input(prompt)
     except KeyboardInterrupt:
@@ -154,15 +282,20 @@ def retrieve_context(
     prompt: str = "context: ",
     default: Optional[str] = None,
     stdin: bool = True,
-    db: Optional[Database] = None,
+    db: Optional[Union[Database, DatabaseSet]] = None,
 ) -> str:
     if arg == "-" and stdin:
         context = sys.stdin.read()
     elif arg is None or arg == ":":
         if db:
-            context = input_complete(
-                prompt, completions=[c for c in db], default=default
-            )
+            completions = [c for c in db]
+            history = open_history()
+            if history is not None:
+                try:
+                    completions = history.rank(completions)
+                except (CryptoError, DatabaseError) as e:
+                    log("WARNING: could not read context history: {}".format(e))
+            context = input_complete(prompt, completions=completions, default=default)
         else:
             context = input_complete(prompt, default=default)
     else:
@@ -178,35 +311,87 @@ class PasswordAction(argparse.Action):
         values: Optional[Union[str, Sequence[Any]]],
         option_string: Optional[str] = None,
     ) -> None:
+        policies = get_policies()
         env_password = os.getenv("IMPASS_PASSWORD")
-        if env_password is None or env_password == "":
-            password: Optional[Union[str, int]] = None
-        elif env_password in ["prompt", ":"]:
+        password: Optional[str] = None
+        if env_password in ["prompt", ":"]:
             password = ":"
-        else:
-            try:
-                password = int()
-            except ValueError:
+        elif env_password:
+            if not is_pwspec(policies, env_password):
                 error(
                     1,
-                    "IMPASS_PASSWORD environment variable is neither int nor 'prompt'.",
+                    "IMPASS_PASSWORD environment variable is neither a password "
+                    "policy nor 'prompt'.",
                 )
+            password = env_password
         if values == ":":
             password = ":"
         elif isinstance(values, str):
-            try:
-                password = int(values)
-            except ValueError:
+            if not is_pwspec(policies, values):
                 error(666, "Don't type your password on the command line!!!")
+            password = values
         setattr(namespace, self.dest, password)
 
 
-def retrieve_password(pwspec: str) -> str:
+def get_policies() -> PolicySet:
+    path = os.getenv("IMPASS_POLICIES", os.path.join(IMPASS_DIR, "policies"))
+    if not os.path.exists(path):
+        return PolicySet()
+    try:
+        return PolicySet.load(path)
+    except PolicyError as e:
+        error(1, "Password policy error: {}".format(e))
+
+
+def is_pwspec(policies: PolicySet, spec: str) -> bool:
+    try:
+        policies.get(spec)
+    except PolicyError:
+        return False
+    return True
+
+
+def retrieve_password(pwspec: Optional[str], context: str) -> str:
     if pwspec == ":":
         return input_password()
-    else:
-        log("Auto-generating password...")
-        return pwspec
+    log("Auto-generating password...")
+    try:
+        return get_policies().select(context, pwspec).generate()[0]
+    except PolicyError as e:
+        error(1, "Password policy error: {}".format(e))
+
+
+def retrieve_date(spec: str, past: bool = False) -> datetime.datetime:
+    """Resolve an ISO-8601 date or a duration relative to now.
+
+    Durations (e.g. '30d') are counted into the future, or into the
+    past if past is True.
+
+    """
+    try:
+        delta = parse_duration(spec)
+    except DatabaseError:
+        try:
+            return parse_date(spec)
+        except DatabaseError as e:
+            error(1, e.msg)
+    now = datetime.datetime.utcnow()
+    return now - delta if past else now + delta
+
+
+def retrieve_fields(specs: Optional[List[str]]) -> Dict[str, Optional[str]]:
+    """Parse NAME=VALUE field specs.
+
+    An empty value (NAME=) maps the field to None.
+
+    """
+    fields: Dict[str, Optional[str]] = {}
+    for spec in specs or []:
+        name, sep, value = spec.partition("=")
+        if not sep or not name:
+            error(1, "Invalid field '{}' (expected NAME=VALUE).".format(spec))
+        fields[name] = value or None
+    return fields
 
 
 def input_password() -> str:
@@ -241,11 +426,29 @@ def add(args: Optional[List[str]]) -> argparse.ArgumentParser:
         "pwspec",
         nargs="?",
         action=PasswordAction,
-        help="password spec: N octets or ':' for prompt",
+        help="password spec: N octets, policy NAME[:LENGTH], or ':' for prompt",
+    )
+    parser.add_argument(
+        "--expires",
+        metavar="WHEN",
+        help="password expiration: ISO-8601 date or duration (e.g. '90d')",
+    )
+    parser.add_argument(
+        "--field",
+        action="append",
+        metavar="NAME=VALUE",
+        help="structured entry field (e.g. 'user=deploy'), may be repeated",
+    )
+    parser.add_argument(
+        "--tag", action="append", default=[], help="entry tag, may be repeated"
     )
     if args is None:
         return parser
     argsns = parser.parse_args(args)
+    expires = None
+    if argsns.expires:
+        expires = retrieve_date(argsns.expires).isoformat() + "Z"
+    fields = {k: v for k, v in retrieve_fields(argsns.field).items() if v}
 
     keyid = get_keyid()
     db = open_db(keyid, create=True)
@@ -254,11 +457,11 @@ def add(args: Optional[List[str]]) -> argparse.ArgumentParser:
     if context in db:
         error(2, "Context '{}' already exists.".format(context))
 
-    password = retrieve_password(argsns.pwspec)
+    password = retrieve_password(argsns.pwspec, context)
 
     try:
-        db.add(context, password)
-        db.save()
+        db.add(context, password, expires, fields=fields, tags=argsns.tag)
+        save_db(db)
     except DatabaseError as e:
         error(10, "Impass database error: {}".format(e.msg))
     log("New entry writen.")
@@ -269,7 +472,8 @@ def replace(args: Optional[List[str]]) -> argparse.ArgumentParser:
     """Replace password for entry.
 
     If the context does not already exist in the database an error
-    will be thrown.
+    will be thrown. To change tags or fields without replacing the
+    password, see annotate.
 
     """
     parser = argparse.ArgumentParser(
@@ -284,11 +488,32 @@ def replace(args: Optional[List[str]]) -> argparse.ArgumentParser:
         "pwspec",
         nargs="?",
         action=PasswordAction,
-        help="password spec: N octets or ':' for prompt",
+        help="password spec: N octets, policy NAME[:LENGTH], or ':' for prompt",
+    )
+    parser.add_argument(
+        "--expires",
+        metavar="WHEN",
+        help="password expiration: ISO-8601 date or duration (e.g. '90d')",
+    )
+    parser.add_argument(
+        "--field",
+        action="append",
+        metavar="NAME=VALUE",
+        help="set entry field, or remove it if VALUE is empty; may be repeated",
+    )
+    parser.add_argument(
+        "--tag", action="append", default=[], help="add entry tag, may be repeated"
+    )
+    parser.add_argument(
+        "--untag", action="append", default=[], help="remove entry tag"
     )
     if args is None:
         return parser
     argsns = parser.parse_args(args)
+    expires = None
+    if argsns.expires:
+        expires = retrieve_date(argsns.expires).isoformat() + "Z"
+    fields = retrieve_fields(argsns.field)
 
     keyid = get_keyid()
     db = open_db(keyid)
@@ -297,17 +522,94 @@ def replace(args: Optional[List[str]]) -> argparse.ArgumentParser:
     if context not in db:
         error(2, "Context '{}' not found.".format(context))
 
-    password = retrieve_password(argsns.pwspec)
+    password = retrieve_password(argsns.pwspec, context)
+    tags = None
+    if argsns.tag or argsns.untag:
+        tags = (db.entry(context).tags | set(argsns.tag)) - set(argsns.untag)
 
     try:
-        db.replace(context, password)
-        db.save()
+        db.replace(context, password, expires, fields=fields, tags=tags)
+        save_db(db)
     except DatabaseError as e:
         error(10, "Impass database error: {}".format(e.msg))
     log("Password replaced.")
     return parser
 
 
+def rotate(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Replace passwords for many entries at once.
+
+    Entries are selected by substring match on their context, by the
+    date of their current password, or both. New passwords are
+    generated for all selected entries in one batch and the database
+    is saved once. A json report of the rotated entries is written to
+    stdout (passwords are included only if IMPASS_DUMP_PASSWORDS is
+    set).
+
+    """
+    parser = argparse.ArgumentParser(prog=PROG + " rotate", description=rotate.__doc__)
+    parser.add_argument("string", nargs="?", help="substring match for contexts")
+    parser.add_argument(
+        "--older-than",
+        metavar="WHEN",
+        help="only rotate passwords set before an ISO-8601 date or duration ago",
+    )
+    parser.add_argument(
+        "--octets",
+        type=int,
+        metavar="N",
+        help="octets of entropy per new password (default: IMPASS_PASSWORD)",
+    )
+    parser.add_argument(
+        "--policy",
+        metavar="SPEC",
+        help="password policy NAME[:LENGTH] for the new passwords",
+    )
+    if args is None:
+        return parser
+    argsns = parser.parse_args(args)
+    if not argsns.string and not argsns.older_than:
+        error(1, "A context string or --older-than date must be specified.")
+
+    if argsns.policy and argsns.octets is not None:
+        error(1, "Only one of --octets and --policy may be specified.")
+    pwspec = argsns.policy
+    if argsns.octets is not None:
+        pwspec = str(argsns.octets)
+    elif not pwspec and os.getenv("IMPASS_PASSWORD") not in [None, "", "prompt", ":"]:
+        pwspec = os.getenv("IMPASS_PASSWORD")
+    policies = get_policies()
+
+    keyid = get_keyid()
+    db = open_db(keyid)
+
+    try:
+        if argsns.older_than:
+            cutoff = retrieve_date(argsns.older_than, past=True)
+            contexts = db.date_range("date", end=cutoff)
+            if argsns.string:
+                contexts = [c for c in contexts if argsns.string in c]
+        else:
+            with TIMINGS.timed("search"):
+                contexts = list(db.search(argsns.string))
+        passwords = policies.generate(contexts, pwspec)
+        rotated = db.rotate(contexts, passwords=passwords)
+        if rotated:
+            save_db(db)
+    except DatabaseError as e:
+        error(10, "Impass database error: {}".format(e.msg))
+    except PolicyError as e:
+        error(1, "Password policy error: {}".format(e))
+    output: Dict[str, Dict[str, str]] = {}
+    for context, entry in rotated.items():
+        output[context] = {"date": entry["date"]}
+        if os.getenv("IMPASS_DUMP_PASSWORDS"):
+            output[context]["password"] = entry["password"]
+    print(json.dumps(output, sort_keys=True, indent=2))
+    log("{} password(s) rotated.".format(len(rotated)))
+    return parser
+
+
 def update(args: Optional[List[str]]) -> argparse.ArgumentParser:
     """Update context for existing entry, keeping password the same.
 
@@ -343,40 +645,496 @@ def update(args: Optional[List[str]]) -> argparse.ArgumentParser:
 
     try:
         db.update(old_context, new_context)
-        db.save()
+        save_db(db)
     except DatabaseError as e:
         error(10, "Impass database error: {}".format(e.msg))
     log("Entry updated.")
     return parser
 
 
+def annotate(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Change tags and fields of entry, keeping password the same.
+
+    The password and its dates are kept as they are, and a separately
+    encrypted password (see convert) is not decrypted.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog=PROG + " annotate", description=annotate.__doc__
+    )
+    parser.add_argument(
+        "context",
+        nargs="?",
+        help="existing database context, ':' for prompt, or '-' for stdin",
+    )
+    parser.add_argument(
+        "--field",
+        action="append",
+        metavar="NAME=VALUE",
+        help="set entry field, or remove it if VALUE is empty; may be repeated",
+    )
+    parser.add_argument(
+        "--tag", action="append", default=[], help="add entry tag, may be repeated"
+    )
+    parser.add_argument(
+        "--untag", action="append", default=[], help="remove entry tag"
+    )
+    if args is None:
+        return parser
+    argsns = parser.parse_args(args)
+    fields = retrieve_fields(argsns.field)
+    if not fields and not argsns.tag and not argsns.untag:
+        error(1, "No tags or fields specified.")
+
+    keyid = get_keyid()
+    db = open_db(keyid)
+
+    context = retrieve_context(argsns.context, db=db)
+    if context not in db:
+        error(2, "Context '{}' not found.".format(context))
+
+    tags = None
+    if argsns.tag or argsns.untag:
+        tags = (db.entry(context).tags | set(argsns.tag)) - set(argsns.untag)
+
+    try:
+        db.annotate(context, fields=fields, tags=tags)
+        save_db(db)
+    except DatabaseError as e:
+        error(10, "Impass database error: {}".format(e.msg))
+    log("Entry annotated.")
+    return parser
+
+
 def dump(args: Optional[List[str]]) -> argparse.ArgumentParser:
     """Dump password database to stdout as json.
 
     If a string is provide only entries whose context contains the
-    string will be dumped. Otherwise all entries are returned.
-    Passwords will not be displayed unless IMPASS_DUMP_PASSWORDS is
-    set.
+    string will be dumped. Otherwise all entries are returned. Entries
+    can also be selected by tag and field value, which is done with an
+    index rather than by searching (the index is stored in version 2
+    and 3 databases, see convert). Passwords will not be displayed
+    unless IMPASS_DUMP_PASSWORDS is set.
 
     """
     parser = argparse.ArgumentParser(prog=PROG + " dump", description=dump.__doc__)
     parser.add_argument("string", nargs="?", help="substring match for contexts")
+    parser.add_argument(
+        "--tag", action="append", default=[], help="only entries with tag"
+    )
+    parser.add_argument(
+        "--field",
+        action="append",
+        metavar="NAME=VALUE",
+        help="only entries with field value",
+    )
     if args is None:
         return parser
     argsns = parser.parse_args(args)
+    fields = {k: v or "" for k, v in retrieve_fields(argsns.field).items()}
     keyid = get_keyid()
     db = open_db(keyid)
-    results = db.search(argsns.string)
-    output: Dict[str, Dict[str, str]] = {}
+    with TIMINGS.timed("search"):
+        results = db.search(argsns.string, tags=argsns.tag, fields=fields)
+    output: Dict[str, Dict[str, Any]] = {}
     for context in results:
+        entry = results.entry(context)
         output[context] = {}
-        output[context]["date"] = results[context]["date"]
+        output[context]["date"] = entry["date"]
+        if "expires" in entry:
+            output[context]["expires"] = entry["expires"]
+        if entry.fields:
+            output[context]["fields"] = entry.fields
+        if entry.tags:
+            output[context]["tags"] = sorted(entry.tags)
+        if isinstance(db, DatabaseSet):
+            output[context]["source"] = db.source(context)
         if os.getenv("IMPASS_DUMP_PASSWORDS"):
-            output[context]["password"] = results[context]["password"]
+            output[context]["password"] = entry["password"]
     print(json.dumps(output, sort_keys=True, indent=2))
     return parser
 
 
+def expiring(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """List entries with expiring or old passwords as json.
+
+    Entries whose password expires within the given duration (already
+    expired passwords included), or whose password was set more than
+    the given age ago, are listed in date order. With no options,
+    entries with expired passwords are listed. Passwords are never
+    included. Dates are looked up in an index, which version 2 and 3
+    databases store (see convert) rather than rebuild on every run.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog=PROG + " expiring", description=expiring.__doc__
+    )
+    parser.add_argument(
+        "--within",
+        metavar="DURATION",
+        help="passwords expiring within DURATION (e.g. '30d')",
+    )
+    parser.add_argument(
+        "--older-than",
+        metavar="DURATION",
+        help="passwords set more than DURATION ago (e.g. '1y')",
+    )
+    if args is None:
+        return parser
+    argsns = parser.parse_args(args)
+    if not argsns.within and not argsns.older_than:
+        argsns.within = "0d"
+    keyid = get_keyid()
+    db = open_db(keyid)
+    contexts: List[str] = []
+    if argsns.within:
+        contexts += db.date_range("expires", end=retrieve_date(argsns.within))
+    if argsns.older_than:
+        cutoff = retrieve_date(argsns.older_than, past=True)
+        contexts += db.date_range("date", end=cutoff)
+    output: Dict[str, Dict[str, str]] = {}
+    for context in contexts:
+        entry = db.entry(context)
+        output[context] = {"date": entry["date"]}
+        if "expires" in entry:
+            output[context]["expires"] = entry["expires"]
+    print(json.dumps(output, indent=2))
+    return parser
+
+
+def audit(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Audit passwords for reuse and known breaches as json.
+
+    Lists groups of entries that share a password, and, if a breach
+    corpus is given, entries whose password appears in it with the
+    number of times it was seen. The corpus is a local file of sorted
+    upper-case SHA-1 password hashes, one per line, optionally
+    followed by ':COUNT' (as published by Have I Been Pwned). It is
+    searched in place without being read as a whole, and nothing is
+    sent over the network. --build-index writes a prefix index next to
+    the corpus (FILE.idx) that speeds up later audits. Passwords are
+    never included.
+
+    """
+    parser = argparse.ArgumentParser(prog=PROG + " audit", description=audit.__doc__)
+    parser.add_argument(
+        "--breaches", metavar="FILE", help="sorted SHA-1 breach corpus file"
+    )
+    parser.add_argument(
+        "--build-index",
+        action="store_true",
+        help="write a prefix index for the breach corpus first",
+    )
+    parser.add_argument("string", nargs="?", help="substring match for contexts")
+    if args is None:
+        return parser
+    argsns = parser.parse_args(args)
+    if argsns.build_index and not argsns.breaches:
+        error(1, "--build-index requires --breaches.")
+
+    keyid = get_keyid()
+    db = open_db(keyid)
+    corpus = None
+    try:
+        if argsns.breaches:
+            corpus = BreachCorpus(argsns.breaches)
+            if argsns.build_index:
+                corpus.build_index()
+        with TIMINGS.timed("search"):
+            contexts = db.search(argsns.string)
+        report = do_audit(db, corpus, contexts)
+    except CryptoError as e:
+        error(20, "Decryption error: {}".format(e))
+    except DatabaseError as e:
+        error(10, "Impass database error: {}".format(e.msg))
+    except OSError as e:
+        error(10, "Impass audit error: {}".format(e))
+    finally:
+        if corpus is not None:
+            corpus.close()
+    print(json.dumps(report.to_dict(), indent=2))
+    log("Audit: {}.".format(report))
+    return parser
+
+
+def sync(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Synchronize database with a remote copy.
+
+    Entries changed since the last sync with the remote are merged in
+    both directions. If an entry was changed on both sides, the one
+    with the newer date wins. The remote is only read if it changed
+    since the last sync, and only written if there are local changes
+    to send. Remote entries are only merged if the remote file carries
+    a valid signature. The remote is a directory holding the remote
+    'db' file (or 'dir:PATH'). Sync state is kept in an encrypted file next to
+    the database (IMPASS_DB + '.sync').
+
+    """
+    parser = argparse.ArgumentParser(prog=PROG + " sync", description=sync.__doc__)
+    parser.add_argument("remote", help="remote to synchronize with")
+    if args is None:
+        return parser
+    argsns = parser.parse_args(args)
+
+    keyid = get_keyid()
+    db = open_db(keyid, create=True)
+    if isinstance(db, DatabaseSet):
+        error(1, "Sync of database directories is not supported.")
+    remote = get_remote(argsns.remote)
+    try:
+        result = do_sync(db, remote, keyid)
+    except CryptoError as e:
+        error(20, "Decryption error: {}".format(e))
+    except DatabaseError as e:
+        error(10, "Impass database error: {}".format(e.msg))
+    except OSError as e:
+        error(10, "Impass sync error: {}".format(e))
+    if result.unsigned:
+        log("WARNING: the remote database is not signed.")
+    for context in result.conflicts:
+        log("Conflicting changes for '{}' (newer kept).".format(context))
+    log("Synchronized with {}: {}.".format(remote, result))
+    return parser
+
+
+def convert(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Convert database to another file format version.
+
+    Version 1 stores entries as JSON. Version 2 is a compact binary
+    encoding that is smaller and faster to load, for large databases,
+    and stores the date, tag and field indices used by 'expiring',
+    'rotate' and 'dump'.
+    Version 3 encrypts each password separately from an index of the
+    contexts, so that passwords are only decrypted when they are
+    retrieved; the number of entries and the length of each password
+    are not hidden. All versions hold the same data,
+    and databases can be converted back and forth without loss.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog=PROG + " convert", description=convert.__doc__
+    )
+    parser.add_argument(
+        "version", type=int, choices=DATABASE_VERSIONS, help="format version"
+    )
+    if args is None:
+        return parser
+    argsns = parser.parse_args(args)
+
+    keyid = get_keyid()
+    db = open_db(keyid)
+    try:
+        db.save(version=argsns.version)
+    except DatabaseError as e:
+        error(10, "Impass database error: {}".format(e.msg))
+    log("Database converted to version {}.".format(argsns.version))
+    return parser
+
+
+def snapshot_history(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """List previous states of the database as json.
+
+    Each save keeps the state it replaced in a snapshot history next
+    to the database (IMPASS_DB + '.snapshots'), as the entries changed
+    by the save, encrypted to the same keys, so that a snapshot only
+    costs the size of the changes. The last IMPASS_SNAPSHOTS states
+    are kept. States are listed newest first, with the date they were
+    saved and their number for restore. Nothing is decrypted.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog=PROG + " history", description=snapshot_history.__doc__
+    )
+    if args is None:
+        return parser
+    parser.parse_args(args)
+
+    db = open_db()
+    if isinstance(db, DatabaseSet):
+        error(1, "History of database directories is not supported.")
+    try:
+        dates = db.history()
+    except DatabaseError as e:
+        error(10, "Impass database error: {}".format(e.msg))
+    output = [{"at": n, "date": d.isoformat() + "Z"} for n, d in enumerate(dates, 1)]
+    print(json.dumps(output, indent=2))
+    return parser
+
+
+def restore(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Restore entries from a previous state of the database.
+
+    The state is given by its number in the history (1 for the state
+    before the last save), or by an ISO-8601 date or duration ago for
+    the newest state saved at or before then. Only the given entries
+    are restored, or else the whole database, removing entries added
+    since. The state is rebuilt by undoing the saves since, so only
+    their snapshots are decrypted. Restoring is itself a save, which
+    can be undone in turn.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog=PROG + " restore", description=restore.__doc__
+    )
+    parser.add_argument(
+        "--at", required=True, metavar="STATE", help="state number, date or duration"
+    )
+    parser.add_argument("context", nargs="*", help="contexts to restore")
+    if args is None:
+        return parser
+    argsns = parser.parse_args(args)
+
+    keyid = get_keyid()
+    db = open_db(keyid)
+    if isinstance(db, DatabaseSet):
+        error(1, "Restore of database directories is not supported.")
+    try:
+        if argsns.at.isdigit():
+            n = int(argsns.at)
+        else:
+            when = retrieve_date(argsns.at, past=True)
+            dates = db.history()
+            for n, date in enumerate(dates, 1):
+                if date <= when:
+                    break
+            else:
+                error(2, "No snapshot at or before {}.".format(argsns.at))
+        changed = db.restore(n, argsns.context or None)
+        if changed:
+            save_db(db)
+    except DatabaseError as e:
+        error(10, "Impass database error: {}".format(e.msg))
+    log("{} entries restored from snapshot {}.".format(len(changed), n))
+    return parser
+
+
+def rekey(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Re-encrypt the database for a new OpenPGP key.
+
+    The database is encrypted to and signed by the new key, together
+    with its snapshot history, sync state, any '.bak' file left by
+    older versions and the context history (IMPASS_HISTORY); for a
+    database directory, all of its files are rekeyed in parallel
+    processes. Entries are not loaded: each file is decrypted and
+    re-encrypted as it is, and replaced only once the result was
+    checked by decrypting it. The key ID file (IMPASS_KEYFILE) is updated
+    unless IMPASS_KEYID is set.
+
+    """
+    parser = argparse.ArgumentParser(prog=PROG + " rekey", description=rekey.__doc__)
+    parser.add_argument(
+        "--to", required=True, metavar="KEYID", help="OpenPGP key ID of the new key"
+    )
+    if args is None:
+        return parser
+    argsns = parser.parse_args(args)
+
+    db_path = os.getenv("IMPASS_DB", os.path.join(IMPASS_DIR, "db"))
+    if os.path.isdir(db_path):
+        paths = sorted(
+            os.path.join(db_path, f)
+            for f in os.listdir(db_path)
+            if f.endswith(DBSET_SUFFIX) and not f.startswith(".")
+        )
+    elif os.path.exists(db_path):
+        paths = [db_path]
+    else:
+        error(5, "Impass database does not exist.")
+    if os.path.exists(os.getenv("IMPASS_RECIPIENTS", db_path + ".recipients")):
+        error(1, "The database has a recipient set; change the recipient set instead.")
+    try:
+        get_backend().resolve_key(argsns.to)
+    except CryptoError as e:
+        error(20, "Crypto error for key ID {}: {}".format(argsns.to, e))
+
+    start = time.perf_counter()
+    try:
+        results = do_rekey(paths, argsns.to, os.getenv("IMPASS_CRYPTO") or None)
+    except CryptoError as e:
+        error(20, "Crypto error: {}".format(e))
+    except DatabaseError as e:
+        error(10, "Impass database error: {}".format(e.msg))
+    # the context history is encrypted for the database key too
+    history = open_history()
+    try:
+        history_rekeyed = history is not None and history.rekey(argsns.to)
+    except CryptoError as e:
+        error(20, "Crypto error: {}".format(e))
+    except DatabaseError as e:
+        error(10, "Impass history error: {}".format(e.msg))
+    elapsed = time.perf_counter() - start
+    for result in results:
+        log("Rekeyed {}.".format(result))
+    if history_rekeyed:
+        log("Context history rekeyed.")
+    size = sum(r.size for r in results)
+    log(
+        "{} file(s) rekeyed, {} bytes in {:.3f}s ({}).".format(
+            len(results), size, elapsed, throughput(size, elapsed)
+        )
+    )
+    keyfile = os.getenv("IMPASS_KEYFILE", os.path.join(IMPASS_DIR, "keyid"))
+    if not os.getenv("IMPASS_KEYID") and os.path.exists(keyfile):
+        with open(keyfile, "w") as f:
+            f.write(argsns.to)
+        log("Key ID file updated.")
+    else:
+        log("Set IMPASS_KEYID to the new key ID.")
+    return parser
+
+
+def stats(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Show database size metrics and impass latencies as json.
+
+    Reports the number of entries, the size of the database cleartext
+    and files, and the distributions of context lengths and of
+    password ages (in days). Passwords are not decrypted. Also reports
+    the count, mean and quantiles (in seconds) of the wall time of
+    impass operations (open, search, save and emit) and commands, from
+    the histograms kept in IMPASS_STATS. With --prometheus the metrics
+    are written instead to a file in the Prometheus text format, for
+    the node exporter textfile collector (e.g. from a cron job).
+
+    """
+    parser = argparse.ArgumentParser(prog=PROG + " stats", description=stats.__doc__)
+    parser.add_argument(
+        "--prometheus",
+        metavar="FILE",
+        help="write metrics in Prometheus text format to FILE ('-' for stdout)",
+    )
+    parser.add_argument(
+        "--latency-only",
+        action="store_true",
+        help="only report latencies (the database is not opened)",
+    )
+    if args is None:
+        return parser
+    argsns = parser.parse_args(args)
+
+    dbstats = None
+    if not argsns.latency_only:
+        keyid = get_keyid()
+        db = open_db(keyid)
+        dbstats = database_stats(db)
+    try:
+        histograms = TIMINGS.load()
+    except DatabaseError as e:
+        error(10, "Impass stats error: {}".format(e.msg))
+    if argsns.prometheus == "-":
+        print(prometheus(dbstats, histograms), end="")
+    elif argsns.prometheus:
+        try:
+            write_prometheus(argsns.prometheus, prometheus(dbstats, histograms))
+        except OSError as e:
+            error(10, "Impass stats error: {}".format(e))
+    else:
+        output: Dict[str, Any] = {"latency": timing_stats(histograms)}
+        if dbstats is not None:
+            output["database"] = dbstats
+        print(json.dumps(output, sort_keys=True, indent=2))
+    return parser
+
+
 def gui(
     args: Optional[List[str]], method: Optional[str] = os.getenv("IMPASS_XPASTE", None)
 ) -> argparse.ArgumentParser:
@@ -388,7 +1146,10 @@ def gui(
     search prompt will be presented. If an additional string is
     provided, it will be added as the initial search string. All
     matching results for the query will be presented to the user.
-    When a result is selected, the password will be retrieved
+    Without a string, contexts that contain the hostname found in the
+    title of the target window (or one of its parent domains) are
+    offered first, and the best one is pre-selected (see
+    IMPASS_PRESEED). When a result is selected, the password will be retrieved
     according to the method specified by IMPASS_XPASTE. If no match
     is found, the user has the opportunity to generate and store a new
     password, which is then delivered via IMPASS_XPASTE.
@@ -404,6 +1165,12 @@ def gui(
     argsns = parser.parse_args(args)
     from .gui import Gui
 
+    preseed_mode = os.getenv("IMPASS_PRESEED", "select")
+    if preseed_mode not in ["off", "select", "emit"]:
+        error(1, "Unknown IMPASS_PRESEED mode '{}'.".format(preseed_mode))
+    # title of the target window, for guessing the context
+    title: Optional[str] = None
+
     if method is None:
         if os.getenv("SWAYSOCK", None) is not None:
             method = "sway"
@@ -423,6 +1190,12 @@ def gui(
         x = xdo.xdo()
         # get the id of the currently focused window
         win = x.get_focused_window()
+        try:
+            name = x.get_window_name(win)
+            title = name.decode("utf-8", "replace") if isinstance(name, bytes) else name
+        except Exception:
+            # not all xdo bindings can report window names
+            pass
     elif method == "xclip":
         pass
     elif method == "sway":
@@ -442,34 +1215,61 @@ def gui(
         if _swaymark not in con_info.marks:
             error(1, "The focused window was not marked")
         criteria = f"con_mark={_swaymark} con_id={con_info.id} pid={con_info.pid}"
+        title = " ".join(filter(None, [con_info.name, con_info.app_id]))
     else:
         error(1, "Unknown X paste method '{}'.".format(method))
     keyid = get_keyid()
     db = open_db(keyid)
-    result = Gui(db, query=argsns.string).return_value()
+    history = open_history(keyid)
+    preseed = None
+    preseed_emit = False
+    if not argsns.string and title and preseed_mode != "off":
+        index = HostIndex(db)
+        preseed = index.lookup_text(title)
+        if preseed_mode == "emit":
+            # window titles are controlled by the application, so only
+            # emit without asking for a context of exactly the host
+            exact = index.lookup_text(title, exact=True)
+            if len(exact) == 1:
+                preseed = exact
+                preseed_emit = True
+    g = Gui(
+        db,
+        query=argsns.string,
+        history=history,
+        preseed=preseed,
+        preseed_emit=preseed_emit,
+        policies=get_policies(),
+    )
+    result = g.return_value()
     # type the password in the saved window
     if result:
-        if method == "xdo":
-            x.focus_window(win)
-            x.wait_for_window_focus(win)
-            x.type(result["password"])
-        elif method == "xclip":
-            xclip(result["password"])
-        elif method == "sway":
-            # pick the right element
-            i3conn.command(f"[{criteria}] focus")
-            proc = subprocess.Popen(
-                ["wtype", "-"],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            (stdout, stderr) = proc.communicate(result["password"].encode())
-            i3conn.command(f"[{criteria}] unmark")
-            if proc.returncode:
-                error(1, "failed to run wtype to inject keystrokes")
-        else:
-            error(1, f"Unknown X paste method '{method}'.")
+        with TIMINGS.timed("emit"):
+            if method == "xdo":
+                x.focus_window(win)
+                x.wait_for_window_focus(win)
+                x.type(result["password"])
+            elif method == "xclip":
+                xclip(result["password"])
+            elif method == "sway":
+                # pick the right element
+                i3conn.command(f"[{criteria}] focus")
+                proc = subprocess.Popen(
+                    ["wtype", "-"],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+                (stdout, stderr) = proc.communicate(result["password"].encode())
+                i3conn.command(f"[{criteria}] unmark")
+                if proc.returncode:
+                    error(1, "failed to run wtype to inject keystrokes")
+            else:
+                error(1, f"Unknown X paste method '{method}'.")
+        # saving the history encrypts it, so only once the password
+        # is delivered
+        if g.selected_context is not None:
+            record_history(history, g.selected_context)
     else:
         if method == "sway":
             i3conn.command(f"[{criteria}] unmark")
@@ -511,13 +1311,148 @@ def remove(args: Optional[List[str]]) -> argparse.ArgumentParser:
 
     try:
         db.remove(context)
-        db.save()
+        save_db(db)
     except DatabaseError as e:
         error(10, "Impass database error: {}".format(e.msg))
     log("Entry removed.")
     return parser
 
 
+def native_host(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Serve password lookups to a browser extension.
+
+    Speaks the WebExtension native messaging protocol on stdin and
+    stdout, for browser autofill. The database is decrypted once and
+    the host keeps running until the browser closes the connection,
+    answering lookups of many URLs at once from an index of the
+    hostnames in contexts, and password requests for contexts. The
+    path in the browser's native messaging manifest should be a
+    script running 'impass native-host "$@"'. Arguments passed by the
+    browser (such as the extension origin) are ignored. The database
+    is never modified.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog=PROG + " native-host", description=native_host.__doc__
+    )
+    parser.add_argument("origin", nargs="*", help="ignored (passed by the browser)")
+    if args is None:
+        return parser
+    parser.parse_args(args)
+
+    # no key ID prompt: stdin belongs to the browser, and the host
+    # never saves
+    db = open_db()
+    host = NativeHost(db)
+    try:
+        host.serve(sys.stdin.buffer, sys.stdout.buffer)
+    except ProtocolError as e:
+        error(1, "Native messaging error: {}".format(e))
+    except BrokenPipeError:
+        pass
+    finally:
+        host.close()
+    return parser
+
+
+SHELL_COMMANDS = ["commit", "exit", "quit"]
+
+
+def shell(args: Optional[List[str]]) -> argparse.ArgumentParser:
+    """Run commands interactively on a database opened once.
+
+    The database is decrypted once for the whole session, and the
+    other commands can be entered as in the command line (without
+    'impass'), with tab completion of commands and contexts. Changes
+    are only written by 'commit', or when the session ends with 'exit'
+    or end of input, so that the database is encrypted once. Commands
+    that write the database files themselves (convert, rekey, sync)
+    are not available. The time taken by each command is shown.
+
+    """
+    global SESSION
+    parser = argparse.ArgumentParser(prog=PROG + " shell", description=shell.__doc__)
+    if args is None:
+        return parser
+    parser.parse_args(args)
+
+    SESSION = Session(get_keyid())
+    start = time.monotonic()
+    db = open_db(SESSION.keyid, create=True)
+    log(
+        "Database opened, {} entries. ({:.3f}s)".format(
+            len(db), time.monotonic() - start
+        )
+    )
+    interactive = sys.stdin.isatty()
+
+    def commit() -> bool:
+        if not db.modified:
+            return True
+        start = time.monotonic()
+        try:
+            warn_recipient_drift(db)
+            db.save()
+        except CryptoError as e:
+            log("Encryption error: {}".format(e))
+            return False
+        except DatabaseError as e:
+            log("Impass database error: {}".format(e.msg))
+            return False
+        log("Changes saved. ({:.3f}s)".format(time.monotonic() - start))
+        return True
+
+    while True:
+        # commands may have prompted with other completions
+        set_completions(list(CMDS) + SHELL_COMMANDS + sorted(db))
+        prompt = PROG + ("*> " if db.modified else "> ")
+        try:
+            line = input(prompt if interactive else "")
+        except KeyboardInterrupt:
+            print()
+            continue
+        except EOFError:
+            if interactive:
+                print()
+            break
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            log("Parse error: {}".format(e))
+            continue
+        if not words:
+            continue
+        cmd, cmdargs = ALIAS.get(words[0], words[0]), words[1:]
+        if cmd in ("exit", "quit"):
+            break
+        if cmd == "commit":
+            commit()
+            continue
+        if cmd not in CMDS:
+            log("Unknown command: {}".format(cmd))
+            continue
+        # interactive themselves, or writing the database files
+        # directly rather than on commit
+        if cmd in ("shell", "gui", "native-host", "rekey", "convert", "sync"):
+            log("Command not available in the shell: {}".format(cmd))
+            continue
+        start = time.monotonic()
+        try:
+            CMDS[cmd](cmdargs)
+        except SystemExit as e:
+            if e.code:
+                log("({} failed with code {})".format(cmd, e.code))
+        except KeyboardInterrupt:
+            if interactive:
+                print()
+            log("({} interrupted)".format(cmd))
+        log("({:.3f}s)".format(time.monotonic() - start))
+    SESSION = None
+    if not commit():
+        error(10, "Changes not saved.")
+    return parser
+
+
 def print_help(args: Optional[List[str]]) -> argparse.ArgumentParser:
     """Full usage or command help (also '-h' after command)."""
     parser = argparse.ArgumentParser(
@@ -590,6 +1525,25 @@ DESCRIPTION
   base64 encoding. If pwspec is ':' the user will be prompted for the
   password.
 
+  The pwspec may also name a password policy, as NAME or NAME:LENGTH
+  for another length. The built-in policies are 'base64' (octets of
+  entropy, as above), 'alnum' (20 letters and digits), 'ascii' (20
+  letters, digits and punctuation), 'pin' (6 digits) and 'diceware' (6
+  words from a word list, see IMPASS_WORDLIST). More policies, and
+  rules choosing the policy by context, can be defined in a policy
+  file (see IMPASS_POLICIES):
+
+      policy  work   chars length=16 classes=lower,upper,digits,symbols
+      policy  words  diceware length=5 separator=.
+      site    *.bank.example.com  pin
+      default words
+
+  Policies are of kind 'base64', 'chars' (option 'classes', a comma
+  separated list of lower, upper, digits and symbols) or 'diceware'
+  (options 'words', the word list, and 'separator'). Site rules match
+  contexts by glob pattern; the first matching rule applies, unless a
+  pwspec is given.
+
 COMMANDS
 
 {format_commands(man=True)}
@@ -601,7 +1555,12 @@ SIGNATURES
 
 ENVIRONMENT
     IMPASS_DB  
-        Path to impass database file. Default: ~/.impass/db
+        Path to impass database file. If this is a directory, all
+        files in it ending in '.db' are opened together (decrypted in
+        parallel) and presented as a single database; dump then shows
+        the source file of each entry, changes are written back to the
+        file holding the entry, and new entries are added to the first
+        file. Default: ~/.impass/db
 
     IMPASS_KEYFILE  
         File containing OpenPGP key ID of database encryption
@@ -617,6 +1576,60 @@ ENVIRONMENT
     IMPASS_DUMP_PASSWORDS  
         Include passwords in dump when set.
 
+    IMPASS_PRESEED  
+        How the GUI uses contexts guessed from the hostname in the
+        target window title. Contexts match a hostname if they are
+        for that host or one of its parent domains, but never for
+        sibling hosts or public suffixes (see {PUBLIC_SUFFIX_LIST}).
+        Options are: 'off'; 'select', which offers matching contexts
+        first and pre-selects the best one; and 'emit', which is like
+        'select' but emits the password without showing the GUI if
+        exactly one context is for exactly the hostname. Note that
+        window titles are controlled by the application (e.g. by web
+        pages), so 'emit' should be used with care. Default: select
+
+    IMPASS_HISTORY  
+        Path to encrypted context usage history, used to offer the
+        most frequently and recently used contexts first in the GUI
+        and at context prompts. Set to an empty string to disable.
+        Default: ~/.impass/history
+
+    IMPASS_RECIPIENTS  
+        File listing the signer and the recipients the database is
+        encrypted to, for databases shared by a team: one line per
+        key, 'signer KEYID' (at most one; IMPASS_KEYID by default) or
+        'recipient KEYID'. A warning is shown when saving would change
+        the recipients of the database file. Default: IMPASS_DB +
+        '.recipients', if it exists
+
+    IMPASS_POLICIES  
+        Password policy file (see Passwords above).
+        Default: ~/.impass/policies, if it exists
+
+    IMPASS_WORDLIST  
+        Word list of diceware password policies, one word per line
+        (lines may start with dice numbers). Default: {DEFAULT_WORDLIST}
+
+    IMPASS_SNAPSHOTS  
+        Number of previous states of the database kept in its snapshot
+        history (see history), 0 to keep none. Default: {DEFAULT_SNAPSHOTS}
+
+    IMPASS_STATS  
+        Path to the latency histograms of impass operations and
+        commands (see stats), updated by every command. The file holds
+        no contexts or passwords. Set to an empty string to disable.
+        Default: ~/.impass/stats
+
+    IMPASS_CRYPTO  
+        Crypto backend. Options are: 'gpgme', which uses the gpgme
+        Python bindings; 'gpg', which runs the gpg program in batch
+        mode (see IMPASS_GPG); and 'null', which stores files
+        UNENCRYPTED and is only meant for tests and benchmarks.
+        Default: gpgme
+
+    IMPASS_GPG  
+        gpg program used by the 'gpg' crypto backend. Default: gpg
+
     IMPASS_XPASTE  
         Method for password retrieval from GUI. Options are: 'xdo',
         which attempts to type the password into the window that had
@@ -675,10 +1688,22 @@ CMDS: collections.OrderedDict[
     [
         ("add", add),
         ("replace", replace),
+        ("rotate", rotate),
         ("update", update),
+        ("annotate", annotate),
         ("dump", dump),
+        ("expiring", expiring),
+        ("audit", audit),
         ("gui", gui),
         ("remove", remove),
+        ("sync", sync),
+        ("convert", convert),
+        ("history", snapshot_history),
+        ("restore", restore),
+        ("rekey", rekey),
+        ("stats", stats),
+        ("shell", shell),
+        ("native-host", native_host),
         ("help", print_help),
         ("version", version),
     ]
@@ -764,7 +1789,18 @@ def main() -> None:
     cmd = sys.argv[1]
     args = sys.argv[2:]
     func = get_func(cmd)
-    func(args)
+    if func in [print_help, version]:
+        func(args)
+        return
+    TIMINGS.path = get_timings_path()
+    try:
+        with TIMINGS.timed(cmd, "commands"):
+            func(args)
+    finally:
+        try:
+            TIMINGS.save()
+        except (OSError, DatabaseError) as e:
+            log("WARNING: could not update latency stats: {}".format(e))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,219 @@
+import asyncio
+import functools
+import concurrent.futures
+
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    TypeVar,
+)
+
+from .crypto import Backend, RecipientSet
+from .db import DEFAULT_NEW_PASSWORD_OCTETS, Entry
+from .shared import SharedDatabase
+
+############################################################
+
+T = TypeVar("T")
+
+
+class AsyncDatabase:
+    """asyncio interface to an impass database.
+
+    Decryption, encryption and file I/O run in an executor (the
+    loop's default executor unless one is given), so they never block
+    the event loop.  The entries are decrypted once, into a
+    SharedDatabase, which any number of coroutines can use at the same
+    time; lookups and iteration only read the entries in memory, and
+    are not coroutines.  Passwords of split (version 3) databases are
+    only decrypted by password().
+
+    Saves are serialized, and coalesced: a save requested while
+    another one is running waits for it, and then a single save
+    writes the changes of all the waiting callers.  Saves with no
+    changes to write return at once.
+
+    Open databases with AsyncDatabase.open().
+
+    """
+
+    def __init__(
+        self,
+        db: SharedDatabase,
+        executor: Optional[concurrent.futures.Executor] = None,
+    ) -> None:
+        self._db = db
+        self._executor = executor
+        self._save_lock = asyncio.Lock()
+        # number of changes made, and of changes known to be saved
+        self._changes = 0
+        self._saved_changes = 0
+
+    @classmethod
+    async def open(
+        cls,
+        dbpath: Optional[str] = None,
+        keyid: Optional[str] = None,
+        backend: Optional[Backend] = None,
+        recipients: Optional[RecipientSet] = None,
+        executor: Optional[concurrent.futures.Executor] = None,
+    ) -> "AsyncDatabase":
+        """Open the database at dbpath (see Database)."""
+        loop = asyncio.get_running_loop()
+        db = await loop.run_in_executor(
+            executor, SharedDatabase, dbpath, keyid, backend, recipients
+        )
+        return cls(db, executor)
+
+    def __str__(self) -> str:
+        return '<impass.aio.AsyncDatabase "%s">' % (self._db.path)
+
+    def __repr__(self) -> str:
+        return 'impass.aio.AsyncDatabase("%s")' % (self._db.path)
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args)
+        )
+
+    async def _change(self, func: Callable[..., T], *args: Any) -> T:
+        result = await self._run(func, *args)
+        self._changes += 1
+        return result
+
+    @property
+    def db(self) -> SharedDatabase:
+        """The underlying database (its methods block)."""
+        return self._db
+
+    @property
+    def path(self) -> Optional[str]:
+        return self._db.path
+
+    @property
+    def sigvalid(self) -> Optional[bool]:
+        return self._db.sigvalid
+
+    @property
+    def modified(self) -> bool:
+        return self._db.modified
+
+    def __getitem__(self, context: str) -> Dict[str, str]:
+        return self._db[context]
+
+    def entry(self, context: str) -> Entry:
+        return self._db.entry(context)
+
+    def __contains__(self, context: str) -> bool:
+        return context in self._db
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._db)
+
+    def __len__(self) -> int:
+        return len(self._db)
+
+    def snapshot(self) -> Mapping[str, Entry]:
+        """Read-only view of the entries at this point in time."""
+        return self._db.snapshot()
+
+    async def password(self, context: str) -> str:
+        """Password of the entry for context."""
+        return await self._run(lambda: self._db.entry(context)["password"])
+
+    async def search(
+        self,
+        string: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        tags: Iterable[str] = (),
+        fields: Optional[Mapping[str, str]] = None,
+    ) -> List[str]:
+        """Contexts matching a search (see Database.search())."""
+        tags = list(tags)
+
+        def search() -> List[str]:
+            return list(self._db.search(string, offset, limit, tags, fields))
+
+        return await self._run(search)
+
+    async def add(
+        self,
+        context: str,
+        password: Optional[str] = None,
+        expires: Optional[str] = None,
+        fields: Optional[Mapping[str, str]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        return await self._change(
+            self._db.add, context, password, expires, fields, tags
+        )
+
+    async def replace(
+        self,
+        context: str,
+        password: Optional[str] = None,
+        expires: Optional[str] = None,
+        fields: Optional[Mapping[str, Optional[str]]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        return await self._change(
+            self._db.replace, context, password, expires, fields, tags
+        )
+
+    async def annotate(
+        self,
+        context: str,
+        fields: Optional[Mapping[str, Optional[str]]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        return await self._change(self._db.annotate, context, fields, tags)
+
+    async def update(self, old_context: str, new_context: str) -> None:
+        await self._change(self._db.update, old_context, new_context)
+
+    async def rotate(
+        self,
+        contexts: Iterable[str],
+        nbytes: int = DEFAULT_NEW_PASSWORD_OCTETS,
+        passwords: Optional[Mapping[str, str]] = None,
+    ) -> Dict[str, Dict[str, str]]:
+        return await self._change(
+            self._db.rotate, list(contexts), nbytes, passwords
+        )
+
+    async def remove(self, context: str) -> None:
+        await self._change(self._db.remove, context)
+
+    async def restore(
+        self, n: int, contexts: Optional[Iterable[str]] = None
+    ) -> List[str]:
+        return await self._change(self._db.restore, n, contexts)
+
+    async def refresh(self) -> List[str]:
+        """Reload the database if it was saved by someone else."""
+        return await self._run(self._db.refresh)
+
+    async def save(self, keyid: Optional[str] = None) -> None:
+        """Save database to disk (see Database.save()).
+
+        Returns once the changes made before the call are saved,
+        possibly by a save requested by another coroutine.
+
+        """
+        changes = self._changes
+        async with self._save_lock:
+            if changes <= self._saved_changes and (changes or not self._db.modified):
+                # saved meanwhile, or nothing to save
+                return
+            # changes made from here on may or may not be included
+            changes = self._changes
+            await self._run(self._db.save, keyid)
+            self._saved_changes = max(self._saved_changes, changes)
@@ -0,0 +1,202 @@
+import os
+import mmap
+import array
+import struct
+import hashlib
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from .db import Database
+from .dbset import DatabaseSet
+
+############################################################
+
+# SHA-1 hex digest length
+_HASH_LEN = 40
+
+# prefix index: one offset per 4 hex digit prefix, plus the end
+_PREFIX_LEN = 4
+_INDEX_MAGIC = b"impass-breach-index 1\n"
+_INDEX_HEADER = struct.Struct("<Q")
+
+
+def password_hash(password: str) -> str:
+    """Upper-case hex SHA-1 of password, as used in breach corpora."""
+    return hashlib.sha1(password.encode("utf-8")).hexdigest().upper()
+
+
+class BreachCorpus:
+    """Sorted SHA-1 breach corpus file (HIBP-style).
+
+    Each line holds the upper-case hex SHA-1 of a breached password,
+    optionally followed by ":COUNT", and lines are sorted by hash.
+    The file is memory-mapped and searched by bisection, so it is
+    never read as a whole, and lookups only touch a few pages.
+
+    If a prefix index (path + ".idx", see build_index()) matching the
+    corpus exists, it narrows each search to the lines sharing the
+    first four hex digits of the hash.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self._size = os.fstat(f.fileno()).st_size
+            if self._size == 0:
+                self._mm: Optional[mmap.mmap] = None
+            else:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index = self._load_index()
+
+    def __enter__(self) -> "BreachCorpus":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    @property
+    def index_path(self) -> str:
+        return self.path + ".idx"
+
+    @property
+    def indexed(self) -> bool:
+        """Whether lookups use a prefix index."""
+        return self._index is not None
+
+    def _load_index(self) -> Optional[array.array]:
+        try:
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        head = len(_INDEX_MAGIC) + _INDEX_HEADER.size
+        if not data.startswith(_INDEX_MAGIC):
+            return None
+        # an index of an older corpus file is ignored
+        (size,) = _INDEX_HEADER.unpack_from(data, len(_INDEX_MAGIC))
+        offsets = array.array("Q")
+        offsets.frombytes(data[head:])
+        if size != self._size or len(offsets) != 16**_PREFIX_LEN + 1:
+            return None
+        return offsets
+
+    def _bisect(self, key: bytes, lo: int, hi: int) -> int:
+        # offset of the first line in [lo, hi) whose hash is not less
+        # than key (lo and hi are line starts)
+        mm = self._mm
+        assert mm is not None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b"\n", lo, mid) + 1 or lo
+            end = mm.find(b"\n", start, hi)
+            end = hi if end < 0 else end + 1
+            if mm[start : start + len(key)] < key:
+                lo = end
+            else:
+                hi = start
+        return lo
+
+    def _range(self, sha1: bytes) -> Tuple[int, int]:
+        if self._index is None:
+            return 0, self._size
+        p = int(sha1[:_PREFIX_LEN], 16)
+        return self._index[p], self._index[p + 1]
+
+    def count(self, sha1: str) -> int:
+        """Number of times the SHA-1 hex digest was seen (0 if never)."""
+        if self._mm is None:
+            return 0
+        key = sha1.upper().encode("ascii")
+        if len(key) != _HASH_LEN:
+            raise ValueError("Not a SHA-1 hex digest: %r" % sha1)
+        lo, hi = self._range(key)
+        pos = self._bisect(key, lo, hi)
+        end = self._mm.find(b"\n", pos)
+        line = self._mm[pos : len(self._mm) if end < 0 else end].rstrip(b"\r")
+        if line[:_HASH_LEN] != key:
+            return 0
+        _, _, count = line[_HASH_LEN:].partition(b":")
+        try:
+            return max(int(count), 1)
+        except ValueError:
+            return 1
+
+    def build_index(self) -> None:
+        """Write the prefix index for this corpus (path + ".idx").
+
+        The index is built by bisection too, so this does not read
+        the corpus either.
+
+        """
+        offsets = array.array("Q", [0] * (16**_PREFIX_LEN + 1))
+        offsets[-1] = self._size
+        lo = 0
+        for p in range(16**_PREFIX_LEN):
+            if self._mm is not None:
+                key = b"%0*X" % (_PREFIX_LEN, p)
+                lo = self._bisect(key, lo, self._size)
+            offsets[p] = lo
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_INDEX_MAGIC + _INDEX_HEADER.pack(self._size))
+            f.write(offsets.tobytes())
+        os.replace(tmp, self.index_path)
+        self._index = offsets
+
+
+class AuditReport:
+    """Result of a password audit."""
+
+    def __init__(self) -> None:
+        # groups of contexts sharing a password
+        self.reused: List[List[str]] = []
+        # contexts whose password is in the breach corpus, with the
+        # number of times it was seen there
+        self.breached: Dict[str, int] = {}
+
+    def __str__(self) -> str:
+        return "%d reused password(s) in %d entries, %d breached" % (
+            len(self.reused),
+            sum(len(group) for group in self.reused),
+            len(self.breached),
+        )
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"reused": self.reused, "breached": self.breached}
+
+
+def audit(
+    db: Union[Database, DatabaseSet],
+    corpus: Optional[BreachCorpus] = None,
+    contexts: Optional[Iterable[str]] = None,
+) -> AuditReport:
+    """Find reused passwords, and passwords in the breach corpus.
+
+    Each password is retrieved and hashed once; the hashes serve both
+    to group reused passwords and to look them up in the corpus.
+    Entries with empty passwords are skipped.  contexts limits the
+    audit to some entries (all by default).
+
+    """
+    groups: Dict[str, List[str]] = {}
+    for context in sorted(db if contexts is None else contexts):
+        password = db[context]["password"]
+        if password:
+            groups.setdefault(password_hash(password), []).append(context)
+    report = AuditReport()
+    report.reused = sorted(g for g in groups.values() if len(g) > 1)
+    if corpus is not None:
+        # sorted lookups keep the touched pages in order
+        for sha1 in sorted(groups):
+            n = corpus.count(sha1)
+            if n:
+                for context in groups[sha1]:
+                    report.breached[context] = n
+        report.breached = dict(sorted(report.breached.items()))
+    return report
@@ -0,0 +1,431 @@
+import os
+import base64
+import subprocess
+import concurrent.futures
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Type
+
+############################################################
+
+
+class CryptoError(Exception):
+    def __init__(self, msg: str) -> None:
+        self.msg = msg
+
+    def __str__(self) -> str:
+        return self.msg
+
+
+class Backend:
+    """Base class for crypto backends.
+
+    A backend signs and encrypts data, decrypts and verifies it, and
+    resolves key IDs to fingerprints.  Backend errors are raised as
+    CryptoError.
+
+    """
+
+    name = ""
+
+    def __repr__(self) -> str:
+        return "impass.crypto.%s()" % type(self).__name__
+
+    def resolve_key(self, keyid: str) -> str:
+        """Return the fingerprint of the public key keyid."""
+        raise NotImplementedError
+
+    def resolve_keys(self, keyids: Sequence[str]) -> List[str]:
+        """Return the fingerprints of many public keys, in order."""
+        return [self.resolve_key(keyid) for keyid in keyids]
+
+    def key_ids(self, fpr: str) -> Set[str]:
+        """Long key IDs of the key with fingerprint fpr and its subkeys.
+
+        Only keys resolved before are known.
+
+        """
+        return {fpr[-16:].upper()}
+
+    def encrypt(self, data: bytes, recipients: Sequence[str], signer: str) -> bytes:
+        """Sign data with signer and encrypt it to recipients.
+
+        recipients and signer are fingerprints from resolve_key().
+
+        """
+        raise NotImplementedError
+
+    def decrypt(self, encdata: bytes) -> Tuple[bytes, Optional[bool]]:
+        """Decrypt and verify encdata.
+
+        Returns the cleartext and whether it carries a valid signature
+        by a fully trusted key (None if the backend does not sign).
+        Data that cannot be verified is still returned.
+
+        """
+        raise NotImplementedError
+
+
+class GpgmeBackend(Backend):
+    """OpenPGP through the gpgme Python bindings (the default)."""
+
+    name = "gpgme"
+
+    def __init__(self) -> None:
+        # imported here, so that the other backends work without the
+        # bindings installed
+        try:
+            import gpg  # type: ignore
+        except ImportError as e:
+            raise CryptoError("gpgme Python bindings not available: {}".format(e))
+        self._gpgmod = gpg
+        self._gpg = gpg.Context()
+        self._gpg.armor = True
+        # keys by fingerprint, so that they are only looked up once
+        self._keys: Dict[str, Any] = {}
+
+    def _get_key(self, keyid: str, ctx: Any = None) -> Any:
+        if keyid in self._keys:
+            return self._keys[keyid]
+        try:
+            key = (ctx or self._gpg).get_key(keyid, secret=False)
+        except self._gpgmod.errors.GPGMEError as e:
+            raise CryptoError(str(e))
+        return key
+
+    def resolve_key(self, keyid: str) -> str:
+        if not keyid:
+            raise CryptoError("No key ID specified.")
+        key = self._get_key(keyid)
+        self._keys[key.fpr] = key
+        return str(key.fpr)
+
+    def resolve_keys(self, keyids: Sequence[str]) -> List[str]:
+        if not all(keyids):
+            raise CryptoError("No key ID specified.")
+        # key listings wait on gpg, so look keys up in parallel, each
+        # with its own context (contexts are not thread-safe)
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            keys = list(
+                pool.map(lambda k: self._get_key(k, self._gpgmod.Context()), keyids)
+            )
+        for key in keys:
+            self._keys[key.fpr] = key
+        return [str(key.fpr) for key in keys]
+
+    def key_ids(self, fpr: str) -> Set[str]:
+        key = self._keys.get(fpr)
+        if key is None:
+            return super().key_ids(fpr)
+        return {str(subkey.keyid).upper() for subkey in key.subkeys}
+
+    def encrypt(self, data: bytes, recipients: Sequence[str], signer: str) -> bytes:
+        keys = [self._get_key(r) for r in recipients]
+        self._gpg.signers = [self._get_key(signer)]
+        try:
+            encdata, _, _ = self._gpg.encrypt(
+                data, keys, always_trust=True, compress=False
+            )
+        except self._gpgmod.errors.GPGMEError as e:
+            raise CryptoError(str(e))
+        if not isinstance(encdata, bytes):
+            raise CryptoError(
+                f"expected gpg.Context.encrypt() to return bytes, got {type(encdata)}"
+            )
+        return encdata
+
+    def decrypt(self, encdata: bytes) -> Tuple[bytes, Optional[bool]]:
+        sigvalid = False
+        try:
+            data, _, vfy = self._gpg.decrypt(encdata, verify=True)
+            for s in vfy.signatures:
+                if s.validity >= self._gpgmod.constants.VALIDITY_FULL:
+                    sigvalid = True
+        except self._gpgmod.errors.GPGMEError:
+            # retry decryption without verification:
+            try:
+                data, _, _ = self._gpg.decrypt(encdata, verify=False)
+            except self._gpgmod.errors.GPGMEError as e:
+                raise CryptoError(str(e))
+        if not isinstance(data, bytes):
+            raise CryptoError(
+                f"expected gpg.Context.decrypt() to return bytes, got {type(data)}"
+            )
+        return data, sigvalid
+
+
+class GpgBinaryBackend(Backend):
+    """OpenPGP by running the gpg program in batch mode.
+
+    Useful where the gpgme bindings are not installed, and to compare
+    against them.  The program is taken from the IMPASS_GPG
+    environment variable ("gpg" by default).
+
+    """
+
+    name = "gpg"
+
+    def __init__(self, program: Optional[str] = None) -> None:
+        self._program = program or os.getenv("IMPASS_GPG") or "gpg"
+        # long key IDs of resolved keys and their subkeys, by fingerprint
+        self._key_ids: Dict[str, Set[str]] = {}
+
+    def _run(self, args: List[str], data: bytes = b"") -> Tuple[bytes, List[str], int]:
+        cmd = [self._program, "--batch", "--no-tty", "--status-fd", "2"] + args
+        try:
+            p = subprocess.run(cmd, input=data, capture_output=True)
+        except OSError as e:
+            raise CryptoError("Could not run {}: {}".format(self._program, e))
+        return p.stdout, p.stderr.decode("utf-8", "replace").splitlines(), p.returncode
+
+    @staticmethod
+    def _status(lines: List[str]) -> List[str]:
+        return [
+            line.split()[1]
+            for line in lines
+            if line.startswith("[GNUPG:] ") and len(line.split()) > 1
+        ]
+
+    @staticmethod
+    def _message(lines: List[str]) -> str:
+        messages = [line for line in lines if not line.startswith("[GNUPG:] ")]
+        return messages[-1] if messages else "gpg failed"
+
+    def resolve_key(self, keyid: str) -> str:
+        if not keyid:
+            raise CryptoError("No key ID specified.")
+        out, err, code = self._run(["--with-colons", "--list-keys", "--", keyid])
+        fpr = None
+        ids: Set[str] = set()
+        if code == 0:
+            for line in out.decode("utf-8", "replace").splitlines():
+                fields = line.split(":")
+                if fields[0] == "pub" and fpr is not None:
+                    # only the first matching key is used
+                    break
+                if fields[0] in ("pub", "sub") and len(fields) > 4:
+                    ids.add(fields[4].upper())
+                elif fields[0] == "fpr" and fpr is None and len(fields) > 9:
+                    fpr = fields[9]
+        if fpr is None:
+            raise CryptoError(
+                "No public key for {}: {}".format(keyid, self._message(err))
+            )
+        self._key_ids[fpr] = ids
+        return fpr
+
+    def resolve_keys(self, keyids: Sequence[str]) -> List[str]:
+        # each lookup runs gpg, so run them in parallel
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            return list(pool.map(self.resolve_key, keyids))
+
+    def key_ids(self, fpr: str) -> Set[str]:
+        return self._key_ids.get(fpr) or super().key_ids(fpr)
+
+    def encrypt(self, data: bytes, recipients: Sequence[str], signer: str) -> bytes:
+        args = ["--armor", "--trust-model", "always", "--compress-algo", "none"]
+        args += ["--local-user", signer]
+        for r in recipients:
+            args += ["--recipient", r]
+        out, err, code = self._run(args + ["--sign", "--encrypt"], data)
+        if code != 0:
+            raise CryptoError(self._message(err))
+        return out
+
+    def decrypt(self, encdata: bytes) -> Tuple[bytes, Optional[bool]]:
+        # gpg exits non-zero for unverifiable signatures, so success
+        # is judged from the status lines
+        out, err, code = self._run(["--decrypt"], encdata)
+        status = self._status(err)
+        if "DECRYPTION_OKAY" not in status:
+            raise CryptoError(self._message(err))
+        sigvalid = "VALIDSIG" in status and (
+            "TRUST_FULLY" in status or "TRUST_ULTIMATE" in status
+        )
+        return out, sigvalid
+
+
+# marks data "encrypted" by the null backend
+_NULL_MAGIC = b"impass-null-backend-plaintext\n"
+
+
+class NullBackend(Backend):
+    """Plaintext backend, for tests and benchmarks only.
+
+    Data is neither encrypted nor signed; it is only prefixed with a
+    marker line, so that the other backends refuse it.  Any key ID is
+    accepted.  This isolates the cost of impass itself from the cost
+    of OpenPGP.  Never use it for real passwords.
+
+    """
+
+    name = "null"
+
+    def resolve_key(self, keyid: str) -> str:
+        if not keyid:
+            raise CryptoError("No key ID specified.")
+        return keyid
+
+    def key_ids(self, fpr: str) -> Set[str]:
+        return set()
+
+    def encrypt(self, data: bytes, recipients: Sequence[str], signer: str) -> bytes:
+        return _NULL_MAGIC + data
+
+    def decrypt(self, encdata: bytes) -> Tuple[bytes, Optional[bool]]:
+        if not encdata.startswith(_NULL_MAGIC):
+            raise CryptoError("Data was not written by the null crypto backend.")
+        return encdata[len(_NULL_MAGIC) :], None
+
+
+class RecipientSet:
+    """Signer and recipients of encrypted files.
+
+    Team databases are encrypted to several recipients.  The set is
+    kept in a text file with one key ID per line, each prefixed by its
+    role:
+
+      # ops team
+      signer   0123456789ABCDEF0123456789ABCDEF01234567
+      recipient alice@example.com
+      recipient bob@example.com
+
+    The signer line is optional; the key ID of the database is used
+    if there is none.
+
+    """
+
+    def __init__(self, recipients: Iterable[str], signer: Optional[str] = None):
+        self.signer = signer
+        self.recipients = tuple(dict.fromkeys(recipients))
+        if not self.recipients:
+            raise CryptoError("Recipient set has no recipients.")
+
+    @classmethod
+    def load(cls, path: str) -> "RecipientSet":
+        """Read a recipient set file."""
+        signer = None
+        recipients = []
+        try:
+            with open(path, "r") as f:
+                lines = f.read().splitlines()
+        except OSError as e:
+            raise CryptoError("Could not read recipient set: {}".format(e))
+        for n, line in enumerate(lines, 1):
+            words = line.split("#", 1)[0].split()
+            if not words:
+                continue
+            if len(words) != 2 or words[0] not in ("signer", "recipient"):
+                raise CryptoError("{}:{}: invalid recipient line.".format(path, n))
+            if words[0] == "recipient":
+                recipients.append(words[1])
+            elif signer is not None:
+                raise CryptoError("{}:{}: more than one signer.".format(path, n))
+            else:
+                signer = words[1]
+        return cls(recipients, signer)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, RecipientSet):
+            return NotImplemented
+        return (self.signer, self.recipients) == (other.signer, other.recipients)
+
+    def __repr__(self) -> str:
+        return "impass.crypto.RecipientSet(%r, %r)" % (
+            list(self.recipients),
+            self.signer,
+        )
+
+
+# OpenPGP public-key encrypted session key packet
+_PKESK_TAG = 1
+_SKESK_TAG = 3
+
+
+def _dearmor(data: bytes) -> bytes:
+    lines = data.splitlines()
+    try:
+        start = lines.index(b"-----BEGIN PGP MESSAGE-----")
+    except ValueError:
+        return data
+    body = []
+    # armor headers end at the first empty line
+    for line in lines[lines.index(b"", start) + 1 :]:
+        if line.startswith(b"=") or line.startswith(b"-----"):
+            break
+        body.append(line)
+    return base64.b64decode(b"".join(body))
+
+
+def encrypted_to(encdata: bytes) -> List[str]:
+    """Long key IDs an OpenPGP message is encrypted to.
+
+    These are read from the packets in front of the encrypted data,
+    without decrypting it.  Anonymous recipients, and data that is
+    not an OpenPGP message, are ignored.
+
+    """
+    try:
+        data = _dearmor(encdata)
+    except (ValueError, TypeError):
+        return []
+    keyids: List[str] = []
+    pos = 0
+    while pos < len(data):
+        head = data[pos]
+        if not head & 0x80:
+            break
+        if head & 0x40:
+            tag = head & 0x3F
+            if pos + 1 >= len(data):
+                break
+            first = data[pos + 1]
+            if first < 192:
+                hlen, length = 2, first
+            elif first < 224 and pos + 2 < len(data):
+                hlen, length = 3, ((first - 192) << 8) + data[pos + 2] + 192
+            elif first == 255:
+                hlen, length = 6, int.from_bytes(data[pos + 2 : pos + 6], "big")
+            else:
+                break
+        else:
+            tag = (head >> 2) & 0x0F
+            size = {0: 1, 1: 2, 2: 4}.get(head & 0x03)
+            if size is None:
+                break
+            hlen = 1 + size
+            length = int.from_bytes(data[pos + 1 : pos + hlen], "big")
+        if tag not in (_PKESK_TAG, _SKESK_TAG):
+            break
+        packet = data[pos + hlen : pos + hlen + length]
+        if tag == _PKESK_TAG and len(packet) >= 9 and packet[0] == 3:
+            keyid = packet[1:9].hex().upper()
+            if keyid != "0" * 16:
+                keyids.append(keyid)
+        pos += hlen + length
+    return keyids
+
+
+BACKENDS: Dict[str, Type[Backend]] = {
+    "gpgme": GpgmeBackend,
+    "gpg": GpgBinaryBackend,
+    "null": NullBackend,
+}
+
+DEFAULT_BACKEND = "gpgme"
+
+
+def get_backend(name: Optional[str] = None) -> Backend:
+    """Return a new instance of the named crypto backend.
+
+    If name is not specified, the IMPASS_CRYPTO environment variable
+    selects the backend (DEFAULT_BACKEND if unset).  Backend instances
+    must not be shared between threads.
+
+    """
+    if name is None:
+        name = os.getenv("IMPASS_CRYPTO") or DEFAULT_BACKEND
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise CryptoError("Unknown crypto backend '{}'.".format(name))
+    return cls()
@@ -1,24 +1,1022 @@
+from __future__ import annotations
+
 import os
 import io
+import re
 import stat
+import sys
 import json
-import gpg  # type: ignore
-import codecs
+import fcntl
+import array
+import struct
+import base64
+import bisect
+import hashlib
 import datetime
+import tempfile
+import itertools
+import contextlib
+
+from typing import (
+    Callable,
+    Optional,
+    Dict,
+    FrozenSet,
+    Iterator,
+    Iterable,
+    List,
+    Tuple,
+    Mapping,
+    Protocol,
+    Sequence,
+    Set,
+    Union,
+)
 
-from typing import Optional, Dict, Iterator
+from .crypto import Backend, CryptoError, RecipientSet, encrypted_to, get_backend
 
 ############################################################
 
 DEFAULT_NEW_PASSWORD_OCTETS = 18
 
+# supported database format versions; new databases are version 1
+DATABASE_VERSIONS = (1, 2, 3)
+
+# previous states of the db file kept in its snapshot history
+DEFAULT_SNAPSHOTS = 10
+
 
 def pwgen(nbytes: int) -> str:
     """Return *nbytes* bytes of random data, base64-encoded."""
-    s = os.urandom(nbytes)
-    b = codecs.encode(s, "base64")
-    b = bytes(filter(lambda x: x not in b"=\n", b))
-    return codecs.decode(b, "ascii")
+    return pwgen_batch(1, nbytes)[0]
+
+
+def pwgen_batch(count: int, nbytes: int) -> List[str]:
+    """Return *count* passwords of *nbytes* random bytes each.
+
+    All of the random data is read in a single call, and then split
+    and base64-encoded (without padding) per password.  A
+    DatabaseError is raised if nbytes is less than 1.
+
+    """
+    if nbytes < 1:
+        raise DatabaseError("Invalid password size %s." % nbytes)
+    s = os.urandom(count * nbytes)
+    return [
+        base64.b64encode(s[i : i + nbytes]).rstrip(b"=").decode("ascii")
+        for i in range(0, count * nbytes, nbytes)
+    ]
+
+
+def parse_date(date: str) -> datetime.datetime:
+    """Parse an ISO-8601 date string into a naive UTC datetime.
+
+    A trailing "Z" (as written by impass into entry dates) is
+    accepted.  A DatabaseError is raised if the date can not be
+    parsed.
+
+    """
+    try:
+        d = datetime.datetime.fromisoformat(date.strip().rstrip("Z"))
+    except ValueError:
+        raise DatabaseError("Could not parse date '%s'." % date)
+    if d.tzinfo is not None:
+        d = d.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return d
+
+
+_DURATION_UNITS = {
+    "h": datetime.timedelta(hours=1),
+    "d": datetime.timedelta(days=1),
+    "w": datetime.timedelta(weeks=1),
+    "m": datetime.timedelta(days=30),
+    "y": datetime.timedelta(days=365),
+}
+
+
+def parse_duration(duration: str) -> datetime.timedelta:
+    """Parse a duration string like "12h", "30d", "2w", "6m" or "1y".
+
+    A DatabaseError is raised if the duration can not be parsed.
+
+    """
+    duration = duration.strip().lower()
+    try:
+        return int(duration[:-1]) * _DURATION_UNITS[duration[-1:]]
+    except (KeyError, ValueError):
+        raise DatabaseError("Could not parse duration '%s'." % duration)
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_epoch(d: datetime.datetime) -> int:
+    return (d - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _from_epoch(us: int) -> datetime.datetime:
+    return _EPOCH + datetime.timedelta(microseconds=us)
+
+
+# dates as written by impass (see _unpack_date()): isoformat() leaves
+# out a zero fraction of seconds
+_IMPASS_DATE = re.compile(
+    r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.(?!000000)\d{6})?Z", re.ASCII
+)
+
+
+def _pack_date(date: str) -> Union[int, str]:
+    # dates written by impass are stored as epoch microseconds; other
+    # strings, that would not be reproduced exactly, are kept as is
+    if not _IMPASS_DATE.fullmatch(date):
+        return date
+    try:
+        return _to_epoch(datetime.datetime.fromisoformat(date[:-1]))
+    except ValueError:
+        return date
+
+
+def _unpack_date(date: Union[int, str]) -> str:
+    if isinstance(date, str):
+        return date
+    return _from_epoch(date).isoformat() + "Z"
+
+
+class SealedPassword:
+    """A password that is only decrypted when it is read.
+
+    Used for the entries of split (version 3) databases.  The digest
+    is the SHA-256 of the ciphertext, as recorded in the signed and
+    encrypted index, so that a swapped ciphertext is detected.
+
+    """
+
+    __slots__ = ("ciphertext", "digest", "_crypto")
+
+    def __init__(self, ciphertext: bytes, digest: str, crypto: Backend) -> None:
+        self.ciphertext = ciphertext
+        self.digest = digest
+        self._crypto = crypto
+
+    def __repr__(self) -> str:
+        return "<impass.SealedPassword %s>" % self.digest[:16]
+
+    def reveal(self) -> str:
+        """Decrypt and return the password."""
+        if hashlib.sha256(self.ciphertext).hexdigest() != self.digest:
+            raise DatabaseError("Corrupt database: secret does not match index.")
+        data, _ = self._crypto.decrypt(self.ciphertext)
+        return data.decode("utf-8")
+
+
+class Entry(Mapping[str, str]):
+    """A database entry as stored, a read-only mapping of fields to values.
+
+    Entries have "password" and "date" fields, and optionally
+    "expires" and other fields.  Fields are kept in slots and dates as
+    integer microseconds since the epoch, which keeps large databases
+    small in memory.  The password may be a SealedPassword, which is
+    decrypted each time the "password" field is read, and is
+    otherwise left out: it is not listed with the other fields, nor
+    in to_dict() unless revealed.
+
+    Database lookups return entries as new dicts (see to_dict()); the
+    stored entries are available from Database.entry().
+
+    """
+
+    __slots__ = ("_password", "_date", "_expires", "_extra")
+
+    def __init__(
+        self,
+        password: Union[str, SealedPassword],
+        date: Union[int, str],
+        expires: Union[int, str, None] = None,
+        extra: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self._password = password
+        self._date = _pack_date(date) if isinstance(date, str) else date
+        if isinstance(expires, str):
+            expires = _pack_date(expires)
+        self._expires = expires
+        # any other fields, None if there are none
+        self._extra = extra or None
+
+    @classmethod
+    def from_dict(cls, entry: Mapping[str, str]) -> Entry:
+        """Entry with the fields of a dict (as stored in the db file)."""
+        extra = {k: v for k, v in entry.items() if k not in _ENTRY_FIELDS}
+        return cls(entry["password"], entry["date"], entry.get("expires"), extra)
+
+    def __getitem__(self, field: str) -> str:
+        if field == "password":
+            if isinstance(self._password, SealedPassword):
+                return self._password.reveal()
+            return self._password
+        if field == "date":
+            return _unpack_date(self._date)
+        if field == "expires" and self._expires is not None:
+            return _unpack_date(self._expires)
+        if self._extra is not None:
+            return self._extra[field]
+        raise KeyError(field)
+
+    def __iter__(self) -> Iterator[str]:
+        if not isinstance(self._password, SealedPassword):
+            yield "password"
+        yield "date"
+        if self._expires is not None:
+            yield "expires"
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        n = 1 if isinstance(self._password, SealedPassword) else 2
+        n += 0 if self._expires is None else 1
+        return n + (len(self._extra) if self._extra is not None else 0)
+
+    def __contains__(self, field: object) -> bool:
+        # without reading the fields, which would decrypt the password
+        if field == "password":
+            return not isinstance(self._password, SealedPassword)
+        if field == "date":
+            return True
+        if field == "expires" and self._expires is not None:
+            return True
+        return self._extra is not None and field in self._extra
+
+    def __repr__(self) -> str:
+        return "impass.Entry(%r)" % self.to_dict()
+
+    def timestamp(self, field: str) -> Optional[int]:
+        """Date field as epoch microseconds, None if missing or unparsable."""
+        if field == "date":
+            date: Union[int, str, None] = self._date
+        elif field == "expires":
+            date = self._expires
+        else:
+            date = self.get(field)
+        if isinstance(date, str):
+            date = _pack_date(date)
+            if isinstance(date, str):
+                try:
+                    date = _to_epoch(parse_date(date))
+                except (DatabaseError, OverflowError):
+                    return None
+        return date
+
+    @property
+    def tags(self) -> FrozenSet[str]:
+        """Tags of the entry, kept as a comma-separated "tags" field."""
+        if self._extra is None or TAGS_FIELD not in self._extra:
+            return frozenset()
+        return frozenset(t for t in self._extra[TAGS_FIELD].split(",") if t)
+
+    @property
+    def fields(self) -> Dict[str, str]:
+        """Structured fields of the entry (e.g. user name or URL).
+
+        These are all fields other than password, date, expires and
+        tags.
+
+        """
+        if self._extra is None:
+            return {}
+        return {k: v for k, v in self._extra.items() if k != TAGS_FIELD}
+
+    @property
+    def sealed(self) -> Optional[SealedPassword]:
+        """The password if it is sealed, else None."""
+        if isinstance(self._password, SealedPassword):
+            return self._password
+        return None
+
+    def to_dict(self, reveal: bool = False) -> Dict[str, str]:
+        """Entry as a new dict.
+
+        A sealed password is only included if reveal is True, which
+        decrypts it.
+
+        """
+        entry: Dict[str, str] = {}
+        if reveal and isinstance(self._password, SealedPassword):
+            entry["password"] = self._password.reveal()
+        entry.update(self.items())
+        return entry
+
+
+def _same_entry(a: Entry, b: Optional[Entry]) -> bool:
+    # compare without decrypting sealed passwords
+    if b is None:
+        return False
+    pa, pb = a._password, b._password
+    if isinstance(pa, SealedPassword) and isinstance(pb, SealedPassword):
+        same_password = pa.digest == pb.digest
+    else:
+        same_password = pa == pb
+    return (
+        same_password
+        and a._date == b._date
+        and a._expires == b._expires
+        and a._extra == b._extra
+    )
+
+
+_ENTRY_FIELDS = ("password", "date", "expires")
+TAGS_FIELD = "tags"
+# entry fields with a date index
+_DATE_FIELDS = ("date", "expires")
+
+
+def _annotate(
+    extra: Optional[Dict[str, str]],
+    fields: Optional[Mapping[str, Optional[str]]] = None,
+    tags: Optional[Iterable[str]] = None,
+) -> Optional[Dict[str, str]]:
+    # extra fields with fields set (or removed if None), and tags
+    # replaced if specified
+    extra = dict(extra or {})
+    for name, value in (fields or {}).items():
+        if name in _ENTRY_FIELDS or name == TAGS_FIELD or not name:
+            raise DatabaseError("Invalid field name '%s'." % name)
+        if value is None:
+            extra.pop(name, None)
+        else:
+            extra[name] = value
+    if tags is not None:
+        tags = sorted(set(tags))
+        for tag in tags:
+            if not tag or "," in tag or tag != tag.strip():
+                raise DatabaseError("Invalid tag '%s'." % tag)
+        if tags:
+            extra[TAGS_FIELD] = ",".join(tags)
+        else:
+            extra.pop(TAGS_FIELD, None)
+    return extra or None
+
+
+class _DateIndex:
+    """Date-ordered index of the contexts with a given entry date field.
+
+    Entries whose field is missing or can not be parsed are not
+    indexed.
+
+    """
+
+    def __init__(self, field: str) -> None:
+        self._field = field
+        self._keys: List[Tuple[int, str]] = []
+
+    def _key(self, context: str, entry: Entry) -> Optional[Tuple[int, str]]:
+        timestamp = entry.timestamp(self._field)
+        if timestamp is None:
+            return None
+        return (timestamp, context)
+
+    def build(self, entries: Mapping[str, Entry]) -> None:
+        keys = (self._key(context, entry) for context, entry in entries.items())
+        self._keys = sorted(k for k in keys if k is not None)
+
+    def load(
+        self, timestamps: Iterable[int], positions: Iterable[int], contexts: List[str]
+    ) -> None:
+        # from a stored index (see _StoredIndices), already in order
+        self._keys = list(zip(timestamps, map(contexts.__getitem__, positions)))
+
+    def add(self, context: str, entry: Entry) -> None:
+        key = self._key(context, entry)
+        if key is not None:
+            bisect.insort(self._keys, key)
+
+    def discard(self, context: str, entry: Entry) -> None:
+        key = self._key(context, entry)
+        if key is None:
+            return
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def range(
+        self,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+    ) -> List[str]:
+        """Contexts with start <= date < end, in date order."""
+        lo = 0
+        if start is not None:
+            lo = bisect.bisect_left(self._keys, (_to_epoch(start), ""))
+        hi = len(self._keys)
+        if end is not None:
+            hi = bisect.bisect_left(self._keys, (_to_epoch(end), ""))
+        return [context for _, context in self._keys[lo:hi]]
+
+
+class _FieldIndex:
+    """Inverted index from tags and field values to contexts."""
+
+    def __init__(self) -> None:
+        self._index: Dict[Tuple[str, str], Set[str]] = {}
+
+    @staticmethod
+    def _keys(entry: Entry) -> Iterator[Tuple[str, str]]:
+        if entry._extra is None:
+            return
+        for tag in entry.tags:
+            yield (TAGS_FIELD, tag)
+        yield from entry.fields.items()
+
+    def build(self, entries: Mapping[str, Entry]) -> None:
+        self._index = {}
+        for context, entry in entries.items():
+            self.add(context, entry)
+
+    def load(
+        self,
+        keys: List[Tuple[str, str]],
+        ends: Iterable[int],
+        positions: Sequence[int],
+        contexts: List[str],
+    ) -> None:
+        # from a stored index (see _StoredIndices)
+        self._index = {}
+        start = 0
+        for key, end in zip(keys, ends):
+            self._index[key] = set(map(contexts.__getitem__, positions[start:end]))
+            start = end
+
+    def add(self, context: str, entry: Entry) -> None:
+        for key in self._keys(entry):
+            self._index.setdefault(key, set()).add(context)
+
+    def discard(self, context: str, entry: Entry) -> None:
+        for key in self._keys(entry):
+            contexts = self._index.get(key)
+            if contexts is None:
+                continue
+            contexts.discard(context)
+            if not contexts:
+                del self._index[key]
+
+    def select(
+        self, tags: Iterable[str] = (), fields: Optional[Mapping[str, str]] = None
+    ) -> Set[str]:
+        keys = [(TAGS_FIELD, t) for t in tags] + list((fields or {}).items())
+        # intersect starting from the smallest set
+        sets = sorted((self._index.get(k, set()) for k in keys), key=len)
+        if not sets:
+            return set()
+        result = set(sets[0])
+        for other in sets[1:]:
+            result &= other
+        return result
+
+
+def _build_indices(
+    entries: Mapping[str, Entry], stored: Optional[_StoredIndices] = None
+) -> Dict[str, Union[_DateIndex, _FieldIndex]]:
+    # date and field indices of entries, loaded from the stored
+    # indices of the entries if given
+    dates = {field: _DateIndex(field) for field in _DATE_FIELDS}
+    fields = _FieldIndex()
+    contexts = list(entries) if stored is not None else []
+    for field, index in dates.items():
+        if stored is not None:
+            index.load(*stored.dates[field], contexts)
+        else:
+            index.build(entries)
+    if stored is not None and stored.fields is not None:
+        fields.load(*stored.fields, contexts)
+    else:
+        fields.build(entries)
+    indices: Dict[str, Union[_DateIndex, _FieldIndex]] = dict(dates)
+    indices["fields"] = fields
+    return indices
+
+
+############################################################
+# version 2 plaintext: a compact, columnar binary encoding
+#
+#   magic (8 bytes), entry count (uint32), then seven sections, each
+#   a uint32 byte length followed by the data:
+#
+#   context ends    uint32 per entry, end offsets (in characters)
+#   contexts        UTF-8 text of all contexts, concatenated
+#   password ends   uint32 per entry
+#   passwords       UTF-8 text of all passwords, concatenated
+#   dates           int64 per entry, epoch microseconds
+#   expires         int64 per entry, epoch microseconds
+#   extras          JSON object of contexts to any other fields
+#
+# followed by the date and field indices, as seven more sections:
+#
+#   date times      int64 per indexed entry, in date order
+#   date entries    uint32 per indexed entry, its position in the file
+#   expires times   int64 per indexed entry, in expiration order
+#   expires entries uint32 per indexed entry
+#   field keys      JSON list of [field, value] pairs ("tags" for tags)
+#   key ends        uint32 per key, end offsets in the key entries
+#   key entries     uint32 positions of the entries with each key
+#
+# All numbers are little-endian.  Dates that are not plain epoch
+# times are kept as strings in the extras, and marked _STR_DATE.
+# Readers that do not know the indices ignore them.
+
+_V2_MAGIC = b"impass\x00\x02"
+_NO_DATE = -(2**63)
+_STR_DATE = _NO_DATE + 1
+
+
+def _pack_array(typecode: str, values: Iterable[int]) -> bytes:
+    a = array.array(typecode, values)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tobytes()
+
+
+def _unpack_array(
+    typecode: str, data: memoryview, count: Optional[int] = None
+) -> array.array:
+    a = array.array(typecode)
+    try:
+        a.frombytes(data)
+    except ValueError:
+        raise DatabaseError("Corrupt database: bad column length.")
+    if sys.byteorder == "big":
+        a.byteswap()
+    if count is not None and len(a) != count:
+        raise DatabaseError("Corrupt database: bad column length.")
+    return a
+
+
+def _date_column(dates: Iterable[Union[int, str, None]]) -> bytes:
+    return _pack_array(
+        "q",
+        (
+            _NO_DATE if d is None else _STR_DATE if isinstance(d, str) else d
+            for d in dates
+        ),
+    )
+
+
+class _StoredIndices:
+    """Date and field indices as stored in version 2 encodings.
+
+    Entries are referred to by their position in the file, so the
+    indices can be loaded without sorting or parsing the entries, but
+    only hold for the entries as they are in the file.
+
+    """
+
+    def __init__(
+        self,
+        dates: Dict[str, Tuple[array.array, array.array]],
+        fields: Optional[Tuple[List[Tuple[str, str]], array.array, array.array]],
+    ) -> None:
+        # by date field: timestamps in index order, and entry positions
+        self.dates = dates
+        # (field, value) keys, end offsets of their entry positions,
+        # and the positions; None if not stored
+        self.fields = fields
+
+    @classmethod
+    def build(
+        cls,
+        entries: Mapping[str, Entry],
+        indices: Mapping[str, Union[_DateIndex, _FieldIndex]],
+    ) -> _StoredIndices:
+        positions = {context: i for i, context in enumerate(entries)}
+        dates = {}
+        for field in _DATE_FIELDS:
+            index = indices[field]
+            assert isinstance(index, _DateIndex)
+            dates[field] = (
+                array.array("q", (t for t, _ in index._keys)),
+                array.array("I", (positions[c] for _, c in index._keys)),
+            )
+        fields = indices["fields"]
+        assert isinstance(fields, _FieldIndex)
+        keys = sorted(fields._index)
+        postings = [sorted(positions[c] for c in fields._index[k]) for k in keys]
+        return cls(
+            dates,
+            (
+                keys,
+                array.array("I", itertools.accumulate(len(p) for p in postings)),
+                array.array("I", itertools.chain.from_iterable(postings)),
+            ),
+        )
+
+    @classmethod
+    def decode(cls, sections: List[memoryview], count: int) -> _StoredIndices:
+        if len(sections) < 2 * len(_DATE_FIELDS):
+            raise DatabaseError("Corrupt database: truncated index.")
+        dates = {}
+        for i, field in enumerate(_DATE_FIELDS):
+            timestamps = _unpack_array("q", sections[2 * i])
+            positions = _unpack_array("I", sections[2 * i + 1], len(timestamps))
+            if positions and max(positions) >= count:
+                raise DatabaseError("Corrupt database: bad index.")
+            dates[field] = (timestamps, positions)
+        fields = None
+        if len(sections) >= 2 * len(_DATE_FIELDS) + 3:
+            keys, ends, postings = sections[2 * len(_DATE_FIELDS) :][:3]
+            try:
+                pairs = [(f, v) for f, v in json.loads(str(keys, "utf-8"))]
+            except (ValueError, TypeError):
+                raise DatabaseError("Corrupt database: bad index.")
+            end_array = _unpack_array("I", ends, len(pairs))
+            positions = _unpack_array("I", postings)
+            if end_array and end_array[-1] != len(positions):
+                raise DatabaseError("Corrupt database: bad index.")
+            if positions and max(positions) >= count:
+                raise DatabaseError("Corrupt database: bad index.")
+            fields = (pairs, end_array, positions)
+        return cls(dates, fields)
+
+    def sections(self) -> List[bytes]:
+        out = []
+        for field in _DATE_FIELDS:
+            timestamps, positions = self.dates[field]
+            out += [_pack_array("q", timestamps), _pack_array("I", positions)]
+        if self.fields is not None:
+            keys, ends, postings = self.fields
+            out += [
+                json.dumps(keys, separators=(",", ":")).encode("utf-8"),
+                _pack_array("I", ends),
+                _pack_array("I", postings),
+            ]
+        return out
+
+
+def _encode_v2(
+    entries: Mapping[str, Entry], indices: Optional[_StoredIndices] = None
+) -> bytes:
+    contexts = list(entries)
+    values = list(entries.values())
+    extras: Dict[str, Dict[str, str]] = {}
+    for context, entry in entries.items():
+        extra = dict(entry._extra or {})
+        if isinstance(entry._date, str):
+            extra["date"] = entry._date
+        if isinstance(entry._expires, str):
+            extra["expires"] = entry._expires
+        if extra:
+            extras[context] = extra
+    passwords = [e["password"] for e in values]
+    sections = [
+        _pack_array("I", itertools.accumulate(len(c) for c in contexts)),
+        "".join(contexts).encode("utf-8"),
+        _pack_array("I", itertools.accumulate(len(p) for p in passwords)),
+        "".join(passwords).encode("utf-8"),
+        _date_column(e._date for e in values),
+        _date_column(e._expires for e in values),
+        json.dumps(extras, separators=(",", ":")).encode("utf-8"),
+    ]
+    if indices is not None:
+        sections += indices.sections()
+    out = [_V2_MAGIC, struct.pack("<I", len(contexts))]
+    for section in sections:
+        out += [struct.pack("<I", len(section)), section]
+    return b"".join(out)
+
+
+def _decode_v2(
+    data: bytes, seal: Optional[Callable[[str], SealedPassword]] = None
+) -> Tuple[Dict[str, Entry], Optional[_StoredIndices]]:
+    # entries, and the stored indices if any
+    view = memoryview(data)
+    pos = len(_V2_MAGIC)
+    sections = []
+    try:
+        (count,) = struct.unpack_from("<I", view, pos)
+        pos += 4
+        while len(sections) < 7 or pos < len(view):
+            (size,) = struct.unpack_from("<I", view, pos)
+            pos += 4
+            if pos + size > len(view):
+                raise DatabaseError("Corrupt database: truncated.")
+            sections.append(view[pos : pos + size])
+            pos += size
+    except struct.error:
+        raise DatabaseError("Corrupt database: truncated.")
+    try:
+        contexts = str(sections[1], "utf-8")
+        passwords = str(sections[3], "utf-8")
+        extras = json.loads(str(sections[6], "utf-8"))
+    except ValueError as e:
+        raise DatabaseError("Corrupt database: {}".format(e))
+    context_ends = _unpack_array("I", sections[0], count)
+    password_ends = _unpack_array("I", sections[2], count)
+    dates = _unpack_array("q", sections[4], count)
+    expires = _unpack_array("q", sections[5], count)
+
+    entries: Dict[str, Entry] = {}
+    cstart = pstart = 0
+    for i in range(count):
+        cend = context_ends[i]
+        pend = password_ends[i]
+        context = contexts[cstart:cend]
+        date: Union[int, str] = dates[i]
+        expire: Union[int, str, None] = expires[i]
+        extra = extras.get(context) if extras else None
+        if extra is not None:
+            if date == _STR_DATE:
+                date = extra.pop("date")
+            if expire == _STR_DATE:
+                expire = extra.pop("expires")
+        if expire == _NO_DATE:
+            expire = None
+        password: Union[str, SealedPassword] = passwords[pstart:pend]
+        if seal is not None:
+            password = seal(password)
+        entries[context] = Entry(password, date, expire, extra)
+        cstart = cend
+        pstart = pend
+    indices = None
+    if len(sections) > 7:
+        indices = _StoredIndices.decode(sections[7:], count)
+    return entries, indices
+
+
+############################################################
+# version 3: split index and secrets
+#
+#   _SPLIT_MAGIC, then length-prefixed records:
+#
+#   index LENGTH\n<ciphertext>\n
+#   secret DIGEST LENGTH\n<ciphertext>\n     (one per password)
+#
+# The index is an encrypted version 2 encoding of the entries, with
+# the SHA-256 digest of the password ciphertext in place of each
+# password.  Each password is encrypted on its own, so the index can
+# be decrypted without decrypting any password.
+
+_SPLIT_MAGIC = b"impass-split 3\n"
+
+
+def _encode_split(index: bytes, secrets: Dict[str, bytes]) -> bytes:
+    out = [_SPLIT_MAGIC, b"index %d\n" % len(index), index, b"\n"]
+    for digest, ciphertext in secrets.items():
+        out += [
+            b"secret %s %d\n" % (digest.encode("ascii"), len(ciphertext)),
+            ciphertext,
+            b"\n",
+        ]
+    return b"".join(out)
+
+
+def _decode_split(data: bytes) -> Tuple[bytes, Dict[str, bytes]]:
+    index: Optional[bytes] = None
+    secrets: Dict[str, bytes] = {}
+    pos = len(_SPLIT_MAGIC)
+    try:
+        while pos < len(data):
+            eol = data.index(b"\n", pos)
+            header = data[pos:eol].decode("ascii").split()
+            size = int(header[-1])
+            record = data[eol + 1 : eol + 1 + size]
+            pos = eol + 1 + size + 1
+            if len(record) != size or data[pos - 1 : pos] != b"\n":
+                raise DatabaseError("Corrupt database: truncated.")
+            if header[0] == "index" and len(header) == 2:
+                index = record
+            elif header[0] == "secret" and len(header) == 3:
+                secrets[header[1]] = record
+            else:
+                raise DatabaseError("Corrupt database: unknown record.")
+    except (ValueError, IndexError):
+        raise DatabaseError("Corrupt database: bad record header.")
+    if index is None:
+        raise DatabaseError("Corrupt database: no index.")
+    return index, secrets
+
+
+############################################################
+# Snapshot history (path + ".snapshots"):
+#
+#   _SNAPSHOT_MAGIC, then one record per save, oldest first:
+#
+#   snapshot DATE OLD NEW LENGTH\n<ciphertext>\n
+#
+# DATE is the date (epoch microseconds) of the state the save
+# replaced, OLD and NEW the SHA-256 digests of the db file before and
+# after the save.  The ciphertext is an encrypted reverse delta: the
+# entries the save changed, as they were before it (null for entries
+# it added).  A previous state is rebuilt from the current entries by
+# undoing the saves since, newest first, following the digests.
+
+_SNAPSHOT_MAGIC = b"impass-snapshots 1\n"
+
+# date, old digest, new digest, encrypted delta
+_Snapshot = Tuple[int, str, str, bytes]
+
+
+def _encode_snapshots(snapshots: Iterable[_Snapshot]) -> bytes:
+    out = [_SNAPSHOT_MAGIC]
+    for date, old, new, delta in snapshots:
+        out += [
+            b"snapshot %d %s %s %d\n" % (date, old.encode(), new.encode(), len(delta)),
+            delta,
+            b"\n",
+        ]
+    return b"".join(out)
+
+
+def _decode_snapshots(data: bytes) -> List[_Snapshot]:
+    if not data.startswith(_SNAPSHOT_MAGIC):
+        raise DatabaseError("Corrupt snapshot history.")
+    snapshots = []
+    pos = len(_SNAPSHOT_MAGIC)
+    try:
+        while pos < len(data):
+            eol = data.index(b"\n", pos)
+            kind, date, old, new, size = data[pos:eol].decode("ascii").split()
+            delta = data[eol + 1 : eol + 1 + int(size)]
+            pos = eol + 1 + int(size) + 1
+            if kind != "snapshot" or len(delta) != int(size):
+                raise ValueError
+            snapshots.append((int(date), old, new, delta))
+    except ValueError:
+        raise DatabaseError("Corrupt snapshot history.")
+    return snapshots
+
+
+def _snapshot_chain(snapshots: List[_Snapshot], digest: str) -> List[_Snapshot]:
+    # snapshots undoing the saves that led to the file with digest,
+    # newest first; later saves (by other processes) are skipped
+    chain: List[_Snapshot] = []
+    for snapshot in reversed(snapshots):
+        if snapshot[2] == digest:
+            chain.append(snapshot)
+            digest = snapshot[1]
+        elif chain:
+            break
+    return chain
+
+
+def _encode_delta(delta: Mapping[str, Optional[Entry]]) -> bytes:
+    # sealed passwords are kept encrypted, as in the db file
+    entries: Dict[str, Optional[Dict[str, str]]] = {}
+    sealed: Dict[str, str] = {}
+    for context, entry in delta.items():
+        if entry is None:
+            entries[context] = None
+            continue
+        password = entry._password
+        if isinstance(password, SealedPassword):
+            sealed[context] = base64.b64encode(password.ciphertext).decode("ascii")
+        entries[context] = entry.to_dict()
+    jsondata = {"type": "impass-snapshot", "entries": entries, "sealed": sealed}
+    return json.dumps(jsondata).encode("utf-8")
+
+
+def _decode_delta(data: bytes, crypto: Backend) -> Dict[str, Optional[Entry]]:
+    try:
+        jsondata = json.loads(data.decode("utf-8"))
+        if jsondata.get("type") != "impass-snapshot":
+            raise ValueError
+        delta: Dict[str, Optional[Entry]] = {}
+        for context, fields in jsondata["entries"].items():
+            if fields is None:
+                delta[context] = None
+                continue
+            password: Union[str, SealedPassword]
+            if context in jsondata["sealed"]:
+                ciphertext = base64.b64decode(jsondata["sealed"][context])
+                digest = hashlib.sha256(ciphertext).hexdigest()
+                password = SealedPassword(ciphertext, digest, crypto)
+            else:
+                password = fields["password"]
+            extra = {k: v for k, v in fields.items() if k not in _ENTRY_FIELDS}
+            delta[context] = Entry(
+                password, fields["date"], fields.get("expires"), extra
+            )
+    except (ValueError, KeyError, AttributeError, TypeError):
+        raise DatabaseError("Corrupt snapshot.")
+    return delta
+
+
+############################################################
+
+
+class _EntrySource(Protocol):
+    # what SearchResult needs from a Database or DatabaseSet
+    def __iter__(self) -> Iterator[str]:
+        ...
+
+    def __len__(self) -> int:
+        ...
+
+    def __contains__(self, context: str) -> bool:
+        ...
+
+    def entry(self, context: str) -> Entry:
+        ...
+
+
+class SearchResult(Mapping[str, Dict[str, str]]):
+    """Lazy result of a database search.
+
+    A read-only mapping of matching contexts to entries, as new dicts
+    (see Database.__getitem__(); the stored entries are available
+    from entry()).  Matches are found while the result is iterated,
+    so nothing is copied and the database is only scanned as far as
+    needed: first() stops at the first match, and count(2) at the
+    second.  The result reflects the
+    database at the time it is used, and the database must not be
+    modified while iterating over it.
+
+    """
+
+    def __init__(
+        self,
+        source: _EntrySource,
+        string: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        candidates: Optional[List[str]] = None,
+    ) -> None:
+        self._source = source
+        self._string = string or None
+        self._offset = max(offset, 0)
+        self._limit = None if limit is None else max(limit, 0)
+        # contexts preselected by tag and field (see Database.search())
+        self._candidates = candidates
+        self._candidate_set = None if candidates is None else set(candidates)
+
+    def __repr__(self) -> str:
+        return "impass.SearchResult(%r, offset=%d, limit=%r)" % (
+            self._string,
+            self._offset,
+            self._limit,
+        )
+
+    def _match(self, context: str) -> bool:
+        # simple substring match
+        return self._string is None or self._string in context
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterator of matching contexts, in database order."""
+        if self._candidates is None:
+            matches = (c for c in self._source if self._match(c))
+        else:
+            matches = (
+                c for c in self._candidates if c in self._source and self._match(c)
+            )
+        stop = None if self._limit is None else self._offset + self._limit
+        return itertools.islice(matches, self._offset, stop)
+
+    def __contains__(self, context: object) -> bool:
+        if not isinstance(context, str) or not self._match(context):
+            return False
+        if context not in self._source:
+            return False
+        if self._candidate_set is not None and context not in self._candidate_set:
+            return False
+        if self._offset == 0 and self._limit is None:
+            return True
+        return any(c == context for c in self)
+
+    def __getitem__(self, context: str) -> Dict[str, str]:
+        return self.entry(context).to_dict(reveal=True)
+
+    def entry(self, context: str) -> Entry:
+        """Stored entry of a matching context (see Database.entry())."""
+        if context not in self:
+            raise KeyError(context)
+        return self._source.entry(context)
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def count(self, upto: Optional[int] = None) -> int:
+        """Number of matches, counting no further than upto."""
+        if self._string is None and self._candidates is None:
+            # every context matches, no need to scan
+            n = max(len(self._source) - self._offset, 0)
+            if self._limit is not None:
+                n = min(n, self._limit)
+            return n if upto is None else min(n, upto)
+        return sum(1 for _ in itertools.islice(self, upto))
+
+    def first(self) -> Optional[str]:
+        """First matching context, or None if there is no match."""
+        return next(iter(self), None)
+
+    def offset(self, n: int) -> SearchResult:
+        """Result without the first n matches."""
+        limit = None if self._limit is None else self._limit - n
+        return SearchResult(
+            self._source, self._string, self._offset + n, limit, self._candidates
+        )
+
+    def limit(self, n: int) -> SearchResult:
+        """Result of at most the first n matches."""
+        if self._limit is not None:
+            n = min(n, self._limit)
+        return SearchResult(
+            self._source, self._string, self._offset, n, self._candidates
+        )
 
 
 ############################################################
@@ -32,62 +1030,458 @@ class DatabaseError(Exception):
         return repr(self.msg)
 
 
-class Database:
+class EncryptedStore:
+    """Base class for OpenPGP-encrypted and signed impass files."""
+
+    def __init__(
+        self, keyid: Optional[str] = None, backend: Optional[Backend] = None
+    ) -> None:
+        """If no crypto backend is given, the one selected by the
+        IMPASS_CRYPTO environment variable is used (see
+        impass.crypto.get_backend()).
+
+        """
+        self._keyid = keyid
+        self._crypto = backend or get_backend()
+        self._sigvalid: Optional[bool] = None
+        # recipient set, if not just the key ID
+        self._recipients: Optional[RecipientSet] = None
+        # last resolved (signer, recipients), and their fingerprints
+        self._resolved: Optional[Tuple[Tuple[str, Tuple[str, ...]], List[str]]] = None
+        # long key IDs the last file read was encrypted to
+        self._encrypted_to: List[str] = []
+
+    @property
+    def keyid(self) -> Optional[str]:
+        """OpenPGP key ID used for encryption."""
+        return self._keyid
+
+    @property
+    def backend(self) -> Backend:
+        """Crypto backend."""
+        return self._crypto
+
+    @property
+    def sigvalid(self) -> Optional[bool]:
+        """Validity of OpenPGP signature on db file."""
+        return self._sigvalid
+
+    def _decrypt_db(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return self._decrypt_data(f.read())
+
+    def _decrypt_data(self, encdata: bytes) -> bytes:
+        self._sigvalid = False
+        data, self._sigvalid = self._crypto.decrypt(encdata)
+        self._encrypted_to = encrypted_to(encdata)
+        return data
+
+    def _encrypt_db(self, data: io.BytesIO, keyid: Optional[str]) -> bytes:
+        signer, recipients = self._resolve_recipients(keyid)
+        return self._crypto.encrypt(data.getvalue(), recipients, signer)
+
+    def _resolve_recipients(self, keyid: Optional[str]) -> Tuple[str, List[str]]:
+        # fingerprints of the signer and recipients: the key ID for
+        # both, unless there is a recipient set.  Keys are only looked
+        # up again if the set changed.
+        signer = keyid or self._keyid or ""
+        if self._recipients is None:
+            wanted: Tuple[str, Tuple[str, ...]] = (signer, (signer,))
+        else:
+            wanted = (self._recipients.signer or signer, self._recipients.recipients)
+        if self._resolved is None or self._resolved[0] != wanted:
+            try:
+                fprs = self._crypto.resolve_keys([wanted[0], *wanted[1]])
+            except CryptoError:
+                raise DatabaseError("Could not retrieve GPG encryption key.")
+            self._resolved = (wanted, fprs)
+        fprs = self._resolved[1]
+        return fprs[0], list(dict.fromkeys(fprs[1:]))
+
+    def _write_file(self, path: str, encdata: bytes) -> None:
+        """Atomically replace the file at path with encdata.
+
+        File permissions of an existing file are preserved.
+
+        """
+        mode = stat.S_IRUSR | stat.S_IWUSR
+        # unique temporary file (created with mode 0600), so that
+        # concurrent writers never clobber each other's
+        fd, newpath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=os.path.basename(path) + ".",
+            suffix=".new",
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(encdata)
+            if os.path.exists(path):
+                mode = os.stat(path)[stat.ST_MODE]
+            os.chmod(newpath, mode)
+            os.rename(newpath, path)
+        except BaseException:
+            if os.path.exists(newpath):
+                os.unlink(newpath)
+            raise
+
+
+@contextlib.contextmanager
+def file_lock(path: str, exclusive: bool = False) -> Iterator[None]:
+    """Hold an advisory lock for the file at path.
+
+    Shared locks (for reading) can be held by many processes at once,
+    an exclusive lock (for writing) by only one.  The lock is taken on
+    a separate path + ".lock" file, since the file itself is replaced
+    on write.  The lock file is kept, as removing it would race with
+    other processes taking the lock.
+
+    If the lock file can not be created, as in a read-only directory
+    (where no one can replace the file either), a shared lock is taken
+    on an existing lock file opened read-only, or not at all.
+
+    """
+    lockpath = path + ".lock"
+    try:
+        fd = os.open(lockpath, os.O_RDWR | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR)
+    except OSError:
+        if exclusive:
+            raise
+        try:
+            fd = os.open(lockpath, os.O_RDONLY)
+        except OSError:
+            yield
+            return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _read_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class Database(EncryptedStore):
     """An impass database."""
 
     def __init__(
-        self, dbpath: Optional[str] = None, keyid: Optional[str] = None
+        self,
+        dbpath: Optional[str] = None,
+        keyid: Optional[str] = None,
+        backend: Optional[Backend] = None,
+        recipients: Optional[RecipientSet] = None,
     ) -> None:
         """Database at dbpath will be decrypted and loaded into memory.
 
         If dbpath is not specified, an empty database will be
-        initialized.
+        initialized.  backend is the crypto backend (see
+        EncryptedStore).
+
+        The database is encrypted to keyid, which also signs it,
+        unless a recipient set is given (see
+        impass.crypto.RecipientSet), for databases shared by a team.
 
         The sigvalid property is set False if any OpenPGP signatures
         on the db file are invalid.  sigvalid is None for new
         databases.
 
         """
+        super().__init__(keyid, backend)
         self._dbpath = dbpath
-        self._keyid = keyid
+        self._recipients = recipients
 
         # default database information
         self._type = "impass"
         self._version = 1
-        self._entries: Dict[str, Dict[str, str]] = {}
+        self._entries: Dict[str, Entry] = {}
+        # date and field indices are built on first use
+        self._indices: Optional[Dict[str, Union[_DateIndex, _FieldIndex]]] = None
+        # indices stored in the file, while the entries are as loaded
+        self._stored: Optional[_StoredIndices] = None
+        # unsaved changes
+        self._modified = False
 
-        self._gpg = gpg.Context()
-        self._gpg.armor = True
-        self._sigvalid: Optional[bool] = None
+        # digest of the db file as last read or written, to detect
+        # saves by other processes
+        self._digest: Optional[str] = None
+        # changes since the last load or save, by context (None for
+        # removal), re-applied if the file changed in the meantime
+        self._pending: Dict[str, Optional[Entry]] = {}
+        # entries as they are in the file (None if not there), for the
+        # contexts in _pending
+        self._originals: Dict[str, Optional[Entry]] = {}
+        self._snapshot_limit = DEFAULT_SNAPSHOTS
+
+        if self._dbpath:
+            # a missing file is checked for under the lock
+            self.reload()
+
+    @classmethod
+    def from_ciphertext(
+        cls,
+        encdata: bytes,
+        keyid: Optional[str] = None,
+        backend: Optional[Backend] = None,
+    ) -> Database:
+        """Load database from encrypted data in memory.
 
-        if self._dbpath and os.path.exists(self._dbpath):
+        The database has no path, so save() needs an explicit path.
+
+        """
+        db = cls(None, keyid, backend)
+        db._load_ciphertext(encdata)
+        return db
+
+    def reload(self) -> None:
+        """Reload database from disk.
+
+        Changes that have not been saved yet are re-applied on top of
+        the reloaded entries.
+
+        """
+        if not self._dbpath:
+            raise DatabaseError("Database has no path.")
+        try:
+            with file_lock(self._dbpath):
+                encdata = _read_file(self._dbpath)
+        except IOError as e:
+            raise DatabaseError(str(e))
+        self._reload(encdata)
+
+    def refresh(self) -> List[str]:
+        """Reload database from disk if it was saved by someone else.
+
+        The file is only decrypted if its content changed since it was
+        last read or written here.  Date indices are updated in place.
+        Returns the contexts that were added, removed or modified.
+
+        """
+        if not self._dbpath:
+            raise DatabaseError("Database has no path.")
+        try:
+            with file_lock(self._dbpath):
+                encdata = _read_file(self._dbpath)
+        except IOError as e:
+            raise DatabaseError(str(e))
+        digest = None if encdata is None else hashlib.sha256(encdata).hexdigest()
+        if digest == self._digest:
+            return []
+        old = self._entries
+        indices = self._indices
+        self._reload(encdata)
+        new = self._entries
+        changed = [c for c in old if not _same_entry(old[c], new.get(c))]
+        changed += [c for c in new if c not in old]
+        if indices is not None and self._indices is None:
+            for context in changed:
+                for index in indices.values():
+                    if context in old:
+                        index.discard(context, old[context])
+                    if context in new:
+                        index.add(context, new[context])
+            self._indices = indices
+        return changed
+
+    def _reload(self, encdata: Optional[bytes]) -> None:
+        pending = self._pending
+        if encdata is None:
+            self._digest = None
+            self._entries = {}
+            self._indices = None
+            self._stored = None
+        else:
+            self._load_ciphertext(encdata)
+            self._digest = hashlib.sha256(encdata).hexdigest()
+        self._pending = {}
+        self._originals = {}
+        self._modified = False
+        for context, entry in pending.items():
+            self._put_entry(context, entry)
+
+    def _load_ciphertext(self, encdata: bytes) -> None:
+        if not encdata.startswith(_SPLIT_MAGIC):
+            self._load(self._decrypt_data(encdata))
+            return
+        index, secrets = _decode_split(encdata)
+        cleardata = self._decrypt_data(index)
+        if not cleardata.startswith(_V2_MAGIC):
+            raise DatabaseError("Corrupt database: bad index.")
+        crypto = self._crypto
+
+        def seal(digest: str) -> SealedPassword:
             try:
-                cleardata = self._decrypt_db(self._dbpath)
-                # FIXME: trap exception if json corrupt
-                jsondata = json.loads(cleardata.decode("utf-8"))
-            except IOError as e:
-                raise DatabaseError(str(e))
-
-            # unpack the json data
-            # FIXME: we accept "assword" type for backwords compatibility
-            if "type" not in jsondata or jsondata["type"] not in [
-                self._type,
-                "assword",
-            ]:
-                raise DatabaseError("Database is not a proper impass database.")
-            if "version" not in jsondata or jsondata["version"] != self._version:
-                raise DatabaseError("Incompatible database.")
-            self._entries = jsondata["entries"]
+                return SealedPassword(secrets[digest], digest, crypto)
+            except KeyError:
+                raise DatabaseError("Corrupt database: missing secret.")
+
+        self._entries, self._stored = _decode_v2(cleardata, seal)
+        self._version = 3
+        self._indices = None
+
+    def _serialize(self, version: int, entries: Mapping[str, Entry]) -> io.BytesIO:
+        if version == 2:
+            return io.BytesIO(_encode_v2(entries, self._stored_indices(entries)))
+        jsondata = {
+            "type": self._type,
+            "version": version,
+            "entries": {c: e.to_dict(reveal=True) for c, e in entries.items()},
+        }
+        return io.BytesIO(json.dumps(jsondata, indent=2).encode("utf-8"))
+
+    def _seal_password(
+        self, password: str, signer: str, recipients: List[str]
+    ) -> SealedPassword:
+        ciphertext = self._crypto.encrypt(password.encode("utf-8"), recipients, signer)
+        digest = hashlib.sha256(ciphertext).hexdigest()
+        return SealedPassword(ciphertext, digest, self._crypto)
+
+    def _preseal(self, keyid: Optional[str]) -> Dict[str, Tuple[Entry, SealedPassword]]:
+        # encrypt the passwords that are not sealed yet, each on its
+        # own, before the file is locked for saving; by context, with
+        # the entry they were sealed for (see _seal())
+        signer, recipients = self._resolve_recipients(keyid)
+        entries, _ = self._save_snapshot()
+        presealed: Dict[str, Tuple[Entry, SealedPassword]] = {}
+        for context, entry in entries.items():
+            password = entry._password
+            if not isinstance(password, SealedPassword):
+                sealed = self._seal_password(password, signer, recipients)
+                presealed[context] = (entry, sealed)
+        return presealed
+
+    def _seal(
+        self,
+        keyid: Optional[str],
+        entries: Mapping[str, Entry],
+        presealed: Mapping[str, Tuple[Entry, SealedPassword]],
+    ) -> Tuple[bytes, Dict[str, Entry]]:
+        # encrypt passwords that are not sealed yet, keeping existing
+        # ciphertexts and using those of presealed for the same
+        # entries; also returns the entries with newly sealed
+        # passwords, to replace the unsealed ones
+        signer, recipients = self._resolve_recipients(keyid)
+        secrets: Dict[str, bytes] = {}
+        index: Dict[str, Entry] = {}
+        sealed: Dict[str, Entry] = {}
+        for context, entry in entries.items():
+            password = entry._password
+            if not isinstance(password, SealedPassword):
+                pre = presealed.get(context)
+                if pre is not None and pre[0] is entry:
+                    password = pre[1]
+                else:
+                    # changed since, or reloaded from another save
+                    password = self._seal_password(password, signer, recipients)
+                entry = Entry(password, entry._date, entry._expires, entry._extra)
+                sealed[context] = entry
+            secrets[password.digest] = password.ciphertext
+            index[context] = Entry(
+                password.digest, entry._date, entry._expires, entry._extra
+            )
+        cleardata = _encode_v2(index, self._stored_indices(entries))
+        encindex = self._crypto.encrypt(cleardata, recipients, signer)
+        return _encode_split(encindex, secrets), sealed
+
+    def _load(self, cleardata: bytes) -> None:
+        if cleardata.startswith(_V2_MAGIC):
+            self._entries, self._stored = _decode_v2(cleardata)
+            self._version = 2
+            self._indices = None
+            return
+
+        # FIXME: trap exception if json corrupt
+        jsondata = json.loads(cleardata.decode("utf-8"))
+
+        # unpack the json data
+        # FIXME: we accept "assword" type for backwords compatibility
+        if "type" not in jsondata or jsondata["type"] not in [
+            self._type,
+            "assword",
+        ]:
+            raise DatabaseError("Database is not a proper impass database.")
+        if "version" not in jsondata or jsondata["version"] != 1:
+            raise DatabaseError("Incompatible database.")
+        self._version = 1
+        self._entries = {
+            context: Entry.from_dict(entry)
+            for context, entry in jsondata["entries"].items()
+        }
+        self._indices = None
+        self._stored = None
 
     @property
     def version(self) -> int:
-        """Database version."""
+        """Database format version.
+
+        This is the version of the loaded file, which is kept when
+        saving unless another version is requested (see save()).
+        Version 1 is JSON, version 2 a compact binary encoding.
+
+        """
         return self._version
 
     @property
-    def sigvalid(self) -> Optional[bool]:
-        """Validity of OpenPGP signature on db file."""
-        return self._sigvalid
+    def path(self) -> Optional[str]:
+        """Path of database file."""
+        return self._dbpath
+
+    def plaintext_size(self) -> int:
+        """Size in bytes of the database cleartext, as it would be saved.
+
+        For split (version 3) databases this is the size of the index;
+        the separately encrypted passwords are not decrypted.
+
+        """
+        if self._version != 3:
+            return len(self._serialize(self._version, self._entries).getvalue())
+        index = {}
+        for context, entry in self._entries.items():
+            password = entry._password
+            digest = password.digest if isinstance(password, SealedPassword) else ""
+            index[context] = Entry(
+                digest.ljust(64, "0"), entry._date, entry._expires, entry._extra
+            )
+        return len(_encode_v2(index, self._stored_indices(self._entries)))
+
+    @property
+    def modified(self) -> bool:
+        """True if the database has changes that have not been saved."""
+        return self._modified
+
+    @property
+    def recipients(self) -> Optional[RecipientSet]:
+        """Recipient set the database is saved for (None for keyid only)."""
+        return self._recipients
+
+    @recipients.setter
+    def recipients(self, recipients: Optional[RecipientSet]) -> None:
+        self._recipients = recipients
+
+    def recipient_drift(
+        self, keyid: Optional[str] = None
+    ) -> Tuple[List[str], List[str]]:
+        """Compare the recipients of the db file with those of the next save.
+
+        Returns the fingerprints of recipients that the next save
+        would add, and the key IDs in the file that it would drop.
+        Both are empty for new files, and for backends that do not
+        encrypt to keys.
+
+        """
+        if not self._encrypted_to:
+            return [], []
+        _, fprs = self._resolve_recipients(keyid)
+        current = set(self._encrypted_to)
+        added = [f for f in fprs if not self._crypto.key_ids(f) & current]
+        kept: Set[str] = set()
+        for fpr in fprs:
+            kept |= self._crypto.key_ids(fpr)
+        return added, sorted(current - kept)
 
     def __str__(self) -> str:
         return '<impass.Database "%s">' % (self._dbpath)
@@ -96,7 +1490,16 @@ class Database:
         return 'impass.Database("%s")' % (self._dbpath)
 
     def __getitem__(self, context: str) -> Dict[str, str]:
-        """Return database entry for exact context."""
+        """Return database entry for exact context, as a new dict.
+
+        A sealed password is decrypted (see Entry).  Changing the dict
+        does not change the database (see replace() and annotate()).
+
+        """
+        return self.entry(context).to_dict(reveal=True)
+
+    def entry(self, context: str) -> Entry:
+        """Return the stored entry for exact context (see Entry)."""
         return self._entries[context]
 
     def __contains__(self, context: str) -> bool:
@@ -107,64 +1510,90 @@ class Database:
         """Iterator of all database contexts."""
         return iter(self._entries)
 
-    def _decrypt_db(self, path: str) -> bytes:
-        data = None
-        self._sigvalid = False
-        with open(path, "rb") as f:
-            try:
-                data, _, vfy = self._gpg.decrypt(f, verify=True)
-                for s in vfy.signatures:
-                    if s.validity >= gpg.constants.VALIDITY_FULL:
-                        self._sigvalid = True
-            except gpg.errors.GPGMEError:
-                # retry decryption without verification:
-                with open(path, "rb") as try2:
-                    data, _, _ = self._gpg.decrypt(try2, verify=False)
-        if not isinstance(data, bytes):
-            raise DatabaseError(
-                f"expected gpg.Context.decrypt() to return bytes, got {type(data)}"
-            )
-        return data
+    def __len__(self) -> int:
+        """Number of database entries."""
+        return len(self._entries)
 
-    def _encrypt_db(self, data: io.BytesIO, keyid: Optional[str]) -> bytes:
-        # The signer and the recipient are assumed to be the same.
-        # FIXME: should these be separated?
-        try:
-            recipient = self._gpg.get_key(keyid or self._keyid, secret=False)
-            signer = self._gpg.get_key(keyid or self._keyid, secret=False)
-        except gpg.errors.GPGMEError:
-            raise DatabaseError("Could not retrieve GPG encryption key.")
-        self._gpg.signers = [signer]
-        data.seek(0)
-        encdata, _, _ = self._gpg.encrypt(
-            data, [recipient], always_trust=True, compress=False
-        )
-        if not isinstance(encdata, bytes):
-            raise DatabaseError(
-                f"expected gpg.Context.decrypt() to return bytes, got {type(data)}"
-            )
-        return encdata
+    def _index_entry(self, context: str, entry: Optional[Entry]) -> None:
+        if self._indices is None:
+            if self._stored is None:
+                return
+            # the stored indices no longer hold once entries change
+            self._get_indices()
+            self._stored = None
+        assert self._indices is not None
+        old = self._entries.get(context)
+        for index in self._indices.values():
+            if old is not None:
+                index.discard(context, old)
+            if entry is not None:
+                index.add(context, entry)
+
+    def _put_entry(self, context: str, entry: Optional[Entry]) -> None:
+        # store entry as is, or remove context if entry is None
+        if entry is None and context not in self._entries:
+            return
+        self._index_entry(context, entry)
+        if context not in self._originals:
+            self._originals[context] = self._entries.get(context)
+        if entry is None:
+            del self._entries[context]
+        else:
+            self._entries[context] = entry
+        self._pending[context] = entry
+        self._modified = True
 
     def _set_entry(
-        self, context: str, password: Optional[str] = None
-    ) -> Dict[str, str]:
+        self,
+        context: str,
+        password: Optional[str] = None,
+        expires: Optional[str] = None,
+        fields: Optional[Mapping[str, Optional[str]]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Entry:
         if not isinstance(password, str):
             if password is None:
                 bytes = DEFAULT_NEW_PASSWORD_OCTETS
             if isinstance(password, int):
                 bytes = password
             password = pwgen(bytes)
-        e = {"password": password, "date": datetime.datetime.utcnow().isoformat() + "Z"}
-        self._entries[context] = e
+        date = _to_epoch(datetime.datetime.utcnow())
+        new_expires: Union[int, str, None] = expires
+        old = self._entries.get(context)
+        if expires is None and old is not None and "expires" in old:
+            # keep the lifetime of the previous password
+            old_expires = old.timestamp("expires")
+            old_date = old.timestamp("date")
+            if old_expires is not None and old_date is not None:
+                new_expires = date + (old_expires - old_date)
+            else:
+                new_expires = old["expires"]
+        extra = _annotate(old._extra if old is not None else None, fields, tags)
+        e = Entry(password, date, new_expires, extra)
+        self._put_entry(context, e)
         return e
 
-    def add(self, context: str, password: Optional[str] = None) -> Dict[str, str]:
+    def add(
+        self,
+        context: str,
+        password: Optional[str] = None,
+        expires: Optional[str] = None,
+        fields: Optional[Mapping[str, str]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
         """Add new entry.
 
         If password is None, one will be generated automatically.  If
         password is an int it will be interpreted as the number of
         random bytes to use.
 
+        If expires is specified it should be an ISO-8601 date string,
+        stored as the expiration date of the password.
+
+        fields are structured fields of the entry (e.g. {"user":
+        "deploy"}), and tags a set of tags (see Entry.fields and
+        Entry.tags).  Both are stored as additional entry fields.
+
         If the context is already in the db a DatabaseError will be
         raised.
 
@@ -176,15 +1605,30 @@ class Database:
             raise DatabaseError("Can not add empty string context")
         if context in self:
             raise DatabaseError("Context already exists (see replace())")
-        return self._set_entry(context, password)
+        return self._set_entry(context, password, expires, fields, tags).to_dict()
 
-    def replace(self, context: str, password: Optional[str] = None) -> Dict[str, str]:
+    def replace(
+        self,
+        context: str,
+        password: Optional[str] = None,
+        expires: Optional[str] = None,
+        fields: Optional[Mapping[str, Optional[str]]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
         """Replace entry password.
 
         If password is None, one will be generated automatically.  If
         password is an int it will be interpreted as the number of
         random bytes to use.
 
+        If expires is not specified and the entry had an expiration
+        date, the new password expires after the same lifetime as the
+        old one.
+
+        Fields and tags of the entry are kept; fields are updated with
+        the given fields (a field set to None is removed), and tags
+        are replaced if specified.
+
         If the context is not in the db a DatabaseError will be
         raised.
 
@@ -194,7 +1638,30 @@ class Database:
         """
         if context not in self:
             raise DatabaseError("Context not found (see add())")
-        return self._set_entry(context, password)
+        return self._set_entry(context, password, expires, fields, tags).to_dict()
+
+    def annotate(
+        self,
+        context: str,
+        fields: Optional[Mapping[str, Optional[str]]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        """Update entry fields and tags, keeping password and dates.
+
+        See replace().  The entry is returned without a sealed password,
+        which is not decrypted (see Entry.to_dict()).
+
+        Database changes are not saved to disk until the save() method
+        is called.
+
+        """
+        if context not in self:
+            raise DatabaseError("Context '%s' not found." % context)
+        old = self._entries[context]
+        extra = _annotate(old._extra, fields, tags)
+        e = Entry(old._password, old._date, old._expires, extra)
+        self._put_entry(context, e)
+        return e.to_dict()
 
     def update(self, old_context: str, new_context: str) -> None:
         """Update entry context.
@@ -208,10 +1675,65 @@ class Database:
         """
         if old_context not in self:
             raise DatabaseError("Context '%s' not found." % old_context)
-        password = self[old_context]["password"]
-        self.add(new_context, password)
+        if new_context == "":
+            raise DatabaseError("Can not add empty string context")
+        if new_context in self:
+            raise DatabaseError("Context already exists (see replace())")
+        # the password is moved as is, so a sealed one stays sealed
+        old = self._entries[old_context]
+        date = _to_epoch(datetime.datetime.utcnow())
+        self._put_entry(
+            new_context, Entry(old._password, date, old._expires, old._extra)
+        )
         self.remove(old_context)
 
+    def rotate(
+        self,
+        contexts: Iterable[str],
+        nbytes: int = DEFAULT_NEW_PASSWORD_OCTETS,
+        passwords: Optional[Mapping[str, str]] = None,
+    ) -> Dict[str, Dict[str, str]]:
+        """Replace the passwords of many entries at once.
+
+        New passwords of *nbytes* random bytes are generated for all
+        contexts in a single batch, unless the new passwords are given
+        in *passwords*, keyed by context (e.g. as generated by
+        impass.policy.PolicySet.generate()).  The updated entries are
+        returned, keyed by context.
+
+        If any of the contexts is not in the db a DatabaseError will be
+        raised and no entries are modified.
+
+        Database changes are not saved to disk until the save() method
+        is called.
+
+        """
+        contexts = list(dict.fromkeys(contexts))
+        for context in contexts:
+            if context not in self:
+                raise DatabaseError("Context '%s' not found." % context)
+            if passwords is not None and context not in passwords:
+                raise DatabaseError("No new password for '%s'." % context)
+        if passwords is None:
+            passwords = dict(zip(contexts, pwgen_batch(len(contexts), nbytes)))
+        return {
+            context: self._set_entry(context, passwords[context]).to_dict()
+            for context in contexts
+        }
+
+    def put_entries(self, entries: Mapping[str, Optional[Entry]]) -> None:
+        """Store entries as they are, keeping their dates.
+
+        Contexts mapped to None are removed.  This is meant for entries
+        taken from another copy of the database (see impass.sync).
+
+        Database changes are not saved to disk until the save() method
+        is called.
+
+        """
+        for context, entry in entries.items():
+            self._put_entry(context, entry)
+
     def remove(self, context: str) -> None:
         """Remove entry.
 
@@ -221,54 +1743,421 @@ class Database:
         """
         if context not in self:
             raise DatabaseError("Context '%s' not found" % context)
-        del self._entries[context]
+        self._put_entry(context, None)
 
-    def save(self, keyid: Optional[str] = None, path: Optional[str] = None) -> None:
+    def save(
+        self,
+        keyid: Optional[str] = None,
+        path: Optional[str] = None,
+        version: Optional[int] = None,
+    ) -> None:
         """Save database to disk.
 
         Key ID must either be specified here or at database initialization.
         If path not specified, database will be saved at original dbpath location.
 
+        If version is specified, the database is converted to that
+        format version (see DATABASE_VERSIONS).  Conversion is lossless.
+
+        The file is locked while saving.  If another process saved the
+        database since it was loaded, it is reloaded and the changes
+        made here since are re-applied before saving, so that no
+        entries are lost.
+
+        When saving to the database path, the state replaced is kept
+        in the snapshot history (see history()).
+
         """
         # FIXME: should check that recipient is not different than who
         # the db was originally encrypted for
         if not keyid:
             keyid = self._keyid
-        if not keyid:
+        if not keyid and not (self._recipients and self._recipients.signer):
             raise DatabaseError("Key ID for decryption not specified.")
         if not path:
             path = self._dbpath
         if not path:
             raise DatabaseError("Save path not specified.")
-        jsondata = {
-            "type": self._type,
-            "version": self._version,
-            "entries": self._entries,
-        }
-        cleardata = io.BytesIO(json.dumps(jsondata, indent=2).encode("utf-8"))
-        encdata = self._encrypt_db(cleardata, keyid)
-        newpath = path + ".new"
-        bakpath = path + ".bak"
-        mode = stat.S_IRUSR | stat.S_IWUSR
-        with open(newpath, "wb") as f:
-            f.write(encdata)
-        if os.path.exists(path):
-            mode = os.stat(path)[stat.ST_MODE]
-            os.rename(path, bakpath)
-        # FIXME: shouldn't this be done when we're actually creating
-        # the file?
-        os.chmod(newpath, mode)
-        os.rename(newpath, path)
-
-    def search(self, string: Optional[str] = None) -> Dict[str, Dict[str, str]]:
+        if version is not None and version not in DATABASE_VERSIONS:
+            raise DatabaseError("Unsupported database version %s." % version)
+        current = None
+        presealed: Dict[str, Tuple[Entry, SealedPassword]] = {}
+        if (version or self._version) == 3:
+            # passwords are encrypted one at a time, which is better
+            # done before locking the file
+            presealed = self._preseal(keyid)
+        with file_lock(path, exclusive=True):
+            if path == self._dbpath:
+                current = _read_file(path)
+                if current is None:
+                    digest = None
+                else:
+                    digest = hashlib.sha256(current).hexdigest()
+                if digest != self._digest:
+                    # saved by someone else since we read it
+                    self._reload(current)
+            if version is None:
+                version = self._version
+            entries, pending = self._save_snapshot()
+            sealed: Dict[str, Entry] = {}
+            if version == 3:
+                encdata, sealed = self._seal(keyid, entries, presealed)
+            else:
+                encdata = self._encrypt_db(self._serialize(version, entries), keyid)
+            digest = hashlib.sha256(encdata).hexdigest()
+            if current is not None and self._snapshot_limit > 0:
+                date = os.stat(path).st_mtime_ns // 1000
+                self._write_file(path, encdata)
+                old = hashlib.sha256(current).hexdigest()
+                self._add_snapshot(keyid, date, old, digest, entries, pending)
+            else:
+                self._write_file(path, encdata)
+        self._saved(path, digest, version, entries, pending, sealed)
+        if path == self._dbpath:
+            if encdata.startswith(_SPLIT_MAGIC):
+                encdata = _decode_split(encdata)[0]
+            self._encrypted_to = encrypted_to(encdata)
+
+    def _save_snapshot(
+        self,
+    ) -> Tuple[Mapping[str, Entry], Dict[str, Optional[Entry]]]:
+        # entries to save, and the pending changes they include
+        return self._entries, self._pending
+
+    def _saved(
+        self,
+        path: str,
+        digest: str,
+        version: int,
+        entries: Mapping[str, Entry],
+        pending: Dict[str, Optional[Entry]],
+        sealed: Dict[str, Entry],
+    ) -> None:
+        # record a successful save of entries
+        self._entries.update(sealed)
+        if path == self._dbpath:
+            self._digest = digest
+            self._pending = {}
+            self._originals = {}
+            self._version = version
+        self._modified = False
+
+    def _add_snapshot(
+        self,
+        keyid: Optional[str],
+        date: int,
+        old: str,
+        new: str,
+        entries: Mapping[str, Entry],
+        pending: Dict[str, Optional[Entry]],
+    ) -> None:
+        # record the save of entries from the file with digest old,
+        # holding the pending changes, in the snapshot history; call
+        # with the db file locked
+        delta: Dict[str, Optional[Entry]] = {}
+        for context in pending:
+            original = self._originals.get(context)
+            entry = entries.get(context)
+            if original is None and entry is None:
+                continue
+            if original is not None and _same_entry(original, entry):
+                continue
+            delta[context] = original
+        encdelta = self._encrypt_db(io.BytesIO(_encode_delta(delta)), keyid)
+        path = self._snapshots_path()
+        snapshots = _decode_snapshots(_read_file(path) or _SNAPSHOT_MAGIC)
+        snapshots.append((date, old, new, encdelta))
+        self._write_file(path, _encode_snapshots(snapshots[-self._snapshot_limit :]))
+
+    def _snapshots_path(self) -> str:
+        if not self._dbpath:
+            raise DatabaseError("Database has no path.")
+        return self._dbpath + ".snapshots"
+
+    def _snapshots(self, digest: Optional[str]) -> List[_Snapshot]:
+        # snapshots leading to the db file with digest, newest first
+        path = self._snapshots_path()
+        if digest is None:
+            return []
+        try:
+            with file_lock(self._dbpath or path):
+                data = _read_file(path)
+        except IOError as e:
+            raise DatabaseError(str(e))
+        if data is None:
+            return []
+        return _snapshot_chain(_decode_snapshots(data), digest)
+
+    def _file_state(self) -> Tuple[Optional[str], Dict[str, Entry]]:
+        # digest and entries of the db file as last read or written
+        entries = dict(self._entries)
+        for context, entry in self._originals.items():
+            if entry is None:
+                entries.pop(context, None)
+            else:
+                entries[context] = entry
+        return self._digest, entries
+
+    @property
+    def snapshot_limit(self) -> int:
+        """Number of previous states kept in the snapshot history.
+
+        0 disables the snapshot history.  Default: DEFAULT_SNAPSHOTS
+
+        """
+        return self._snapshot_limit
+
+    @snapshot_limit.setter
+    def snapshot_limit(self, limit: int) -> None:
+        self._snapshot_limit = max(limit, 0)
+
+    def history(self) -> List[datetime.datetime]:
+        """Dates of the previous states of the db file, newest first.
+
+        Each save to the database path keeps the state it replaced in
+        a snapshot history next to the db file (path + ".snapshots"),
+        as the entries that the save changed, encrypted to the same
+        recipients; the last snapshot_limit states are kept.  Listing
+        them needs no decryption.  Dates are naive UTC datetimes, of
+        the save that produced each state.  State n (counting from 1)
+        is rebuilt by revision(n).
+
+        """
+        return [_from_epoch(s[0]) for s in self._snapshots(self._digest)]
+
+    def revision(self, n: int) -> Dict[str, Entry]:
+        """Entries of the nth previous state of the db file.
+
+        State 0 is the db file as last read or written, without the
+        changes not saved yet.  The state is rebuilt from it by
+        undoing the last n saves, so only their snapshots are
+        decrypted.
+
+        """
+        digest, entries = self._file_state()
+        snapshots = self._snapshots(digest)
+        if not 0 <= n <= len(snapshots):
+            raise DatabaseError("No snapshot %d in history." % n)
+        for _, _, _, encdelta in snapshots[:n]:
+            data, valid = self._crypto.decrypt(encdelta)
+            if valid is False:
+                raise DatabaseError("Invalid signature on snapshot.")
+            for context, entry in _decode_delta(data, self._crypto).items():
+                if entry is None:
+                    entries.pop(context, None)
+                else:
+                    entries[context] = entry
+        return entries
+
+    def restore(self, n: int, contexts: Optional[Iterable[str]] = None) -> List[str]:
+        """Restore entries as they were in the nth previous state.
+
+        All entries are restored (entries added since are removed),
+        unless contexts are given.  Returns the contexts that changed.
+        See revision().
+
+        Database changes are not saved to disk until the save() method
+        is called.
+
+        """
+        entries = self.revision(n)
+        if contexts is None:
+            contexts = set(self) | set(entries)
+        contexts = sorted(contexts)
+        for context in contexts:
+            if context not in entries and context not in self:
+                raise DatabaseError("Context '%s' not found" % context)
+        changed = []
+        for context in contexts:
+            entry = entries.get(context)
+            if entry is None:
+                if context not in self:
+                    continue
+            elif context in self and _same_entry(entry, self.entry(context)):
+                continue
+            self._put_entry(context, entry)
+            changed.append(context)
+        return changed
+
+    def search(
+        self,
+        string: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        tags: Iterable[str] = (),
+        fields: Optional[Mapping[str, str]] = None,
+    ) -> SearchResult:
         """Search for string in contexts.
 
-        If query is None, all entries will be returned.
+        If query is None, all entries will be returned.  The result is
+        a lazy view of the matching entries (see SearchResult); at
+        most limit matches are returned after skipping the first
+        offset.
+
+        If tags or fields are specified, only entries with all of the
+        tags and field values match.  These are looked up in an index
+        (stored in version 2 and 3 databases, see date_range()),
+        without scanning the database; the matches are then ordered
+        by context.
 
         """
-        mset = {}
-        for context, entry in self._entries.items():
-            # simple substring match
-            if not string or string in context:
-                mset[context] = entry
-        return mset
+        tags = list(tags)
+        candidates = None
+        if tags or fields:
+            candidates = sorted(self._select(tags, fields))
+        return SearchResult(self, string, offset, limit, candidates)
+
+    def date_range(
+        self,
+        field: str = "date",
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+    ) -> List[str]:
+        """Return contexts whose date field is in the range [start, end).
+
+        field may be "date" (when the password was set) or "expires".
+        Dates are naive UTC datetimes; if start or end is None the
+        range is open on that side.  Contexts are returned in date
+        order.
+
+        The dates are looked up in an index, which version 2 and 3
+        databases store, so that it is loaded rather than built by
+        sorting the entries.
+
+        """
+        if field not in _DATE_FIELDS:
+            raise DatabaseError("Unknown date field '%s'." % field)
+        index = self._get_indices()[field]
+        assert isinstance(index, _DateIndex)
+        return index.range(start, end)
+
+    def _get_indices(self) -> Dict[str, Union[_DateIndex, _FieldIndex]]:
+        if self._indices is None:
+            self._indices = _build_indices(self._entries, self._stored)
+        return self._indices
+
+    def _stored_indices(self, entries: Mapping[str, Entry]) -> _StoredIndices:
+        # indices to store with entries (a save snapshot): those of
+        # the file if unchanged, or the maintained ones
+        if entries is not self._entries:
+            indices = _build_indices(entries)
+        elif self._stored is not None:
+            return self._stored
+        else:
+            indices = self._get_indices()
+        return _StoredIndices.build(entries, indices)
+
+    def _select(
+        self, tags: Iterable[str] = (), fields: Optional[Mapping[str, str]] = None
+    ) -> Set[str]:
+        # contexts with all tags and field values, from the index
+        index = self._get_indices()["fields"]
+        assert isinstance(index, _FieldIndex)
+        return index.select(tags, fields)
+
+
+############################################################
+
+
+class _Rekey(EncryptedStore):
+    # re-encryption of db files as they are, for another key; each
+    # result is checked by decrypting it
+
+    def __init__(self, keyid: str, backend: Optional[Backend] = None) -> None:
+        super().__init__(keyid, backend)
+        # cleartext bytes re-encrypted
+        self.size = 0
+
+    def _decrypt_checked(self, encdata: bytes) -> bytes:
+        data, valid = self._crypto.decrypt(encdata)
+        if valid is False:
+            raise DatabaseError("Invalid signature, not rekeying.")
+        return data
+
+    def _encrypt_checked(self, data: bytes) -> bytes:
+        encdata = self._encrypt_db(io.BytesIO(data), self._keyid)
+        if self._decrypt_checked(encdata) != data:
+            raise DatabaseError("Re-encrypted data does not match.")
+        self.size += len(data)
+        return encdata
+
+    def reencrypt(self, encdata: bytes) -> bytes:
+        if not encdata.startswith(_SPLIT_MAGIC):
+            return self._encrypt_checked(self._decrypt_checked(encdata))
+        # the index refers to the passwords by ciphertext digest
+        index, secrets = _decode_split(encdata)
+        digests: Dict[str, str] = {}
+        new_secrets: Dict[str, bytes] = {}
+        for digest, ciphertext in secrets.items():
+            if hashlib.sha256(ciphertext).hexdigest() != digest:
+                raise DatabaseError("Corrupt database: secret does not match index.")
+            ciphertext = self._encrypt_checked(self._decrypt_checked(ciphertext))
+            digests[digest] = hashlib.sha256(ciphertext).hexdigest()
+            new_secrets[digests[digest]] = ciphertext
+        entries, indices = _decode_v2(self._decrypt_checked(index))
+        try:
+            entries = {
+                c: Entry(digests[str(e._password)], e._date, e._expires, e._extra)
+                for c, e in entries.items()
+            }
+        except KeyError:
+            raise DatabaseError("Corrupt database: missing secret.")
+        index = self._encrypt_checked(_encode_v2(entries, indices))
+        return _encode_split(index, new_secrets)
+
+    def reencrypt_snapshots(self, data: bytes, digests: Dict[str, str]) -> bytes:
+        # digests maps replaced file digests to new ones
+        snapshots = []
+        for date, old, new, encdelta in _decode_snapshots(data):
+            try:
+                jsondata = json.loads(self._decrypt_checked(encdelta).decode("utf-8"))
+                sealed = jsondata["sealed"]
+                for context, ciphertext in sealed.items():
+                    ciphertext = self._decrypt_checked(base64.b64decode(ciphertext))
+                    ciphertext = self._encrypt_checked(ciphertext)
+                    sealed[context] = base64.b64encode(ciphertext).decode("ascii")
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise DatabaseError("Corrupt snapshot.")
+            encdelta = self._encrypt_checked(json.dumps(jsondata).encode("utf-8"))
+            snapshots.append(
+                (date, digests.get(old, old), digests.get(new, new), encdelta)
+            )
+        return _encode_snapshots(snapshots)
+
+
+def rekey_database(path: str, keyid: str, backend: Optional[Backend] = None) -> int:
+    """Re-encrypt the db file at path, and the files kept with it, for keyid.
+
+    The file is encrypted to and signed by keyid alone.  Its snapshot
+    history, sync state (path + ".sync") and a backup left by older
+    versions (path + ".bak") are rekeyed too.  Entries are not loaded:
+    each file is decrypted and re-encrypted as it is, and files are
+    only replaced once all of them were re-encrypted and checked by
+    decrypting the results.  Files with invalid signatures are not
+    rekeyed.  Returns the number of cleartext bytes re-encrypted.
+
+    """
+    rekey = _Rekey(keyid, backend)
+    with file_lock(path, exclusive=True):
+        try:
+            encdata = _read_file(path)
+            if encdata is None:
+                raise DatabaseError("Database does not exist.")
+            files = {path: rekey.reencrypt(encdata)}
+            # the snapshot history refers to the db file by digest
+            old = hashlib.sha256(encdata).hexdigest()
+            digests = {old: hashlib.sha256(files[path]).hexdigest()}
+            for other in (path + ".bak", path + ".sync"):
+                encdata = _read_file(other)
+                if encdata is not None:
+                    files[other] = rekey.reencrypt(encdata)
+            data = _read_file(path + ".snapshots")
+            if data is not None:
+                files[path + ".snapshots"] = rekey.reencrypt_snapshots(data, digests)
+        except IOError as e:
+            raise DatabaseError(str(e))
+        except CryptoError as e:
+            raise DatabaseError("Could not rekey: %s" % e)
+        for name, encdata in files.items():
+            rekey._write_file(name, encdata)
+    return rekey.size
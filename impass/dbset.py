@@ -0,0 +1,368 @@
+import os
+import datetime
+import concurrent.futures
+
+from typing import Optional, Dict, Iterator, Iterable, List, Mapping, Union
+
+from .db import (
+    Database,
+    DatabaseError,
+    Entry,
+    SearchResult,
+    DEFAULT_NEW_PASSWORD_OCTETS,
+)
+
+############################################################
+
+# file name suffix of database files in a database directory
+DBSET_SUFFIX = ".db"
+
+
+class DatabaseSet:
+    """A unified view of several impass databases.
+
+    All member databases start decrypting concurrently when the set
+    is opened, and each member is waited for on first use: looking up
+    a context only waits for the members up to the one holding it,
+    while iterating, searching or checking signatures waits for all of
+    them.  The set can then be searched and edited as one.  Each entry
+    is kept in, and written back to, the member database it came from.
+    If a context is present in several members, the entry from the
+    first member (in order of names) is used.
+
+    """
+
+    def __init__(
+        self,
+        paths: Union[str, Iterable[str]],
+        keyid: Optional[str] = None,
+        default: Optional[str] = None,
+        max_workers: Optional[int] = None,
+    ) -> None:
+        """Open the databases at paths.
+
+        paths is either a directory, in which case all files ending in
+        DBSET_SUFFIX are opened, or an iterable of database paths.
+        Members are named after their file name (without the suffix).
+
+        New entries are added to the member named default, or to the
+        first member if default is not specified.
+
+        Errors decrypting a member are raised when it is first used.
+
+        """
+        if isinstance(paths, str):
+            self._dirpath: Optional[str] = paths
+            try:
+                names = os.listdir(paths)
+            except OSError as e:
+                raise DatabaseError(str(e))
+            paths = [
+                os.path.join(paths, f)
+                for f in names
+                if f.endswith(DBSET_SUFFIX) and not f.startswith(".")
+            ]
+        else:
+            self._dirpath = None
+        byname: Dict[str, str] = {}
+        for path in paths:
+            name = os.path.basename(path)
+            if name.endswith(DBSET_SUFFIX):
+                name = name[: -len(DBSET_SUFFIX)]
+            if name in byname:
+                raise DatabaseError("Duplicate database name '%s'." % name)
+            byname[name] = path
+        names = sorted(byname)
+        if default is not None and default not in byname:
+            raise DatabaseError("Unknown default database '%s'." % default)
+        self._default = default
+
+        # decryption is dominated by waiting on gpg, so decrypt all
+        # member files at the same time, in the background
+        self._names = names
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._futures: Dict[str, "concurrent.futures.Future[Database]"] = {
+            name: pool.submit(Database, byname[name], keyid) for name in names
+        }
+        # the pool threads exit once the decryptions are done
+        pool.shutdown(wait=False)
+        # members loaded so far, a prefix of names, and the sources of
+        # their contexts
+        self._members: Dict[str, Database] = {}
+        self._sources: Dict[str, str] = {}
+
+    def _load_next(self) -> bool:
+        # wait for the next member; False if all are loaded
+        if len(self._members) == len(self._names):
+            return False
+        name = self._names[len(self._members)]
+        db = self._futures[name].result()
+        del self._futures[name]
+        self._members[name] = db
+        for context in db:
+            self._sources.setdefault(context, name)
+        return True
+
+    def _load_all(self) -> None:
+        while self._load_next():
+            pass
+
+    def _find(self, context: str) -> Optional[str]:
+        # member holding context, loading members until it is found
+        while context not in self._sources and self._load_next():
+            pass
+        return self._sources.get(context)
+
+    def _index_sources(self) -> None:
+        self._sources = {}
+        for name, db in self._members.items():
+            for context in db:
+                self._sources.setdefault(context, name)
+
+    @property
+    def members(self) -> Dict[str, Database]:
+        """Member databases by name."""
+        self._load_all()
+        return dict(self._members)
+
+    @property
+    def sigvalid(self) -> Optional[bool]:
+        """Validity of OpenPGP signatures on member db files.
+
+        False if any member has an invalid signature, and None if
+        all members are new databases.
+
+        """
+        self._load_all()
+        valid = [db.sigvalid for db in self._members.values()]
+        if False in valid:
+            return False
+        if True in valid:
+            return True
+        return None
+
+    @property
+    def modified(self) -> bool:
+        """True if any member has changes that have not been saved."""
+        # members not loaded yet are unchanged
+        return any(db.modified for db in self._members.values())
+
+    def __str__(self) -> str:
+        return '<impass.DatabaseSet "%s">' % (self._dirpath or self._names)
+
+    def __repr__(self) -> str:
+        return "impass.DatabaseSet(%r)" % (self._dirpath or self._names)
+
+    def __getitem__(self, context: str) -> Dict[str, str]:
+        """Return database entry for exact context, as a new dict."""
+        return self.entry(context).to_dict(reveal=True)
+
+    def entry(self, context: str) -> Entry:
+        """Return the stored entry for exact context (see Database.entry())."""
+        name = self._find(context)
+        if name is None:
+            raise KeyError(context)
+        return self._members[name].entry(context)
+
+    def __contains__(self, context: str) -> bool:
+        """True if context string in any member database."""
+        return self._find(context) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterator of all contexts."""
+        self._load_all()
+        return iter(self._sources)
+
+    def __len__(self) -> int:
+        """Number of contexts in all member databases."""
+        self._load_all()
+        return len(self._sources)
+
+    def source(self, context: str) -> str:
+        """Name of the member database holding context."""
+        name = self._find(context)
+        if name is None:
+            raise DatabaseError("Context '%s' not found." % context)
+        return name
+
+    def _owner(self, context: str) -> Database:
+        return self._members[self.source(context)]
+
+    def add(
+        self,
+        context: str,
+        password: Optional[str] = None,
+        expires: Optional[str] = None,
+        source: Optional[str] = None,
+        fields: Optional[Mapping[str, str]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        """Add new entry to member database source.
+
+        If source is not specified the default member is used.  See
+        Database.add().
+
+        """
+        if context in self:
+            raise DatabaseError("Context already exists (see replace())")
+        if source is None:
+            source = self._default
+        if source is None:
+            if not self._names:
+                raise DatabaseError("No database to add the entry to.")
+            source = self._names[0]
+        if source not in self._names:
+            raise DatabaseError("Unknown database '%s'." % source)
+        entry = self._members[source].add(context, password, expires, fields, tags)
+        self._sources[context] = source
+        return entry
+
+    def replace(
+        self,
+        context: str,
+        password: Optional[str] = None,
+        expires: Optional[str] = None,
+        fields: Optional[Mapping[str, Optional[str]]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        """Replace entry password in its member database.
+
+        See Database.replace().
+
+        """
+        return self._owner(context).replace(context, password, expires, fields, tags)
+
+    def annotate(
+        self,
+        context: str,
+        fields: Optional[Mapping[str, Optional[str]]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        """Update entry fields and tags in its member database.
+
+        See Database.annotate().
+
+        """
+        return self._owner(context).annotate(context, fields, tags)
+
+    def update(self, old_context: str, new_context: str) -> None:
+        """Update entry context within its member database.
+
+        See Database.update().
+
+        """
+        if new_context in self:
+            raise DatabaseError("Context already exists (see replace())")
+        source = self.source(old_context)
+        self._members[source].update(old_context, new_context)
+        del self._sources[old_context]
+        self._sources[new_context] = source
+        self._restore_shadowed(old_context)
+
+    def remove(self, context: str) -> None:
+        """Remove entry from its member database."""
+        self._owner(context).remove(context)
+        del self._sources[context]
+        self._restore_shadowed(context)
+
+    def _restore_shadowed(self, context: str) -> None:
+        # a context removed from one member may still exist in another
+        self._load_all()
+        for name, db in self._members.items():
+            if context in db:
+                self._sources[context] = name
+                break
+
+    def rotate(
+        self,
+        contexts: Iterable[str],
+        nbytes: int = DEFAULT_NEW_PASSWORD_OCTETS,
+        passwords: Optional[Mapping[str, str]] = None,
+    ) -> Dict[str, Dict[str, str]]:
+        """Replace the passwords of many entries, in their member databases.
+
+        See Database.rotate().
+
+        """
+        bysource: Dict[str, List[str]] = {}
+        for context in contexts:
+            bysource.setdefault(self.source(context), []).append(context)
+        rotated: Dict[str, Dict[str, str]] = {}
+        for name, group in bysource.items():
+            rotated.update(self._members[name].rotate(group, nbytes, passwords))
+        return rotated
+
+    def refresh(self) -> List[str]:
+        """Reload member databases saved by someone else.
+
+        See Database.refresh().  Database files added to the directory
+        since the set was opened are not picked up, and members not
+        loaded yet are loaded as they are on first use.
+
+        """
+        changed: List[str] = []
+        for db in self._members.values():
+            changed += db.refresh()
+        if changed:
+            self._index_sources()
+        return sorted(set(changed))
+
+    def save(self, keyid: Optional[str] = None, version: Optional[int] = None) -> None:
+        """Save modified member databases.
+
+        Unmodified members are not re-encrypted, unless they are to be
+        converted to another format version (see Database.save()).
+
+        """
+        if version is not None:
+            self._load_all()
+        for db in self._members.values():
+            if db.modified or (version is not None and db.version != version):
+                db.save(keyid, version=version)
+
+    def search(
+        self,
+        string: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        tags: Iterable[str] = (),
+        fields: Optional[Mapping[str, str]] = None,
+    ) -> SearchResult:
+        """Search for string in contexts of all member databases.
+
+        If query is None, all entries will be returned.  Use source()
+        to find the member database of a result.  See
+        Database.search().
+
+        """
+        tags = list(tags)
+        self._load_all()
+        candidates = None
+        if tags or fields:
+            candidates = sorted(
+                context
+                for name, db in self._members.items()
+                for context in db._select(tags, fields)
+                if self._sources.get(context) == name
+            )
+        return SearchResult(self, string, offset, limit, candidates)
+
+    def date_range(
+        self,
+        field: str = "date",
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+    ) -> List[str]:
+        """Return contexts whose date field is in the range [start, end).
+
+        See Database.date_range().  Contexts are ordered by member
+        database, then by date.
+
+        """
+        self._load_all()
+        contexts = []
+        for name, db in self._members.items():
+            for context in db.date_range(field, start, end):
+                if self._sources.get(context) == name:
+                    contexts.append(context)
+        return contexts
@@ -1,16 +1,23 @@
 from __future__ import annotations
 
 import os
+import sys
 import gi  # type: ignore
 
-from typing import Any, Optional, Dict, Callable
+from typing import Any, Optional, Callable, Dict, List, Union
 
-from .db import pwgen, DEFAULT_NEW_PASSWORD_OCTETS, Database
+from .db import Database, DatabaseError
+from .crypto import CryptoError
+from .dbset import DatabaseSet
+from .history import History
+from .policy import PasswordStats, PolicyError, PolicySet
+from .watch import DatabaseWatcher
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk  # type: ignore # noqa: E402
 from gi.repository import GObject  # noqa: E402
 from gi.repository import Gdk  # noqa: E402
+from gi.repository import GLib  # noqa: E402
 
 
 ############################################################
@@ -337,7 +344,15 @@ _gui_layout = """<?xml version="1.0" encoding="UTF-8"?>
 class Gui:
     """Impass X-based query UI."""
 
-    def __init__(self, db: Database, query: Optional[str] = None) -> None:
+    def __init__(
+        self,
+        db: Union[Database, DatabaseSet],
+        query: Optional[str] = None,
+        history: Optional[History] = None,
+        preseed: Optional[List[str]] = None,
+        preseed_emit: bool = False,
+        policies: Optional[PolicySet] = None,
+    ) -> None:
         """
         +--------------------- warning --------------------+
         |                    notification                  |
@@ -358,7 +373,10 @@ class Gui:
         +-----------+------------------------+-------------+
         """
         self.db = db
+        self.history = history
+        self.policies = policies or PolicySet()
         self.selected: Optional[Dict[str, str]] = None
+        self.selected_context: Optional[str] = None
         self.window: Gtk.Widget
         self.entry: Gtk.Widget
         self.label: Gtk.Widget
@@ -375,9 +393,18 @@ class Gui:
             # there are none).  Since we don't need to initialize any
             # GUI, return the initialization immediately.
             # See .returnValue().
-            if len(r) == 1:
-                self.selected = r[list(r.keys())[0]]
+            # The search stops at the second match.
+            matches = list(r.limit(2))
+            if len(matches) == 1:
+                self.selected_context = matches[0]
+                self.selected = r[self.selected_context]
                 return
+        elif preseed and preseed_emit and len(preseed) == 1 and preseed[0] in self.db:
+            # Likewise for a single context guessed from the target
+            # window, if so requested.
+            self.selected_context = preseed[0]
+            self.selected = self.db[self.selected_context]
+            return
 
         self.builder: Gtk.Builder = Gtk.Builder.new_from_string(
             _gui_layout, len(_gui_layout)
@@ -410,10 +437,44 @@ class Gui:
         completion.set_text_column(0)
         completion.set_match_func(_match_func, 0)  # 0 is column number
         context_len = 50
-        for context in sorted(filter(lambda x: x == x.strip(), self.db), key=str.lower):
+        contexts = [c for c in self.db if c == c.strip()]
+        ordered: Optional[List[str]] = None
+        if self.history is not None:
+            # most frequently and recently used contexts first
+            try:
+                ordered = self.history.rank(contexts)
+            except (CryptoError, DatabaseError) as e:
+                print(
+                    "WARNING: could not read context history: {}".format(e),
+                    file=sys.stderr,
+                )
+        if ordered is None:
+            ordered = sorted(contexts, key=str.lower)
+        if preseed:
+            # contexts guessed from the target window first
+            first = [c for c in preseed if c in self.db and c == c.strip()]
+            seen = set(first)
+            ordered = first + [c for c in ordered if c not in seen]
+        for context in ordered:
             if len(context) > context_len:
                 context_len = len(context)
             liststore.append([context])
+        self.liststore = liststore
+
+        # follow saves by other processes while waiting for input
+        self.watcher: Optional[DatabaseWatcher]
+        try:
+            self.watcher = DatabaseWatcher(self.db)
+        except OSError:
+            self.watcher = None
+        else:
+            GLib.io_add_watch(
+                self.watcher.fileno(),
+                GLib.PRIORITY_DEFAULT,
+                GLib.IO_IN,
+                self.db_changed,
+            )
+
         self.window.connect("destroy", self.destroy)
         self.window.connect("key-press-event", self.keypress)
         self.entry.connect("activate", self.simpleclicked)
@@ -436,10 +497,37 @@ class Gui:
 
         if query:
             self.entry.set_text(query)
+        elif preseed:
+            # pre-selected, so that typing replaces the guess
+            self.entry.set_text(preseed[0])
+            self.entry.select_region(0, -1)
         self.set_state("Enter context for desired password:")
         self.update_simple_context_entry(None)
         self.window.show()
 
+    def db_changed(self, fd: int, condition: int) -> bool:
+        assert self.watcher is not None
+        try:
+            changed = self.watcher.poll()
+        except (CryptoError, DatabaseError) as e:
+            self.set_state("Could not reload database: {}".format(e))
+            return True
+        if changed:
+            self.refresh_completions(changed)
+            self.update_simple_context_entry(None)
+        return True
+
+    def refresh_completions(self, changed: List[str]) -> None:
+        removed = [row.iter for row in self.liststore if row[0] not in self.db]
+        for it in removed:
+            self.liststore.remove(it)
+        listed = {row[0] for row in self.liststore}
+        for context in changed:
+            if context in listed or context not in self.db:
+                continue
+            if context == context.strip():
+                self.liststore.append([context])
+
     def set_state(self, state: str) -> None:
         self.builder.get_object("description").set_label(state)
 
@@ -502,6 +590,7 @@ class Gui:
         sctx = self.entry.get_text().strip()
         if sctx in self.db:
             self.selected = self.db[sctx]
+            self.selected_context = sctx
             if self.selected is None:
                 self.label.set_text(
                     "weird -- no context found even though there should be one"
@@ -519,7 +608,8 @@ class Gui:
 
     def create(self, widget: Gtk.Widget, data: Optional[Any] = None) -> None:
         sctx = self.entry.get_text().strip()
-        self.selected = self.db.add(sctx)
+        self.selected = self.db.add(sctx, password=self.newpassword(sctx))
+        self.selected_context = sctx
         self.db.save()
         Gtk.main_quit()
 
@@ -537,6 +627,7 @@ class Gui:
         confirmation.destroy()
         if answer == Gtk.ResponseType.OK:
             self.selected = None
+            self.selected_context = None
             self.db.remove(sctx)
             self.db.save()
             Gtk.main_quit()
@@ -578,19 +669,8 @@ class Gui:
     ) -> None:
         newpass = self.passentry.get_text()
         sctx = self.ctxentry.get_text().strip()
-        ln = len(newpass)
         # FIXME: should check (and warn) for non-ascii characters
-        lcount = len("".join(filter(lambda x: x.islower(), newpass)))
-        ucount = len("".join(filter(lambda x: x.isupper(), newpass)))
-        ncount = len("".join(filter(lambda x: x.isnumeric(), newpass)))
-        ocount = ln - (lcount + ucount + ncount)
-        desc = "%d characters (%d lowercase, %d uppercase, %d number, %d other)" % (
-            ln,
-            lcount,
-            ucount,
-            ncount,
-            ocount,
-        )
+        desc = str(PasswordStats(newpass))
         self.createbtn.set_sensitive(
             newpass != "" and sctx != "" and sctx not in self.db
         )
@@ -629,15 +709,21 @@ class Gui:
         sep.show()
         widget.insert(sep, 2)
 
+    def newpassword(self, context: str) -> str:
+        spec = os.environ.get("IMPASS_PASSWORD")
+        if spec in ["prompt", ":"]:
+            spec = None
+        try:
+            return self.policies.select(context, spec).generate()[0]
+        except PolicyError:
+            # fall back to base64 passwords on a bad IMPASS_PASSWORD
+            # or a missing word list
+            return self.policies.get("base64").generate()[0]
+
     def refreshpass(
         self, widget: Optional[Gtk.Widget] = None, event: Optional[Gdk.Event] = None
     ) -> None:
-        pwsize = os.environ.get("IMPASS_PASSWORD", DEFAULT_NEW_PASSWORD_OCTETS)
-        try:
-            pwsize = int(pwsize)
-        except ValueError:
-            pwsize = DEFAULT_NEW_PASSWORD_OCTETS
-        newpw = pwgen(pwsize)
+        newpw = self.newpassword(self.ctxentry.get_text().strip())
         self.passentry.set_text(newpw)
         # FIXME: should refocus self.passentry?
 
@@ -650,10 +736,13 @@ class Gui:
             # this button is not supposed to work under these conditions
             return
         self.selected = self.db.add(newctx, password=newpass)
+        self.selected_context = newctx
         self.db.save()
         Gtk.main_quit()
 
     def destroy(self, widget: Gtk.Widget, data: Optional[Any] = None) -> None:
+        if self.watcher is not None:
+            self.watcher.close()
         Gtk.main_quit()
 
     def return_value(self) -> Optional[Dict[str, str]]:
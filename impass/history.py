@@ -0,0 +1,135 @@
+import io
+import os
+import json
+import time
+
+from typing import Optional, Dict, List, Iterable
+
+from .db import EncryptedStore, DatabaseError
+from .crypto import Backend
+
+############################################################
+
+# usage counts lose half their weight after this many seconds
+HISTORY_HALF_LIFE = 30 * 24 * 3600
+# maximum number of contexts remembered
+HISTORY_MAX_CONTEXTS = 500
+
+
+class History(EncryptedStore):
+    """Encrypted record of context usage, for frecency ranking.
+
+    For every used context a decaying usage score and the time of
+    last use are kept.  The history file is only decrypted the first
+    time it is needed.
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        keyid: Optional[str] = None,
+        backend: Optional[Backend] = None,
+    ) -> None:
+        super().__init__(keyid, backend)
+        self._path = path
+        self._type = "impass-history"
+        self._version = 1
+        self._contexts: Optional[Dict[str, List[float]]] = None
+
+    def __str__(self) -> str:
+        return '<impass.History "%s">' % (self._path)
+
+    def __repr__(self) -> str:
+        return 'impass.History("%s")' % (self._path)
+
+    def _load(self) -> Dict[str, List[float]]:
+        if self._contexts is not None:
+            return self._contexts
+        self._contexts = {}
+        if os.path.exists(self._path):
+            try:
+                cleardata = self._decrypt_db(self._path)
+                jsondata = json.loads(cleardata.decode("utf-8"))
+            except (IOError, ValueError) as e:
+                raise DatabaseError(str(e))
+            if jsondata.get("type") != self._type:
+                raise DatabaseError("History is not a proper impass history.")
+            if jsondata.get("version") != self._version:
+                raise DatabaseError("Incompatible history.")
+            self._contexts = jsondata["contexts"]
+        return self._contexts
+
+    def score(self, context: str, now: Optional[float] = None) -> float:
+        """Current usage score of context (0 if never used)."""
+        try:
+            score, last = self._load()[context]
+        except KeyError:
+            return 0.0
+        if now is None:
+            now = time.time()
+        return score * 0.5 ** (max(now - last, 0) / HISTORY_HALF_LIFE)
+
+    def record(self, context: str, now: Optional[float] = None) -> None:
+        """Record use of context.
+
+        History changes are not saved to disk until the save() method
+        is called.
+
+        """
+        if now is None:
+            now = time.time()
+        score = self.score(context, now)
+        self._load()[context] = [score + 1.0, now]
+
+    def rank(self, contexts: Iterable[str]) -> List[str]:
+        """Return contexts ordered by decreasing usage score.
+
+        Contexts with equal scores (e.g. never used ones) are ordered
+        alphabetically, ignoring case.
+
+        """
+        now = time.time()
+        return sorted(contexts, key=lambda c: (-self.score(c, now), c.lower()))
+
+    def save(self) -> None:
+        """Save history to disk.
+
+        Only the HISTORY_MAX_CONTEXTS contexts with the highest scores
+        are kept.
+
+        """
+        if self._contexts is None:
+            return
+        if not self._keyid:
+            raise DatabaseError("Key ID for encryption not specified.")
+        now = time.time()
+        if len(self._contexts) > HISTORY_MAX_CONTEXTS:
+            keep = sorted(self._contexts, key=lambda c: -self.score(c, now))
+            self._contexts = {
+                c: self._contexts[c] for c in keep[:HISTORY_MAX_CONTEXTS]
+            }
+        jsondata = {
+            "type": self._type,
+            "version": self._version,
+            "contexts": self._contexts,
+        }
+        cleardata = io.BytesIO(json.dumps(jsondata).encode("utf-8"))
+        self._write_file(self._path, self._encrypt_db(cleardata, self._keyid))
+
+    def rekey(self, keyid: str) -> bool:
+        """Re-encrypt the history file for keyid.
+
+        Returns False if there is no history file.  Files with invalid
+        signatures are not rekeyed.
+
+        """
+        if not os.path.exists(self._path):
+            return False
+        self._load()
+        if self._sigvalid is False:
+            raise DatabaseError("Invalid signature, not rekeying.")
+        self._keyid = keyid
+        self._resolved = None
+        self.save()
+        return True
@@ -0,0 +1,172 @@
+import re
+import functools
+
+from typing import Dict, FrozenSet, Iterable, List, Set, Tuple
+
+############################################################
+
+# hostnames, optionally as part of a URL or an email-like user@host
+_HOST_RE = re.compile(
+    r"(?<![\w.-])(?:[a-z][a-z0-9+.-]*://)?(?:[^\s/@]+@)?"
+    r"((?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,61}[a-z0-9])"
+    r"(?![\w-])",
+    re.IGNORECASE,
+)
+
+
+def hostnames(text: str) -> List[str]:
+    """Return the hostnames found in text, lower-cased, in order.
+
+    Hostnames are recognized on their own, in URLs, and after an "@"
+    (as in "user@example.com").
+
+    """
+    found: List[str] = []
+    for m in _HOST_RE.finditer(text):
+        host = m.group(1).lower().rstrip(".")
+        if host not in found:
+            found.append(host)
+    return found
+
+
+# public suffix list (https://publicsuffix.org/), as packaged by
+# distributions
+PUBLIC_SUFFIX_LIST = "/usr/share/publicsuffix/public_suffix_list.dat"
+
+# common public suffixes of more than one label, used if the public
+# suffix list is not installed
+_KNOWN_SUFFIXES = """
+ac.uk co.uk gov.uk ltd.uk me.uk net.uk org.uk plc.uk sch.uk
+com.au net.au org.au edu.au gov.au co.nz net.nz org.nz
+co.jp ne.jp or.jp ac.jp go.jp co.kr or.kr com.cn net.cn org.cn
+com.hk com.tw com.sg com.my co.in net.in org.in co.id co.th
+com.br net.br org.br com.ar com.mx co.za org.za com.tr com.ua
+github.io gitlab.io pages.dev netlify.app vercel.app herokuapp.com
+blogspot.com appspot.com web.app firebaseapp.com azurewebsites.net
+cloudfront.net s3.amazonaws.com workers.dev glitch.me
+""".split()
+
+
+@functools.lru_cache(maxsize=None)
+def _public_suffixes() -> Tuple[FrozenSet[str], FrozenSet[str], FrozenSet[str]]:
+    # rules, wildcard rules (without "*.") and exception rules
+    # (without "!") of the public suffix list
+    try:
+        with open(PUBLIC_SUFFIX_LIST, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return frozenset(_KNOWN_SUFFIXES), frozenset(), frozenset()
+    rules, wildcards, exceptions = set(), set(), set()
+    for line in lines:
+        rule = line.strip().split(" ", 1)[0].lower()
+        if not rule or rule.startswith("//"):
+            continue
+        if rule.startswith("!"):
+            exceptions.add(rule[1:])
+        elif rule.startswith("*."):
+            wildcards.add(rule[2:])
+        else:
+            rules.add(rule)
+    return frozenset(rules), frozenset(wildcards), frozenset(exceptions)
+
+
+def is_public_suffix(domain: str) -> bool:
+    """True if domain is a public suffix (e.g. "com", "co.uk", "github.io").
+
+    Domains under a public suffix are registered by unrelated parties,
+    so they must never be matched with each other.  Single labels are
+    always public suffixes.
+
+    """
+    domain = domain.lower()
+    if "." not in domain:
+        return True
+    rules, wildcards, exceptions = _public_suffixes()
+    if domain in exceptions:
+        return False
+    return domain in rules or domain.split(".", 1)[1] in wildcards
+
+
+def domain_suffixes(host: str) -> List[str]:
+    """Return host and its parent domains, most specific first.
+
+    Public suffixes are not included, so "www.example.co.uk" yields
+    ["www.example.co.uk", "example.co.uk"].
+
+    """
+    labels = host.lower().split(".")
+    suffixes = []
+    for i in range(len(labels)):
+        domain = ".".join(labels[i:])
+        if is_public_suffix(domain):
+            break
+        suffixes.append(domain)
+    return suffixes
+
+
+class HostIndex:
+    """Index from hostnames to contexts.
+
+    Every hostname appearing in a context is indexed.  A lookup for a
+    host matches the contexts for that host and for its parent
+    domains, but never contexts for sibling or child hosts, nor for
+    public suffixes: "login.example.com" matches "example.com", but
+    "example.com" and "www.example.com" do not match
+    "login.example.com".
+
+    """
+
+    def __init__(self, contexts: Iterable[str] = ()) -> None:
+        self._index: Dict[str, Set[str]] = {}
+        for context in contexts:
+            self.add(context)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _hosts(self, context: str) -> List[str]:
+        return [h for h in hostnames(context) if not is_public_suffix(h)]
+
+    def add(self, context: str) -> None:
+        """Add context to the index."""
+        for host in self._hosts(context):
+            self._index.setdefault(host, set()).add(context)
+
+    def discard(self, context: str) -> None:
+        """Remove context from the index, if present."""
+        for host in self._hosts(context):
+            contexts = self._index.get(host)
+            if contexts is None:
+                continue
+            contexts.discard(context)
+            if not contexts:
+                del self._index[host]
+
+    def lookup(self, host: str, exact: bool = False) -> List[str]:
+        """Return contexts matching host, best matches first.
+
+        Contexts for host itself come first, then those for its
+        parent domains, most specific first (e.g. "login.example.com"
+        before "example.com"); ties are ordered alphabetically,
+        ignoring case.  If exact is True, only contexts for host
+        itself are returned.
+
+        """
+        suffixes = domain_suffixes(host)
+        if exact:
+            suffixes = suffixes[:1]
+        result: List[str] = []
+        seen: Set[str] = set()
+        for suffix in suffixes:
+            matches = self._index.get(suffix, set()) - seen
+            result.extend(sorted(matches, key=str.lower))
+            seen |= matches
+        return result
+
+    def lookup_text(self, text: str, exact: bool = False) -> List[str]:
+        """Return contexts matching the first hostname in text that has any."""
+        for host in hostnames(text):
+            matches = self.lookup(host, exact)
+            if matches:
+                return matches
+        return []
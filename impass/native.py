@@ -0,0 +1,171 @@
+import json
+import struct
+import urllib.parse
+
+from typing import Any, BinaryIO, Dict, List, Optional, Union
+
+from .db import Database, DatabaseError
+from .crypto import CryptoError
+from .dbset import DatabaseSet
+from .hosts import HostIndex, hostnames
+from .version import __version__
+from .watch import DatabaseWatcher
+
+############################################################
+
+# WebExtension native messaging: each message is UTF-8 JSON preceded
+# by its length as a 32-bit unsigned integer in native byte order
+_LENGTH = struct.Struct("=I")
+# largest message a browser accepts from a native host
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+
+class ProtocolError(Exception):
+    def __init__(self, msg: str) -> None:
+        self.msg = msg
+
+    def __str__(self) -> str:
+        return self.msg
+
+
+def _read_exactly(stream: BinaryIO, n: int) -> bytes:
+    data = b""
+    while len(data) < n:
+        chunk = stream.read(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_message(stream: BinaryIO) -> Optional[Any]:
+    """Read one native message, None at end of input."""
+    head = _read_exactly(stream, _LENGTH.size)
+    if not head:
+        return None
+    if len(head) < _LENGTH.size:
+        raise ProtocolError("Truncated message length.")
+    (length,) = _LENGTH.unpack(head)
+    data = _read_exactly(stream, length)
+    if len(data) < length:
+        raise ProtocolError("Truncated message.")
+    try:
+        return json.loads(data.decode("utf-8"))
+    except ValueError as e:
+        raise ProtocolError("Invalid message: {}".format(e))
+
+
+def write_message(stream: BinaryIO, message: Any) -> None:
+    """Write one native message."""
+    data = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    if len(data) > MAX_MESSAGE_SIZE:
+        raise ProtocolError("Message too large ({} bytes).".format(len(data)))
+    stream.write(_LENGTH.pack(len(data)) + data)
+    stream.flush()
+
+
+class NativeHost:
+    """Answer native messaging requests from a browser extension.
+
+    The database is decrypted once and kept for the whole browser
+    session, with an index of the hostnames in its contexts; saves by
+    other processes are picked up before answering.  Requests are JSON
+    objects with a "type", and an optional "id" which is copied to the
+    response:
+
+      {"type": "ping"} -> {"version": VERSION}
+      {"type": "lookup", "urls": [URL, ...]}
+          -> {"results": {URL: [CONTEXT, ...], ...}}
+      {"type": "get", "context": CONTEXT}
+          -> {"context": CONTEXT, "password": PASSWORD, "fields": {...}}
+
+    Lookups take many URLs (or page titles) at once, and match the
+    host of each URL (or the first hostname in a title) on the
+    hostnames in contexts, best matches first; only contexts for the
+    host itself or its parent domains match (see HostIndex.lookup()).
+    Failed requests are answered with {"error": MESSAGE}.
+
+    """
+
+    def __init__(self, db: Union[Database, DatabaseSet]) -> None:
+        self.db = db
+        self.index = HostIndex(db)
+        self._watcher: Optional[DatabaseWatcher]
+        try:
+            self._watcher = DatabaseWatcher(db)
+        except OSError:
+            self._watcher = None
+
+    def close(self) -> None:
+        if self._watcher is not None:
+            self._watcher.close()
+
+    def _refresh(self) -> None:
+        if self._watcher is not None:
+            changed = self._watcher.poll()
+        else:
+            changed = self.db.refresh()
+        for context in changed:
+            self.index.discard(context)
+            if context in self.db:
+                self.index.add(context)
+
+    def lookup(self, urls: List[str]) -> Dict[str, List[str]]:
+        return {url: self._lookup(url) for url in urls}
+
+    def _lookup(self, url: str) -> List[str]:
+        # only the host of the page is matched, never hostnames found
+        # elsewhere in the URL (e.g. in its query string)
+        if "://" in url:
+            host = urllib.parse.urlsplit(url).hostname or ""
+        else:
+            found = hostnames(url)
+            host = found[0] if found else ""
+        return self.index.lookup(host) if host else []
+
+    def handle(self, request: Any) -> Dict[str, Any]:
+        """Return the response to one request."""
+        if not isinstance(request, dict):
+            return {"error": "Request is not an object."}
+        response: Dict[str, Any] = {}
+        kind = request.get("type")
+        try:
+            self._refresh()
+            if kind == "ping":
+                response["version"] = __version__
+            elif kind == "lookup":
+                urls = request.get("urls")
+                if not isinstance(urls, list) or not all(
+                    isinstance(u, str) for u in urls
+                ):
+                    raise ProtocolError("'urls' must be a list of strings.")
+                response["results"] = self.lookup(urls)
+            elif kind == "get":
+                context = request.get("context")
+                if not isinstance(context, str) or context not in self.db:
+                    raise ProtocolError("Context not found.")
+                entry = self.db.entry(context)
+                response["context"] = context
+                response["password"] = entry["password"]
+                response["fields"] = entry.fields
+            else:
+                raise ProtocolError("Unknown request type {!r}.".format(kind))
+        except (ProtocolError, CryptoError) as e:
+            response = {"error": str(e)}
+        except DatabaseError as e:
+            response = {"error": e.msg}
+        if "id" in request:
+            response["id"] = request["id"]
+        return response
+
+    def serve(self, instream: BinaryIO, outstream: BinaryIO) -> None:
+        """Answer requests until the browser closes the input."""
+        while True:
+            request = read_message(instream)
+            if request is None:
+                return
+            response = self.handle(request)
+            try:
+                write_message(outstream, response)
+            except ProtocolError as e:
+                write_message(outstream, {"id": response.get("id"), "error": str(e)})
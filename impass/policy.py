@@ -0,0 +1,374 @@
+import os
+import math
+import mmap
+import array
+import string
+import fnmatch
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .db import DEFAULT_NEW_PASSWORD_OCTETS, pwgen_batch
+
+############################################################
+
+# character classes of "chars" policies
+CLASSES = {
+    "lower": string.ascii_lowercase,
+    "upper": string.ascii_uppercase,
+    "digits": string.digits,
+    "symbols": string.punctuation,
+}
+
+# word list of diceware policies, unless the policy names one
+DEFAULT_WORDLIST = "/usr/share/dict/words"
+
+POLICY_KINDS = ("base64", "chars", "diceware")
+
+# extra random bits drawn per password, so that reducing them to
+# characters or words is unbiased in practice
+_EXTRA_BITS = 64
+
+
+class PolicyError(Exception):
+    def __init__(self, msg: str) -> None:
+        self.msg = msg
+
+    def __str__(self) -> str:
+        return self.msg
+
+
+class WordList:
+    """Word list for diceware passwords, one word per line.
+
+    The file is memory-mapped, and only the offsets of the lines are
+    kept, so words are only decoded when they are picked.  Lines
+    starting with dice numbers (as in the EFF lists) are accepted,
+    the word being the last field of the line.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    raise PolicyError("Word list {} is empty.".format(path))
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as e:
+            raise PolicyError("Could not read word list: {}".format(e))
+        # start offsets of the non-empty lines, and the end of the file
+        self._starts = array.array("Q")
+        pos = 0
+        size = len(self._mm)
+        while pos < size:
+            end = self._mm.find(b"\n", pos)
+            if end < 0:
+                end = size
+            if self._mm[pos:end].strip():
+                self._starts.append(pos)
+            pos = end + 1
+        if not self._starts:
+            raise PolicyError("Word list {} is empty.".format(path))
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, i: int) -> str:
+        start = self._starts[i]
+        end = self._mm.find(b"\n", start)
+        line = self._mm[start : len(self._mm) if end < 0 else end]
+        return line.decode("utf-8", "replace").split()[-1]
+
+
+def _draw(data: bytes, n: int, k: int) -> List[int]:
+    # k numbers below n from random data
+    x = int.from_bytes(data, "little")
+    out = []
+    for _ in range(k):
+        x, r = divmod(x, n)
+        out.append(r)
+    return out
+
+
+class Policy:
+    """Password generation policy.
+
+    Policies are of one of three kinds:
+
+      base64    length random octets, base64-encoded (the default)
+      chars     length characters from character classes (CLASSES)
+      diceware  length words from a word list, joined by separator
+
+    Passwords are generated in batches from a single read of random
+    data.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        kind: str = "base64",
+        length: int = DEFAULT_NEW_PASSWORD_OCTETS,
+        classes: Iterable[str] = ("lower", "upper", "digits"),
+        words: Optional[str] = None,
+        separator: str = "-",
+    ) -> None:
+        if kind not in POLICY_KINDS:
+            raise PolicyError("Unknown policy kind '{}'.".format(kind))
+        if length < 1:
+            raise PolicyError("Invalid policy length {}.".format(length))
+        self.name = name
+        self.kind = kind
+        self.length = length
+        self.classes = tuple(dict.fromkeys(classes))
+        for c in self.classes:
+            if c not in CLASSES:
+                raise PolicyError("Unknown character class '{}'.".format(c))
+        if kind == "chars" and not self.classes:
+            raise PolicyError("Policy '{}' has no character classes.".format(name))
+        self.alphabet = "".join(CLASSES[c] for c in self.classes)
+        self.words = words
+        self.separator = separator
+        self._wordlist: Optional[WordList] = None
+
+    @classmethod
+    def parse(cls, name: str, kind: str, options: Iterable[str]) -> "Policy":
+        """Policy from its kind and OPTION=VALUE options (as in policy files)."""
+        kwargs: Dict[str, object] = {}
+        for option in options:
+            key, sep, value = option.partition("=")
+            if not sep:
+                raise PolicyError("Invalid policy option '{}'.".format(option))
+            if key == "length":
+                try:
+                    kwargs[key] = int(value)
+                except ValueError:
+                    raise PolicyError("Invalid policy length '{}'.".format(value))
+            elif key == "classes":
+                kwargs[key] = [c for c in value.split(",") if c]
+            elif key in ("words", "separator"):
+                kwargs[key] = value
+            else:
+                raise PolicyError("Unknown policy option '{}'.".format(key))
+        return cls(name, kind, **kwargs)  # type: ignore
+
+    def __repr__(self) -> str:
+        return "<impass.policy.Policy %s: %s %d>" % (self.name, self.kind, self.length)
+
+    def with_length(self, length: int) -> "Policy":
+        """The same policy, for another length."""
+        policy = Policy(
+            self.name, self.kind, length, self.classes, self.words, self.separator
+        )
+        # share the word list, rather than mapping it again
+        policy._wordlist = self._wordlist
+        return policy
+
+    def wordlist(self) -> WordList:
+        if self._wordlist is None:
+            self._wordlist = WordList(
+                self.words or os.getenv("IMPASS_WORDLIST") or DEFAULT_WORDLIST
+            )
+        return self._wordlist
+
+    def _choices(self) -> int:
+        # number of characters or words to choose from
+        if self.kind == "chars":
+            return len(self.alphabet)
+        return len(self.wordlist())
+
+    @property
+    def entropy(self) -> float:
+        """Bits of entropy of the generated passwords."""
+        if self.kind == "base64":
+            return 8.0 * self.length
+        return self.length * math.log2(self._choices())
+
+    def generate(self, count: int = 1) -> List[str]:
+        """Return count new passwords."""
+        if self.kind == "base64":
+            return pwgen_batch(count, self.length)
+        n = self._choices()
+        size = (math.ceil(self.length * math.log2(n)) + _EXTRA_BITS + 7) // 8
+        data = os.urandom(count * size)
+        passwords = []
+        for i in range(0, count * size, size):
+            picks = _draw(data[i : i + size], n, self.length)
+            if self.kind == "chars":
+                passwords.append("".join(self.alphabet[p] for p in picks))
+            else:
+                words = self.wordlist()
+                passwords.append(self.separator.join(words[p] for p in picks))
+        return passwords
+
+
+# built-in policies
+POLICIES = {
+    p.name: p
+    for p in [
+        Policy("base64"),
+        Policy("alnum", "chars", 20),
+        Policy("ascii", "chars", 20, ["lower", "upper", "digits", "symbols"]),
+        Policy("pin", "chars", 6, ["digits"]),
+        Policy("diceware", "diceware", 6),
+    ]
+}
+
+
+class PolicySet:
+    """Named password policies, and per-site rules to choose them.
+
+    Besides the built-in POLICIES, policies can be defined in a text
+    file, with rules choosing the policy for a context by glob
+    pattern (the first match wins):
+
+      # name   kind     options
+      policy   work     chars length=16 classes=lower,upper,digits,symbols
+      policy   phrase   diceware length=5 words=/usr/share/dict/words
+      site     *.bank.example.com  pin
+      site     *@work.example.com  work
+      default  phrase
+
+    Policies are referred to as NAME, or NAME:LENGTH for another
+    length; a plain number N is the base64 policy of N octets.
+
+    """
+
+    def __init__(
+        self,
+        policies: Optional[Dict[str, Policy]] = None,
+        rules: Sequence[Tuple[str, str]] = (),
+        default: str = "base64",
+    ) -> None:
+        self.policies = dict(POLICIES)
+        self.policies.update(policies or {})
+        self.rules = list(rules)
+        self.default = default
+        for _, name in [*self.rules, ("", default)]:
+            if name not in self.policies:
+                raise PolicyError("Unknown password policy '{}'.".format(name))
+
+    @classmethod
+    def load(cls, path: str) -> "PolicySet":
+        """Read a policy file."""
+        policies: Dict[str, Policy] = {}
+        rules: List[Tuple[str, str]] = []
+        default = "base64"
+        try:
+            with open(path, "r") as f:
+                lines = f.read().splitlines()
+        except OSError as e:
+            raise PolicyError("Could not read password policies: {}".format(e))
+        for n, line in enumerate(lines, 1):
+            words = line.split("#", 1)[0].split()
+            try:
+                if not words:
+                    continue
+                elif words[0] == "policy" and len(words) >= 3:
+                    policies[words[1]] = Policy.parse(words[1], words[2], words[3:])
+                elif words[0] == "site" and len(words) == 3:
+                    rules.append((words[1], words[2]))
+                elif words[0] == "default" and len(words) == 2:
+                    default = words[1]
+                else:
+                    raise PolicyError("invalid policy line.")
+            except PolicyError as e:
+                raise PolicyError("{}:{}: {}".format(path, n, e))
+        return cls(policies, rules, default)
+
+    def get(self, spec: str) -> Policy:
+        """Policy for NAME, NAME:LENGTH or a number of base64 octets."""
+        name, sep, length = spec.partition(":")
+        if name.isdigit() and not sep:
+            name, length = "base64", name
+        try:
+            policy = self.policies[name]
+        except KeyError:
+            raise PolicyError("Unknown password policy '{}'.".format(name))
+        if length:
+            try:
+                policy = policy.with_length(int(length))
+            except ValueError:
+                raise PolicyError("Invalid policy length '{}'.".format(length))
+        return policy
+
+    def for_context(self, context: str) -> Policy:
+        """Policy of the first rule matching context, or the default."""
+        for pattern, name in self.rules:
+            if fnmatch.fnmatch(context.lower(), pattern.lower()):
+                return self.policies[name]
+        return self.policies[self.default]
+
+    def select(self, context: str = "", spec: Optional[str] = None) -> Policy:
+        """Policy given by spec if any, else the one for context."""
+        if spec:
+            return self.get(spec)
+        return self.for_context(context)
+
+    def generate(
+        self, contexts: Iterable[str], spec: Optional[str] = None
+    ) -> Dict[str, str]:
+        """New passwords for contexts, one batch per policy."""
+        # resolve spec once: get() builds a new policy for NAME:LENGTH
+        fixed = self.get(spec) if spec else None
+        groups: Dict[int, Tuple[Policy, List[str]]] = {}
+        for context in contexts:
+            policy = fixed or self.for_context(context)
+            groups.setdefault(id(policy), (policy, []))[1].append(context)
+        passwords = {}
+        for policy, group in groups.values():
+            passwords.update(zip(group, policy.generate(len(group))))
+        return passwords
+
+
+############################################################
+
+# size of the character pool of each class, for entropy estimates
+_POOLS = {"lower": 26, "upper": 26, "digits": 10, "other": 33}
+
+
+class PasswordStats:
+    """Character class counts of a password, and an entropy estimate."""
+
+    __slots__ = ("length", "lower", "upper", "digits", "other")
+
+    def __init__(self, password: str) -> None:
+        lower = upper = digits = other = 0
+        for c in password:
+            if c.islower():
+                lower += 1
+            elif c.isupper():
+                upper += 1
+            elif c.isnumeric():
+                digits += 1
+            else:
+                other += 1
+        self.length = len(password)
+        self.lower = lower
+        self.upper = upper
+        self.digits = digits
+        self.other = other
+
+    @property
+    def entropy(self) -> float:
+        """Entropy in bits, if each character were random from its classes.
+
+        This is an upper bound for passwords that were not generated.
+
+        """
+        pool = sum(size for c, size in _POOLS.items() if getattr(self, c))
+        return self.length * math.log2(pool) if pool else 0.0
+
+    def __str__(self) -> str:
+        return (
+            "%d characters (%d lowercase, %d uppercase, %d number, %d other), "
+            "~%d bits"
+            % (
+                self.length,
+                self.lower,
+                self.upper,
+                self.digits,
+                self.other,
+                self.entropy,
+            )
+        )
@@ -0,0 +1,73 @@
+import os
+import time
+import concurrent.futures
+
+from typing import Iterable, List, Optional
+
+from .crypto import get_backend
+from .db import rekey_database
+
+############################################################
+
+
+class RekeyResult:
+    """Outcome of rekeying one database file."""
+
+    def __init__(self, path: str, size: int, seconds: float) -> None:
+        self.path = path
+        # cleartext bytes re-encrypted
+        self.size = size
+        self.seconds = seconds
+
+    def __str__(self) -> str:
+        return "%s: %d bytes in %.3fs (%s)" % (
+            self.path,
+            self.size,
+            self.seconds,
+            throughput(self.size, self.seconds),
+        )
+
+
+def throughput(size: int, seconds: float) -> str:
+    """Human readable rate of size bytes in seconds."""
+    rate = size / seconds if seconds > 0 else 0.0
+    for unit in ("B/s", "kB/s", "MB/s"):
+        if rate < 1000:
+            break
+        rate /= 1000
+    return "%.1f %s" % (rate, unit)
+
+
+def _rekey_one(path: str, keyid: str, backend: Optional[str]) -> RekeyResult:
+    # run in a worker process; backends can not be passed between
+    # processes, so each worker makes its own
+    start = time.perf_counter()
+    size = rekey_database(path, keyid, get_backend(backend))
+    return RekeyResult(path, size, time.perf_counter() - start)
+
+
+def rekey(
+    paths: Iterable[str],
+    keyid: str,
+    backend: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> List[RekeyResult]:
+    """Re-encrypt the database files at paths for keyid.
+
+    Each file is rekeyed with impass.db.rekey_database().  Files are
+    rekeyed in parallel, by a pool of max_workers processes (one per
+    CPU by default), each running its own crypto backend (named as
+    for impass.crypto.get_backend()).  The results are in the order
+    of paths.  If a file can not be rekeyed, the DatabaseError is
+    raised once the other files are done; files already rekeyed stay
+    rekeyed.
+
+    """
+    paths = list(paths)
+    if len(paths) <= 1 or max_workers == 1:
+        return [_rekey_one(path, keyid, backend) for path in paths]
+    workers = min(len(paths), max_workers or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_rekey_one, path, keyid, backend) for path in paths]
+        concurrent.futures.wait(futures)
+    return [f.result() for f in futures]
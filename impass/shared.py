@@ -0,0 +1,389 @@
+import types
+import datetime
+import threading
+import contextlib
+
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from .crypto import Backend, RecipientSet, get_backend
+from .db import (
+    DEFAULT_NEW_PASSWORD_OCTETS,
+    Database,
+    Entry,
+    SearchResult,
+    _StoredIndices,
+)
+
+############################################################
+
+
+class _RWLock:
+    """Reader-writer lock, preferring writers.
+
+    Any number of threads can read at once; a writer waits for the
+    readers to finish and excludes everyone else.  While a writer
+    waits, new readers wait too, so that a steady stream of readers
+    cannot starve writers.  A reading thread may take the lock again
+    for reading, and the writing thread may take it again for reading
+    or writing.
+
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition(threading.Lock())
+        # reading depth, by thread
+        self._readers: Dict[int, int] = {}
+        self._writer: Optional[int] = None
+        self._depth = 0
+        self._waiting_writers = 0
+
+    @contextlib.contextmanager
+    def reading(self) -> Iterator[None]:
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        with self._cond:
+            if me not in self._readers:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers[me] -= 1
+                if not self._readers[me]:
+                    del self._readers[me]
+                    if not self._readers:
+                        self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self) -> Iterator[None]:
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting_writers += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                except BaseException:
+                    # let the readers held back for us in
+                    self._waiting_writers -= 1
+                    self._cond.notify_all()
+                    raise
+                self._waiting_writers -= 1
+                self._writer = me
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._depth -= 1
+                if not self._depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class _SerializedBackend(Backend):
+    # crypto backends must not be used by several threads at once
+
+    def __init__(self, backend: Backend) -> None:
+        self._backend = backend
+        self._lock = threading.Lock()
+        self.name = backend.name
+
+    def __repr__(self) -> str:
+        return repr(self._backend)
+
+    def resolve_key(self, keyid: str) -> str:
+        with self._lock:
+            return self._backend.resolve_key(keyid)
+
+    def resolve_keys(self, keyids: Sequence[str]) -> List[str]:
+        with self._lock:
+            return self._backend.resolve_keys(keyids)
+
+    def key_ids(self, fpr: str) -> Set[str]:
+        with self._lock:
+            return self._backend.key_ids(fpr)
+
+    def encrypt(self, data: bytes, recipients: Sequence[str], signer: str) -> bytes:
+        with self._lock:
+            return self._backend.encrypt(data, recipients, signer)
+
+    def decrypt(self, encdata: bytes) -> Tuple[bytes, Optional[bool]]:
+        with self._lock:
+            return self._backend.decrypt(encdata)
+
+
+class _Snapshot:
+    # entries at one point in time, as the source of search results
+
+    def __init__(self, entries: Mapping[str, Entry]) -> None:
+        self._entries = entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, context: str) -> bool:
+        return context in self._entries
+
+    def entry(self, context: str) -> Entry:
+        return self._entries[context]
+
+
+class SharedDatabase(Database):
+    """Database that can be used by many threads at once.
+
+    Reads (lookups, iteration, searches) share a reader-writer lock
+    and never block each other; changes and reloads take it
+    exclusively.  Iteration and search results see a consistent
+    snapshot of the entries, unaffected by later changes (see
+    snapshot()).
+
+    Snapshots are copy-on-write: handing one out costs nothing, and
+    the entries are only copied by the next change.  save() encrypts
+    such a snapshot without holding the lock, so changes can continue
+    while the database is being saved; changes made meanwhile are
+    kept for the next save.
+
+    The crypto backend is used by one thread at a time.
+
+    """
+
+    def __init__(
+        self,
+        dbpath: Optional[str] = None,
+        keyid: Optional[str] = None,
+        backend: Optional[Backend] = None,
+        recipients: Optional[RecipientSet] = None,
+    ) -> None:
+        self._lock = _RWLock()
+        # one save at a time
+        self._save_lock = threading.Lock()
+        # whether _entries was handed out as a snapshot, and must be
+        # copied before it is changed
+        self._shared = False
+        # number of changes so far
+        self._generation = 0
+        self._saved_generation = 0
+        backend = _SerializedBackend(backend or get_backend())
+        super().__init__(dbpath, keyid, backend, recipients)
+
+    def __str__(self) -> str:
+        return '<impass.SharedDatabase "%s">' % (self._dbpath)
+
+    def __repr__(self) -> str:
+        return 'impass.SharedDatabase("%s")' % (self._dbpath)
+
+    def _share(self) -> Dict[str, Entry]:
+        # call with the lock held
+        self._shared = True
+        return self._entries
+
+    def snapshot(self) -> Mapping[str, Entry]:
+        """Read-only view of the entries at this point in time."""
+        with self._lock.reading():
+            return types.MappingProxyType(self._share())
+
+    def entry(self, context: str) -> Entry:
+        with self._lock.reading():
+            return self._entries[context]
+
+    def __contains__(self, context: str) -> bool:
+        with self._lock.reading():
+            return context in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.snapshot())
+
+    def __len__(self) -> int:
+        with self._lock.reading():
+            return len(self._entries)
+
+    def _put_entry(self, context: str, entry: Optional[Entry]) -> None:
+        with self._lock.writing():
+            if self._shared:
+                self._entries = dict(self._entries)
+                self._shared = False
+            super()._put_entry(context, entry)
+            self._generation += 1
+
+    def put_entries(self, entries: Mapping[str, Optional[Entry]]) -> None:
+        with self._lock.writing():
+            super().put_entries(entries)
+
+    def _reload(self, encdata: Optional[bytes]) -> None:
+        with self._lock.writing():
+            super()._reload(encdata)
+            self._shared = False
+
+    def reload(self) -> None:
+        # not while saving, which would reload or overwrite the file
+        with self._save_lock:
+            super().reload()
+
+    def refresh(self) -> List[str]:
+        with self._save_lock, self._lock.writing():
+            return super().refresh()
+
+    def add(
+        self,
+        context: str,
+        password: Optional[str] = None,
+        expires: Optional[str] = None,
+        fields: Optional[Mapping[str, str]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        with self._lock.writing():
+            return super().add(context, password, expires, fields, tags)
+
+    def replace(
+        self,
+        context: str,
+        password: Optional[str] = None,
+        expires: Optional[str] = None,
+        fields: Optional[Mapping[str, Optional[str]]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        with self._lock.writing():
+            return super().replace(context, password, expires, fields, tags)
+
+    def annotate(
+        self,
+        context: str,
+        fields: Optional[Mapping[str, Optional[str]]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Dict[str, str]:
+        with self._lock.writing():
+            return super().annotate(context, fields, tags)
+
+    def update(self, old_context: str, new_context: str) -> None:
+        with self._lock.writing():
+            super().update(old_context, new_context)
+
+    def rotate(
+        self,
+        contexts: Iterable[str],
+        nbytes: int = DEFAULT_NEW_PASSWORD_OCTETS,
+        passwords: Optional[Mapping[str, str]] = None,
+    ) -> Dict[str, Dict[str, str]]:
+        with self._lock.writing():
+            return super().rotate(contexts, nbytes, passwords)
+
+    def remove(self, context: str) -> None:
+        with self._lock.writing():
+            super().remove(context)
+
+    def restore(self, n: int, contexts: Optional[Iterable[str]] = None) -> List[str]:
+        with self._lock.writing():
+            return super().restore(n, contexts)
+
+    def plaintext_size(self) -> int:
+        with self._lock.reading():
+            return super().plaintext_size()
+
+    def _file_state(self) -> Tuple[Optional[str], Dict[str, Entry]]:
+        with self._lock.reading():
+            return super()._file_state()
+
+    def save(
+        self,
+        keyid: Optional[str] = None,
+        path: Optional[str] = None,
+        version: Optional[int] = None,
+    ) -> None:
+        with self._save_lock:
+            super().save(keyid, path, version)
+
+    def _save_snapshot(
+        self,
+    ) -> Tuple[Mapping[str, Entry], Dict[str, Optional[Entry]]]:
+        with self._lock.writing():
+            self._saved_generation = self._generation
+            return self._share(), dict(self._pending)
+
+    def _stored_indices(self, entries: Mapping[str, Entry]) -> _StoredIndices:
+        # the indices are changed with the entries
+        with self._lock.reading():
+            return super()._stored_indices(entries)
+
+    def _saved(
+        self,
+        path: str,
+        digest: str,
+        version: int,
+        entries: Mapping[str, Entry],
+        pending: Dict[str, Optional[Entry]],
+        sealed: Dict[str, Entry],
+    ) -> None:
+        with self._lock.writing():
+            # newly sealed passwords replace entries not changed since
+            sealed = {
+                c: e for c, e in sealed.items() if self._entries.get(c) is entries[c]
+            }
+            if sealed and self._shared:
+                self._entries = dict(self._entries)
+                self._shared = False
+            self._entries.update(sealed)
+            if path == self._dbpath:
+                self._digest = digest
+                self._version = version
+                # changes made during the save are still pending
+                for context, entry in pending.items():
+                    if context in self._pending and self._pending[context] is entry:
+                        del self._pending[context]
+                self._originals = {c: entries.get(c) for c in self._pending}
+            if self._generation == self._saved_generation:
+                self._modified = False
+
+    def search(
+        self,
+        string: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        tags: Iterable[str] = (),
+        fields: Optional[Mapping[str, str]] = None,
+    ) -> SearchResult:
+        """Search for string in contexts.
+
+        See Database.search(); the result is a view of a snapshot of
+        the entries.
+
+        """
+        tags = list(tags)
+        with self._lock.reading():
+            candidates = None
+            if tags or fields:
+                candidates = sorted(self._select(tags, fields))
+            source = _Snapshot(self._share())
+            return SearchResult(source, string, offset, limit, candidates)
+
+    def date_range(
+        self,
+        field: str = "date",
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+    ) -> List[str]:
+        with self._lock.reading():
+            return super().date_range(field, start, end)
+
+    def _select(
+        self, tags: Iterable[str] = (), fields: Optional[Mapping[str, str]] = None
+    ) -> Set[str]:
+        with self._lock.reading():
+            return set(super()._select(tags, fields))
@@ -0,0 +1,331 @@
+import os
+import json
+import math
+import time
+import tempfile
+import contextlib
+
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Union
+
+from .db import Database, DatabaseError, file_lock
+from .dbset import DatabaseSet
+
+############################################################
+
+# upper bounds, in seconds, of the latency histogram buckets (the
+# last bucket is unbounded)
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+# quantiles reported for distributions
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def summarize(values: Sequence[float]) -> Dict[str, float]:
+    """Count, mean, extremes and quantiles (nearest rank) of values."""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    result = {
+        "count": len(values),
+        "min": values[0],
+        "max": values[-1],
+        "mean": sum(values) / len(values),
+    }
+    for q in QUANTILES:
+        rank = max(math.ceil(q * len(values)), 1)
+        result["p%d" % (q * 100)] = values[rank - 1]
+    return result
+
+
+class Histogram:
+    """Latency histogram with fixed buckets (LATENCY_BUCKETS)."""
+
+    __slots__ = ("counts", "total")
+
+    def __init__(
+        self, counts: Optional[Sequence[int]] = None, total: float = 0.0
+    ) -> None:
+        self.counts = list(counts or [0] * (len(LATENCY_BUCKETS) + 1))
+        if len(self.counts) != len(LATENCY_BUCKETS) + 1:
+            raise DatabaseError("Latency histogram buckets do not match.")
+        # sum of the observed values
+        self.total = total
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, seconds: float) -> None:
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(LATENCY_BUCKETS)
+        self.counts[i] += 1
+        self.total += seconds
+
+    def merge(self, other: "Histogram") -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    def quantile(self, q: float) -> float:
+        """Estimate of quantile q, interpolated within its bucket."""
+        count = self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            if n and seen + n >= rank:
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        # in the unbounded bucket
+        return LATENCY_BUCKETS[-1]
+
+    def summary(self) -> Dict[str, float]:
+        count = self.count
+        result = {"count": count, "mean": self.total / count if count else 0.0}
+        for q in QUANTILES:
+            result["p%d" % (q * 100)] = self.quantile(q)
+        return result
+
+
+class Timings:
+    """Latency histograms of impass operations and commands, on disk.
+
+    The file is plain JSON (it holds no contexts or passwords).
+    Observations are kept in memory until save(), which adds them to
+    the histograms in the file under a lock, so that concurrent impass
+    processes do not lose each other's observations.
+
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        # observations not saved yet, by kind ("operations" or
+        # "commands") and name
+        self._pending: Dict[str, Dict[str, Histogram]] = {}
+
+    def __str__(self) -> str:
+        return '<impass.stats.Timings "%s">' % (self.path)
+
+    def record(self, kind: str, name: str, seconds: float) -> None:
+        """Record one observation of name, of seconds."""
+        histograms = self._pending.setdefault(kind, {})
+        histograms.setdefault(name, Histogram()).observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name: str, kind: str = "operations") -> Iterator[None]:
+        """Record the wall time of the with block as an observation of name."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(kind, name, time.monotonic() - start)
+
+    def _read(self) -> Dict[str, Dict[str, Histogram]]:
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                jsondata = json.load(f)
+        except (OSError, ValueError) as e:
+            raise DatabaseError("Could not read timings: {}".format(e))
+        if jsondata.get("type") != "impass-timings":
+            raise DatabaseError("Timings file is not proper impass timings.")
+        if list(jsondata.get("buckets", [])) != list(LATENCY_BUCKETS):
+            # bucket bounds changed, start over
+            return {}
+        return {
+            kind: {name: Histogram(*h) for name, h in histograms.items()}
+            for kind, histograms in jsondata["histograms"].items()
+        }
+
+    def load(self) -> Dict[str, Dict[str, Histogram]]:
+        """Saved histograms, with the pending observations."""
+        histograms = self._read()
+        for kind, pending in self._pending.items():
+            saved = histograms.setdefault(kind, {})
+            for name, h in pending.items():
+                saved.setdefault(name, Histogram()).merge(h)
+        return histograms
+
+    def save(self) -> None:
+        """Add the pending observations to the timings file."""
+        if self.path is None or not self._pending:
+            return
+        with file_lock(self.path, exclusive=True):
+            histograms = self.load()
+            jsondata = {
+                "type": "impass-timings",
+                "buckets": LATENCY_BUCKETS,
+                "histograms": {
+                    kind: {name: [h.counts, h.total] for name, h in hs.items()}
+                    for kind, hs in histograms.items()
+                },
+            }
+            _write_text(self.path, json.dumps(jsondata, sort_keys=True))
+        self._pending = {}
+
+
+def _write_text(path: str, text: str) -> None:
+    # atomically replace the file at path
+    fd, newpath = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + ".",
+        suffix=".new",
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.chmod(newpath, 0o644)
+        os.rename(newpath, path)
+    except BaseException:
+        if os.path.exists(newpath):
+            os.unlink(newpath)
+        raise
+
+
+############################################################
+
+
+def database_stats(
+    db: Union[Database, DatabaseSet], now: Optional[float] = None
+) -> Dict[str, object]:
+    """Size metrics of a database.
+
+    Reports the number of entries, the size of the cleartext and of
+    the database files on disk, and the distributions of the lengths
+    of contexts (in characters) and of the age of the passwords (in
+    days, from their "date" field).  Passwords are not decrypted.
+
+    """
+    if isinstance(db, DatabaseSet):
+        members: List[Database] = list(db.members.values())
+    else:
+        members = [db]
+    plaintext = 0
+    ciphertext = 0
+    for member in members:
+        plaintext += member.plaintext_size()
+        if member.path is not None and os.path.exists(member.path):
+            ciphertext += os.path.getsize(member.path)
+    if now is None:
+        now = time.time()
+    ages = []
+    for context in db:
+        timestamp = db.entry(context).timestamp("date")
+        if timestamp is not None:
+            ages.append(max(now - timestamp / 1e6, 0) / 86400)
+    return {
+        "entries": len(db),
+        "files": len(members),
+        "plaintext_bytes": plaintext,
+        "ciphertext_bytes": ciphertext,
+        "context_length": summarize([len(c) for c in db]),
+        "age_days": summarize(ages),
+    }
+
+
+def timing_stats(
+    histograms: Mapping[str, Mapping[str, Histogram]]
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Summaries (count, mean and quantiles in seconds) of histograms."""
+    return {
+        kind: {name: h.summary() for name, h in sorted(hs.items())}
+        for kind, hs in sorted(histograms.items())
+    }
+
+
+def _labels(**labels: str) -> str:
+    def escape(value: str) -> str:
+        return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+    return "{%s}" % ",".join('%s="%s"' % (k, escape(v)) for k, v in labels.items())
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prometheus(
+    stats: Optional[Mapping[str, object]],
+    histograms: Mapping[str, Mapping[str, Histogram]],
+) -> str:
+    """Metrics in the Prometheus text exposition format.
+
+    stats is as returned by database_stats() (or None), histograms as
+    returned by Timings.load().  The output is meant for the textfile
+    collector of the node exporter.
+
+    """
+    lines: List[str] = []
+
+    def metric(name: str, kind: str, doc: str) -> None:
+        lines.append("# HELP impass_%s %s" % (name, doc))
+        lines.append("# TYPE impass_%s %s" % (name, kind))
+
+    if stats is not None:
+        for name, doc in [
+            ("entries", "Number of database entries."),
+            ("files", "Number of database files."),
+            ("plaintext_bytes", "Size of the database cleartext."),
+            ("ciphertext_bytes", "Size of the database files."),
+        ]:
+            metric(name, "gauge", doc)
+            lines.append("impass_%s %s" % (name, stats[name]))
+        for name, doc in [
+            ("context_length", "Length of contexts, in characters."),
+            ("age_days", "Age of passwords, in days."),
+        ]:
+            summary = stats[name]
+            assert isinstance(summary, dict)
+            metric(name, "summary", doc)
+            for q in QUANTILES:
+                value = summary.get("p%d" % (q * 100), 0)
+                labels = _labels(quantile=str(q))
+                lines.append("impass_%s%s %s" % (name, labels, _number(value)))
+            mean = summary.get("mean", 0)
+            lines.append(
+                "impass_%s_sum %s" % (name, _number(mean * summary["count"]))
+            )
+            lines.append("impass_%s_count %d" % (name, summary["count"]))
+
+    for kind, label, doc in [
+        ("operations", "operation", "Wall time of impass operations."),
+        ("commands", "command", "Wall time of impass commands."),
+    ]:
+        name = "%s_seconds" % kind.rstrip("s")
+        metric(name, "histogram", doc)
+        for value, h in sorted(histograms.get(kind, {}).items()):
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, h.counts):
+                cumulative += n
+                labels = _labels(**{label: value, "le": str(bound)})
+                lines.append("impass_%s_bucket%s %d" % (name, labels, cumulative))
+            labels = _labels(**{label: value, "le": "+Inf"})
+            lines.append("impass_%s_bucket%s %d" % (name, labels, h.count))
+            labels = _labels(**{label: value})
+            lines.append("impass_%s_sum%s %s" % (name, labels, _number(h.total)))
+            lines.append("impass_%s_count%s %d" % (name, labels, h.count))
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str, text: str) -> None:
+    """Atomically write metrics text, as the textfile collector requires."""
+    _write_text(path, text)
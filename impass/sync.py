@@ -0,0 +1,290 @@
+import io
+import os
+import json
+import stat
+import hashlib
+import tempfile
+
+from typing import Optional, Dict, List, Mapping, Tuple
+
+from .db import Database, DatabaseError, EncryptedStore, Entry
+from .crypto import Backend
+
+############################################################
+
+
+def entry_digest(entry: Entry) -> str:
+    """Digest identifying the content of an entry.
+
+    A sealed password is identified by the digest of its ciphertext,
+    so that it is not decrypted.
+
+    """
+    fields: Dict[str, object] = dict(entry.to_dict())
+    if entry.sealed is not None:
+        fields["password"] = {"sealed": entry.sealed.digest}
+    data = json.dumps(fields, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def _newer(a: Entry, b: Entry) -> bool:
+    ta = a.timestamp("date")
+    tb = b.timestamp("date")
+    return ta is not None and tb is not None and ta > tb
+
+
+# context to new entry, or to None for removal
+Changes = Dict[str, Optional[Entry]]
+
+
+def merge(
+    base: Dict[str, str],
+    local: Mapping[str, Entry],
+    remote: Mapping[str, Entry],
+) -> Tuple[Changes, Changes, List[str]]:
+    """Three-way merge of local and remote entries.
+
+    base maps each context of the last common snapshot to the
+    entry_digest() of its entry.  Returns a tuple of the changes to
+    apply to local, the changes to apply to remote, and the list of
+    conflicting contexts.  Contexts changed on both sides are
+    resolved in favor of the entry with the newer date (local on
+    ties); a removal conflicting with a change keeps the changed
+    entry.
+
+    """
+    to_local: Changes = {}
+    to_remote: Changes = {}
+    conflicts: List[str] = []
+    for context in set(base) | set(local) | set(remote):
+        b = base.get(context)
+        lentry = local.get(context)
+        rentry = remote.get(context)
+        ld = None if lentry is None else entry_digest(lentry)
+        rd = None if rentry is None else entry_digest(rentry)
+        if ld == rd:
+            continue
+        if ld == b:
+            # only changed remotely
+            to_local[context] = rentry
+        elif rd == b:
+            # only changed locally
+            to_remote[context] = lentry
+        else:
+            conflicts.append(context)
+            if lentry is None or (rentry is not None and _newer(rentry, lentry)):
+                to_local[context] = rentry
+            else:
+                to_remote[context] = lentry
+    return to_local, to_remote, sorted(conflicts)
+
+
+############################################################
+
+
+class Remote:
+    """Base class for sync remotes.
+
+    A remote stores a single encrypted database file.
+
+    """
+
+    def __str__(self) -> str:
+        raise NotImplementedError
+
+    def token(self) -> Optional[str]:
+        """Cheap token that changes whenever the remote file changes.
+
+        None if the remote has no database yet.
+
+        """
+        raise NotImplementedError
+
+    def fetch(self) -> bytes:
+        """Return the encrypted remote database."""
+        raise NotImplementedError
+
+    def push(self, encdata: bytes) -> None:
+        """Replace the remote database with encdata."""
+        raise NotImplementedError
+
+
+class DirectoryRemote(Remote):
+    """Remote database file in a local (or mounted) directory."""
+
+    def __init__(self, path: str, name: str = "db") -> None:
+        self._path = os.path.join(os.path.abspath(path), name)
+
+    def __str__(self) -> str:
+        return "dir:" + self._path
+
+    def token(self) -> Optional[str]:
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        return "%d:%d" % (st.st_size, st.st_mtime_ns)
+
+    def fetch(self) -> bytes:
+        with open(self._path, "rb") as f:
+            return f.read()
+
+    def push(self, encdata: bytes) -> None:
+        fd, newpath = tempfile.mkstemp(dir=os.path.dirname(self._path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(encdata)
+        os.chmod(newpath, stat.S_IRUSR | stat.S_IWUSR)
+        os.rename(newpath, self._path)
+
+
+REMOTES = {
+    "dir": DirectoryRemote,
+}
+
+
+def get_remote(spec: str) -> Remote:
+    """Return remote for spec "TYPE:ARG", or a directory path."""
+    kind, sep, arg = spec.partition(":")
+    if sep and kind in REMOTES:
+        return REMOTES[kind](arg)
+    return DirectoryRemote(spec)
+
+
+############################################################
+
+
+class SyncState(EncryptedStore):
+    """Encrypted record of the last common snapshot with each remote.
+
+    For each remote the token of the remote file and the entry
+    digests of the snapshot are kept.
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        keyid: Optional[str] = None,
+        backend: Optional[Backend] = None,
+    ) -> None:
+        super().__init__(keyid, backend)
+        self._path = path
+        self._type = "impass-sync"
+        self._version = 1
+        self._remotes: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            jsondata = json.loads(self._decrypt_db(path).decode("utf-8"))
+            if jsondata.get("type") != self._type:
+                raise DatabaseError("Not a proper impass sync state.")
+            if jsondata.get("version") != self._version:
+                raise DatabaseError("Incompatible sync state.")
+            self._remotes = jsondata["remotes"]
+
+    def get(self, remote: str) -> Tuple[Optional[str], Dict[str, str]]:
+        """Return (token, base digests) for remote."""
+        state = self._remotes.get(remote, {})
+        return state.get("token"), state.get("base", {})
+
+    def set(self, remote: str, token: Optional[str], base: Dict[str, str]) -> None:
+        self._remotes[remote] = {"token": token, "base": base}
+
+    def save(self) -> None:
+        jsondata = {
+            "type": self._type,
+            "version": self._version,
+            "remotes": self._remotes,
+        }
+        cleardata = io.BytesIO(json.dumps(jsondata).encode("utf-8"))
+        self._write_file(self._path, self._encrypt_db(cleardata, self._keyid))
+
+
+class SyncResult:
+    """Summary of a sync."""
+
+    def __init__(self) -> None:
+        self.pulled: List[str] = []
+        self.pushed: List[str] = []
+        self.conflicts: List[str] = []
+        self.fetched = False
+        self.uploaded = False
+        # True if the fetched remote was not signed, as with backends
+        # that do not sign
+        self.unsigned = False
+
+    def __str__(self) -> str:
+        return "%d pulled, %d pushed, %d conflicts" % (
+            len(self.pulled),
+            len(self.pushed),
+            len(self.conflicts),
+        )
+
+
+def sync(db: Database, remote: Remote, keyid: Optional[str] = None) -> SyncResult:
+    """Synchronize db with remote.
+
+    The remote is only fetched if its token changed since the last
+    sync, the local database is only re-encrypted if remote changes
+    were merged, and the remote is only written if local changes were
+    merged.  db must have a path; the sync state is kept next to it
+    (path + ".sync").
+
+    Remote entries are only merged if the remote database carries a
+    valid signature: anyone who can write to the remote could
+    otherwise add or replace entries.  A DatabaseError is raised if
+    the signature is not valid.  With backends that do not sign, the
+    remote is merged and result.unsigned is set.
+
+    """
+    if db.path is None:
+        raise DatabaseError("Database has no path.")
+    if db.modified or not os.path.exists(db.path):
+        db.save(keyid)
+    state = SyncState(db.path + ".sync", keyid or db.keyid, db.backend)
+    token, base = state.get(str(remote))
+    result = SyncResult()
+
+    local = {c: db.entry(c) for c in db}
+    remote_token = remote.token()
+    to_local: Changes = {}
+    if remote_token is not None and remote_token == token:
+        # remote unchanged since the last sync, so it still matches
+        # base, and everything that differs from base is a local
+        # change
+        changed = [c for c in local if base.get(c) != entry_digest(local[c])]
+        changed += [c for c in base if c not in local]
+        result.pushed = sorted(changed)
+    else:
+        remote_entries: Mapping[str, Entry] = {}
+        if remote_token is not None:
+            result.fetched = True
+            remote_db = Database.from_ciphertext(
+                remote.fetch(), keyid or db.keyid, db.backend
+            )
+            if remote_db.sigvalid is False:
+                raise DatabaseError(
+                    "Remote database signature is not valid; not merging it."
+                )
+            result.unsigned = remote_db.sigvalid is None
+            remote_entries = {c: remote_db.entry(c) for c in remote_db}
+        to_local, to_remote, result.conflicts = merge(base, local, remote_entries)
+        result.pulled = sorted(to_local)
+        result.pushed = sorted(to_remote)
+
+    db.put_entries(to_local)
+    if db.modified:
+        db.save(keyid)
+
+    if result.pushed or remote_token is None:
+        with open(db.path, "rb") as f:
+            remote.push(f.read())
+        result.uploaded = True
+        remote_token = remote.token()
+
+    if result.fetched or result.uploaded:
+        state.set(
+            str(remote),
+            remote_token,
+            {c: entry_digest(db.entry(c)) for c in db},
+        )
+        state.save()
+    return result
@@ -0,0 +1,123 @@
+import os
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from .db import Database
+from .dbset import DatabaseSet
+
+############################################################
+
+# from <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT = struct.Struct("iIII")
+
+
+class DatabaseWatcher:
+    """Watch database files for saves by other processes, using inotify.
+
+    Saves replace the database file by renaming a new file over it,
+    so the directories holding the files are watched, not the files
+    themselves.  Call poll() when fileno() is readable (or just
+    periodically) to reload the database if it changed; the file is
+    only decrypted if its content actually changed, so the watcher's
+    own saves cost nothing.
+
+    Only Linux is supported; OSError is raised if inotify is not
+    available.
+
+    """
+
+    def __init__(self, db: Union[Database, DatabaseSet]) -> None:
+        self._db = db
+        if isinstance(db, DatabaseSet):
+            paths = [m.path for m in db.members.values()]
+        else:
+            paths = [db.path]
+        files: Set[Tuple[str, str]] = set()
+        for path in paths:
+            if path is None:
+                raise OSError("Database has no path.")
+            path = os.path.abspath(path)
+            files.add((os.path.dirname(path), os.path.basename(path)))
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("inotify is not available.")
+        self._fd = init(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # watch descriptor to directory, and watched (dir, name) pairs
+        self._dirs: Dict[int, str] = {}
+        self._files = files
+        mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+        for dirpath in {d for d, _ in files}:
+            wd = self._add_watch(self._fd, os.fsencode(dirpath), mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                self.close()
+                raise OSError(errno, "inotify_add_watch failed", dirpath)
+            self._dirs[wd] = dirpath
+
+    def __enter__(self) -> "DatabaseWatcher":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def fileno(self) -> int:
+        """File descriptor that becomes readable on file events."""
+        return self._fd
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _relevant(self) -> bool:
+        # drain all queued events, and tell whether any concerns a
+        # database file
+        relevant = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096 * (_EVENT.size + 256))
+            except BlockingIOError:
+                return relevant
+            pos = 0
+            while pos + _EVENT.size <= len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, pos)
+                pos += _EVENT.size
+                name = data[pos : pos + length].rstrip(b"\0")
+                pos += length
+                if mask & _IN_Q_OVERFLOW:
+                    relevant = True
+                elif (self._dirs.get(wd), os.fsdecode(name)) in self._files:
+                    relevant = True
+
+    def poll(self, timeout: Optional[float] = 0) -> List[str]:
+        """Reload the database if one of its files changed.
+
+        Waits up to timeout seconds for a change (forever if None).
+        Returns the contexts that were added, removed or modified
+        (see Database.refresh()).
+
+        """
+        if timeout != 0:
+            select.select([self._fd], [], [], timeout)
+        if not self._relevant():
+            return []
+        return self._db.refresh()
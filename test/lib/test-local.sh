@@ -5,6 +5,7 @@ export LC_ALL=C.UTF-8
 export SRC_DIRECTORY=$(cd "$TEST_DIRECTORY"/.. && pwd)
 export PYTHONPATH="$SRC_DIRECTORY":"$PYTHONPATH"
 export IMPASS_DB="$TMP_DIRECTORY"/db
+export IMPASS_HISTORY="$TMP_DIRECTORY"/history
 export GNUPGHOME="$TEST_DIRECTORY"/gnupg
 export IMPASS_KEYID=84DCED32C1D6E9DDF52C65D1B2D1C2C1E7EEC6DC
 